@@ -1,4 +1,4 @@
-from flask import Flask, request, jsonify, make_response, send_file
+from flask import Flask, request, jsonify, make_response, send_file, Response, stream_with_context
 from flask_cors import CORS
 import pandas as pd
 import io
@@ -20,6 +20,22 @@ import traceback
 import sys
 import pytz
 import re
+import csv
+import collections
+import cProfile
+import difflib
+import functools
+import hashlib
+import hmac
+import itertools
+import pstats
+import shutil
+import tempfile
+import threading
+import uuid
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud.firestore_v1.field_path import FieldPath
 from reportlab.lib import colors
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Table, Spacer, Image
@@ -39,16 +55,34 @@ app = Flask(__name__)
 # Set current date and time dynamically
 current_date = datetime.now(pytz.timezone('Asia/Kolkata')).replace(hour=3, minute=28, second=0, microsecond=0)  # 03:28 AM IST, October 27, 2025
 
+def ist_now():
+    return datetime.now(pytz.timezone('Asia/Kolkata'))
+
 # CORS configuration: Dynamically allow the requesting origin
 CORS(app, resources={r"/*": {"origins": "*", "supports_credentials": True}})
 
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB limit
 app.config['SECRET_KEY'] = os.urandom(24)
-app.config['THREADS'] = 1
+app.config['WORKERS'] = int(os.getenv('WORKERS', '1'))
+app.config['THREADS'] = int(os.getenv('THREADS', '1'))
+app.config['SNAPSHOTS_ENABLED'] = os.getenv('SNAPSHOTS_ENABLED', '1') == '1'
+app.config['SNAPSHOT_DIR'] = os.getenv('SNAPSHOT_DIR', os.path.join(tempfile.gettempdir(), 'airport_snapshots'))
+app.config['FETCH_WORKERS'] = int(os.getenv('FETCH_WORKERS', '8'))
+app.config['MAX_COMPARE_BATCHES'] = int(os.getenv('MAX_COMPARE_BATCHES', '400'))
+app.config['AUDIT_HEAVY_AIRCRAFT_WT'] = float(os.getenv('AUDIT_HEAVY_AIRCRAFT_WT', '45000'))
+app.config['EXCEL_ENGINE'] = os.getenv('EXCEL_ENGINE', 'openpyxl').lower()  # openpyxl | calamine
+app.config['PROFILE_ADMIN_TOKEN'] = os.getenv('PROFILE_ADMIN_TOKEN', '')  # empty disables request profiling
+app.config['PROFILE_DIR'] = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'airport_profiles'))
+app.config['PROFILE_TOP_N'] = int(os.getenv('PROFILE_TOP_N', '25'))
 
 logger.info(f"Matplotlib backend set to: {matplotlib.get_backend()} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
 
 def initialize_firestore():
+    if os.getenv('FIRESTORE_BACKEND', 'firebase').lower() == 'memory':
+        # Local in-process stand-in (load tests, offline runs); nothing is persisted.
+        from memory_firestore import MemoryClient
+        logger.info(f"Using in-memory Firestore backend at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        return MemoryClient()
     try:
         cred_path = os.getenv('FIREBASE_CRED_PATH', r"C:\Users\suremdra singh\Desktop\Flutter project\airport-authority-linkage-app\lib\flask-backend\airport-authority-linkage-firebase-adminsdk-fbsvc-d146646df7.json")
         if not os.path.exists(cred_path):
@@ -67,7 +101,25 @@ def initialize_firestore():
         logger.error(f"Failed to initialize Firestore: {e}\n{traceback.format_exc()} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
         raise
 
-db = initialize_firestore()
+class LazyFirestoreClient:
+    # The client is created on first use rather than at import. Under gunicorn the master imports this module
+    # and forks, and a gRPC channel must not cross a fork, so each worker builds its own on its first request.
+    def __init__(self, factory):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+
+    def get_client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return self._client
+
+    def __getattr__(self, name):
+        return getattr(self.get_client(), name)
+
+db = LazyFirestoreClient(initialize_firestore)
 
 def firestore_retry(max_retries=3, initial_delay=1.0, max_delay=10.0):
     return retry.Retry(
@@ -118,56 +170,1011 @@ def clean_out_of_range(df):
         df.loc[mask, col] = None
     return df
 
-# ENHANCEMENT: More robust column name normalization
+# Shared by the audit rules, traffic cubes and route matrices: a missing column reads as a constant default.
+def resolve_column(frame, column, default=0.0):
+    return frame[column] if column in frame.columns else pd.Series(default, index=frame.index)
+
+DEPARTURE_COLUMN_MAPPINGS = {
+    'SL No.': 'SL_No', 'Airport Code': 'Airport_Code', 'Airport Name': 'Airport_Name',
+    'Region': 'Region', 'ProfitCenter': 'Profit_Center', 'Operator Name': 'Operator_Name',
+    'Operator': 'Operator_Name', 'OperatorName': 'Operator_Name',
+    'CA12 No.': 'CA12_No', 'Reg No.': 'Reg_No', 'Max Allup Wt': 'Max_Allup_Wt',
+    'Seating Capacity': 'Seating_Capacity', 'Helicopter': 'Helicopter',
+    'Aircraft Type': 'Aircraft_Type', 'Arr Date': 'Arr_Date', 'Arr GMT': 'Arr_GMT',
+    'Arr Flight No.': 'Arr_Flight_No', 'Dep Location': 'Dep_Location', 'Arr Nature': 'Arr_Nature',
+    'Arr GCD': 'Arr_GCD', 'Arr Sch': 'Arr_Sch', 'Arr RCS Status': 'Arr_RCS_Status',
+    'Arr RCS Category': 'Arr_RCS_Category', 'Dep Date': 'Dep_Date', 'Dep GMT': 'Dep_GMT',
+    'Dep Flight No.': 'Dep_Flight_No', 'Dest Location': 'Dest_Location', 'Dep Nature': 'Dep_Nature',
+    'Dep GCD': 'Dep_GCD', 'Dep Sch': 'Dep_Sch', 'Dep RCS Status': 'Dep_RCS_Status',
+    'Dep RCS Category': 'Dep_RCS_Category', 'Credit Facility': 'Credit_Facility',
+    'Operator Type': 'Operator_Type', 'Landing': 'Landing', 'Parking': 'Parking',
+    'Open Parking': 'Open_Parking', 'Housing': 'Housing', 'RNFC': 'RNFC', 'TNLC': 'TNLC',
+    'Arr Watch': 'Arr_Watch', 'Dep Watch': 'Dep_Watch', 'Counter': 'Counter', 'XRay': 'XRay',
+    'UDF Charge': 'UDF_Charge', 'OLD IN PAX': 'OLD_IN_PAX', 'OLD US PAX': 'OLD_US_PAX',
+    'NEW IN PAX': 'NEW_IN_PAX', 'NEW US PAX': 'NEW_US_PAX', 'OLD IN RATE': 'OLD_IN_RATE',
+    'OLD US RATE': 'OLD_US_RATE', 'NEW IN RATE': 'NEW_IN_RATE', 'NEW US RATE': 'NEW_US_RATE',
+    'Unique Id': 'Unique_Id', 'Arr Bill Status': 'Arr_Bill_Status',
+    'Dep Bill Status': 'Dep_Bill_Status', 'UDF Bill Status': 'UDF_Bill_Status'
+}
+BASE_COLUMN_MAPPINGS = {
+    'Payer ID': 'Payer_ID', 'Customer Name': 'Operator_Name', 'VAN SPOC': 'VAN_SPOC',
+    'CF Validity': 'CF_Validity', 'Fleet Count': 'Fleet_Count', 'Opening Balance': 'Opening_Balance',
+    'Assessment': 'Assessment', 'Realisation': 'Realisation', 'Closing Balance': 'Closing_Balance',
+    'SD/BG': 'SD_BG', 'Avg Monthly Assessment': 'Avg_Monthly_Assessment'
+}
+# Columns the base pipeline actually consumes; everything else in a finance workbook is skipped at read time.
+BASE_PROJECTED_COLUMNS = ['Operator_Name', 'Assessment', 'Realisation', 'Closing_Balance', 'Fleet_Count']
+BASE_NUMERIC_COLUMNS = ['Assessment', 'Realisation', 'Closing_Balance', 'Fleet_Count']
+COLUMN_KEY_PATTERN = re.compile(r'[^\w\s\.]')
+COLUMN_SEPARATOR_PATTERN = re.compile(r'[\s\./&]+')
+COLUMN_UNDERSCORE_PATTERN = re.compile(r'_+')
+
+# ENHANCEMENT: More robust column name normalization (memoized: headers repeat across sheets and files)
+@functools.lru_cache(maxsize=4096)
 def normalize_column_name(col):
     col = str(col).strip()
-    col_key = re.sub(r'[^\w\s\.]', '', col).strip()
-
-    departure_mappings = {
-        'SL No.': 'SL_No', 'Airport Code': 'Airport_Code', 'Airport Name': 'Airport_Name',
-        'Region': 'Region', 'ProfitCenter': 'Profit_Center', 'Operator Name': 'Operator_Name',
-        'Operator': 'Operator_Name', 'OperatorName': 'Operator_Name',
-        'CA12 No.': 'CA12_No', 'Reg No.': 'Reg_No', 'Max Allup Wt': 'Max_Allup_Wt',
-        'Seating Capacity': 'Seating_Capacity', 'Helicopter': 'Helicopter',
-        'Aircraft Type': 'Aircraft_Type', 'Arr Date': 'Arr_Date', 'Arr GMT': 'Arr_GMT',
-        'Arr Flight No.': 'Arr_Flight_No', 'Dep Location': 'Dep_Location', 'Arr Nature': 'Arr_Nature',
-        'Arr GCD': 'Arr_GCD', 'Arr Sch': 'Arr_Sch', 'Arr RCS Status': 'Arr_RCS_Status',
-        'Arr RCS Category': 'Arr_RCS_Category', 'Dep Date': 'Dep_Date', 'Dep GMT': 'Dep_GMT',
-        'Dep Flight No.': 'Dep_Flight_No', 'Dest Location': 'Dest_Location', 'Dep Nature': 'Dep_Nature',
-        'Dep GCD': 'Dep_GCD', 'Dep Sch': 'Dep_Sch', 'Dep RCS Status': 'Dep_RCS_Status',
-        'Dep RCS Category': 'Dep_RCS_Category', 'Credit Facility': 'Credit_Facility',
-        'Operator Type': 'Operator_Type', 'Landing': 'Landing', 'Parking': 'Parking',
-        'Open Parking': 'Open_Parking', 'Housing': 'Housing', 'RNFC': 'RNFC', 'TNLC': 'TNLC',
-        'Arr Watch': 'Arr_Watch', 'Dep Watch': 'Dep_Watch', 'Counter': 'Counter', 'XRay': 'XRay',
-        'UDF Charge': 'UDF_Charge', 'OLD IN PAX': 'OLD_IN_PAX', 'OLD US PAX': 'OLD_US_PAX',
-        'NEW IN PAX': 'NEW_IN_PAX', 'NEW US PAX': 'NEW_US_PAX', 'OLD IN RATE': 'OLD_IN_RATE',
-        'OLD US RATE': 'OLD_US_RATE', 'NEW IN RATE': 'NEW_IN_RATE', 'NEW US RATE': 'NEW_US_RATE',
-        'Unique Id': 'Unique_Id', 'Arr Bill Status': 'Arr_Bill_Status',
-        'Dep Bill Status': 'Dep_Bill_Status', 'UDF Bill Status': 'UDF_Bill_Status'
-    }
-    base_mappings = {
-        'Payer ID': 'Payer_ID', 'Customer Name': 'Operator_Name', 'VAN SPOC': 'VAN_SPOC',
-        'CF Validity': 'CF_Validity', 'Fleet Count': 'Fleet_Count', 'Opening Balance': 'Opening_Balance',
-        'Assessment': 'Assessment', 'Realisation': 'Realisation', 'Closing Balance': 'Closing_Balance',
-        'SD/BG': 'SD_BG', 'Avg Monthly Assessment': 'Avg_Monthly_Assessment'
-    }
+    col_key = COLUMN_KEY_PATTERN.sub('', col).strip()
 
-    if col_key in departure_mappings:
-        mapped_col = departure_mappings[col_key]
-    elif col_key in base_mappings:
-        mapped_col = base_mappings[col_key]
+    if col_key in DEPARTURE_COLUMN_MAPPINGS:
+        mapped_col = DEPARTURE_COLUMN_MAPPINGS[col_key]
+    elif col_key in BASE_COLUMN_MAPPINGS:
+        mapped_col = BASE_COLUMN_MAPPINGS[col_key]
     else:
-        mapped_col = re.sub(r'[\s\./&]+', '_', col_key)
-        mapped_col = re.sub(r'_+', '_', mapped_col).rstrip('_')
+        mapped_col = COLUMN_SEPARATOR_PATTERN.sub('_', col_key)
+        mapped_col = COLUMN_UNDERSCORE_PATTERN.sub('_', mapped_col).rstrip('_')
 
     logger.debug(f"Normalized '{col}' (key: '{col_key}') to '{mapped_col}' at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
     return mapped_col
 
+def base_column_positions(header):
+    positions = {}
+    for position, col in enumerate(header):
+        positions.setdefault(normalize_column_name(col), position)
+    projected = [name for name in BASE_PROJECTED_COLUMNS if name in positions]
+    if 'Operator_Name' not in projected:
+        # Unknown layout: load everything so the caller can report which columns were found.
+        return None
+    return sorted(positions[name] for name in projected)
+
+def finish_base_frame(df):
+    for col in BASE_NUMERIC_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0.0)
+    return df
+
+def load_base_sheet(stream, sheet, engine='openpyxl'):
+    stream.seek(0)
+    header = pd.read_excel(stream, sheet_name=sheet, header=0, nrows=0, engine=engine).columns
+    usecols = base_column_positions(header)
+    logger.debug(f"Base sheet {sheet}: projecting {usecols} out of {len(header)} columns at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+    stream.seek(0)
+    if usecols is None:
+        df = pd.read_excel(stream, sheet_name=sheet, header=0, engine=engine)
+        df.columns = [normalize_column_name(col) for col in df.columns]
+        return df
+    df = pd.read_excel(stream, sheet_name=sheet, header=0, usecols=usecols, engine=engine)
+    df.columns = [normalize_column_name(header[position]) for position in usecols]
+    return finish_base_frame(df)
+
+# Departure sheets are read positionally: 2 metadata rows + 1 header row, then exactly these columns in order.
+DEPARTURE_SHEET_COLUMNS = [
+    'SL_No', 'Airport_Code', 'Airport_Name', 'Region', 'Profit_Center', 'Operator_Name',
+    'CA12_No', 'Reg_No', 'Max_Allup_Wt', 'Seating_Capacity', 'Helicopter',
+    'Aircraft_Type', 'Arr_Date', 'Arr_GMT', 'Arr_Flight_No', 'Dep_Location',
+    'Arr_Nature', 'Arr_GCD', 'Arr_Sch', 'Arr_RCS_Status', 'Arr_RCS_Category',
+    'Dep_Date', 'Dep_GMT', 'Dep_Flight_No', 'Dest_Location', 'Dep_Nature',
+    'Dep_GCD', 'Dep_Sch', 'Dep_RCS_Status', 'Dep_RCS_Category', 'Credit_Facility',
+    'Operator_Type', 'Landing', 'Parking', 'Open_Parking', 'Housing', 'RNFC',
+    'TNLC', 'Arr_Watch', 'Dep_Watch', 'Counter', 'XRay', 'UDF_Charge',
+    'OLD_IN_PAX', 'OLD_US_PAX', 'NEW_IN_PAX', 'NEW_US_PAX', 'OLD_IN_RATE',
+    'OLD_US_RATE', 'NEW_IN_RATE', 'NEW_US_RATE', 'Unique_Id', 'Arr_Bill_Status',
+    'Dep_Bill_Status', 'UDF_Bill_Status'
+]
+DEPARTURE_SKIP_ROWS = 3
+# Read as text from CSV so codes like GMT '0005' or flight numbers keep their leading zeros, as they do in Excel.
+DEPARTURE_TEXT_COLUMNS = [
+    'Airport_Code', 'Airport_Name', 'Region', 'Profit_Center', 'Operator_Name', 'CA12_No', 'Reg_No', 'Helicopter',
+    'Aircraft_Type', 'Arr_GMT', 'Arr_Flight_No', 'Dep_Location', 'Arr_Nature', 'Arr_Sch', 'Arr_RCS_Status',
+    'Arr_RCS_Category', 'Dep_GMT', 'Dep_Flight_No', 'Dest_Location', 'Dep_Nature', 'Dep_Sch', 'Dep_RCS_Status',
+    'Dep_RCS_Category', 'Credit_Facility', 'Operator_Type', 'Unique_Id', 'Arr_Bill_Status', 'Dep_Bill_Status', 'UDF_Bill_Status'
+]
+DEPARTURE_DATE_COLUMNS = ['Arr_Date', 'Dep_Date']
+EXCEL_EPOCH = pd.Timestamp(1899, 12, 30)
+
+def departure_structure_error(found):
+    return f"File structure error: Expected {len(DEPARTURE_SHEET_COLUMNS)} columns, found only {found} after skipping {DEPARTURE_SKIP_ROWS} rows."
+
+def load_departure_sheet(stream, sheet, engine='openpyxl'):
+    stream.seek(0)
+    # Load with NO HEADER, starting from the first data row, then force the expected names by position.
+    df = pd.read_excel(stream, sheet_name=sheet, skiprows=DEPARTURE_SKIP_ROWS, header=None, engine=engine)
+    if len(df.columns) < len(DEPARTURE_SHEET_COLUMNS):
+        raise ValueError(departure_structure_error(len(df.columns)))
+    df = df.iloc[:, :len(DEPARTURE_SHEET_COLUMNS)]
+    df.columns = DEPARTURE_SHEET_COLUMNS
+    return df
+
+def departure_column_positions(header):
+    # Exports with recognizable headers are projected by name; anything else falls back to the sheet layout.
+    positions = {}
+    for position, col in enumerate(header):
+        positions.setdefault(normalize_column_name(col), position)
+    if all(name in positions for name in DEPARTURE_SHEET_COLUMNS):
+        return [positions[name] for name in DEPARTURE_SHEET_COLUMNS]
+    if len(header) < len(DEPARTURE_SHEET_COLUMNS):
+        raise ValueError(departure_structure_error(len(header)))
+    return list(range(len(DEPARTURE_SHEET_COLUMNS)))
+
+def excel_serial_dates(values):
+    # CSV and Parquet carry real dates where Excel carries day serials; the departure pipeline expects serials.
+    if pd.api.types.is_numeric_dtype(values):
+        return values
+    if pd.api.types.is_datetime64_any_dtype(values):
+        dates = values.dt.tz_localize(None) if getattr(values.dt, 'tz', None) is not None else values
+    else:
+        numeric = pd.to_numeric(values, errors='coerce')
+        dates = pd.to_datetime(values.where(numeric.isna()), errors='coerce', dayfirst=True, format='mixed')
+        return numeric.fillna((dates - EXCEL_EPOCH) / pd.Timedelta(days=1))
+    return (dates - EXCEL_EPOCH) / pd.Timedelta(days=1)
+
+def finish_departure_frame(df):
+    for col in DEPARTURE_DATE_COLUMNS:
+        df[col] = excel_serial_dates(df[col])
+    return df
+
+# Upload formats are detected from the leading bytes rather than trusted from the file name.
+UPLOAD_EXTENSIONS = ('.xlsx', '.xls', '.csv', '.parquet')
+CSV_HEADER_SCAN_ROWS = 20
+
+def detect_upload_format(stream):
+    stream.seek(0)
+    magic = stream.read(8)
+    stream.seek(0)
+    if magic.startswith(b'PK\x03\x04'):
+        return 'xlsx'
+    if magic.startswith(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'):
+        return 'xls'
+    if magic.startswith(b'PAR1'):
+        return 'parquet'
+    return 'csv'
+
+@functools.lru_cache(maxsize=1)
+def calamine_available():
+    try:
+        import python_calamine  # noqa: F401
+        return True
+    except ImportError:
+        logger.warning(f"EXCEL_ENGINE=calamine but python-calamine is not installed, using openpyxl at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        return False
+
+def excel_engine(file_format):
+    # openpyxl cannot read legacy .xls at all, so those always go through calamine when it is installed.
+    if (app.config['EXCEL_ENGINE'] == 'calamine' or file_format == 'xls') and calamine_available():
+        return 'calamine'
+    return 'openpyxl'
+
+def read_csv_text(stream):
+    raw = stream.getvalue()
+    for encoding in ('utf-8-sig', 'cp1252'):
+        try:
+            return raw.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return raw.decode('latin-1')
+
+def find_csv_header_row(text, file_type):
+    # Airport exports keep the report's title rows above the header; the header is the first row naming the operator.
+    reader = csv.reader(io.StringIO(text))
+    for index, row in enumerate(itertools.islice(reader, CSV_HEADER_SCAN_ROWS)):
+        if any(normalize_column_name(cell) == 'Operator_Name' for cell in row if cell.strip()):
+            return index
+    return DEPARTURE_SKIP_ROWS - 1 if file_type == 'departure' else 0
+
+def load_csv_table(stream, file_type):
+    text = read_csv_text(stream)
+    header_row = find_csv_header_row(text, file_type)
+    header = next(itertools.islice(csv.reader(io.StringIO(text)), header_row, None), [])
+    if file_type == 'departure':
+        positions = departure_column_positions(header)
+        names = DEPARTURE_SHEET_COLUMNS
+        dtype = {positions[names.index(col)]: str for col in DEPARTURE_TEXT_COLUMNS}
+    else:
+        positions = base_column_positions(header)
+        if positions is None:
+            positions = list(range(len(header)))
+        names = [normalize_column_name(header[position]) for position in positions]
+        dtype = {positions[names.index('Operator_Name')]: str} if 'Operator_Name' in names else None
+    df = pd.read_csv(io.StringIO(text), skiprows=header_row + 1, header=None, usecols=positions, dtype=dtype,
+                     skip_blank_lines=True, keep_default_na=True, engine='c')
+    df = df[positions]
+    df.columns = names
+    return finish_departure_frame(df) if file_type == 'departure' else finish_base_frame(df)
+
+def load_parquet_table(stream, file_type):
+    import pyarrow.parquet as pq
+    stream.seek(0)
+    header = pq.read_schema(stream).names
+    if file_type == 'departure':
+        positions = departure_column_positions(header)
+        names = DEPARTURE_SHEET_COLUMNS
+    else:
+        positions = base_column_positions(header)
+        if positions is None:
+            positions = list(range(len(header)))
+        names = [normalize_column_name(header[position]) for position in positions]
+    stream.seek(0)
+    df = pd.read_parquet(stream, columns=[header[position] for position in positions], engine='pyarrow')
+    df.columns = names
+    return finish_departure_frame(df) if file_type == 'departure' else finish_base_frame(df)
+
+def list_upload_sheets(stream, file_format, filename):
+    if file_format in ('xlsx', 'xls'):
+        stream.seek(0)
+        return pd.ExcelFile(stream, engine=excel_engine(file_format)).sheet_names
+    # CSV and Parquet hold a single table; it is named after the file so batch keys and doc ids stay readable.
+    return [secure_filename(os.path.splitext(filename)[0]) or 'Sheet1']
+
+def load_upload_sheet(stream, file_format, sheet, file_type):
+    if file_format == 'csv':
+        return load_csv_table(stream, file_type)
+    if file_format == 'parquet':
+        return load_parquet_table(stream, file_type)
+    engine = excel_engine(file_format)
+    if file_type == 'departure':
+        return load_departure_sheet(stream, sheet, engine)
+    return load_base_sheet(stream, sheet, engine)
+
+# Operator canonicalization: raw spellings are mapped to one display name through the persistent
+# alias table (Firestore 'operator_aliases'), then exact normalized keys, then fuzzy matching against
+# names already seen. The answer must not depend on which worker or which upload saw a name first:
+# an unaliased key gets a display name derived from the key itself, and a fuzzy match is written to the
+# alias table (create-if-absent, so the first decision wins everywhere). The table is re-read every
+# OPERATOR_ALIAS_TTL_SECONDS so aliases posted to one worker reach the others.
+OPERATOR_KEY_STOPWORDS = {'PVT', 'PRIVATE', 'LTD', 'LIMITED', 'INC', 'CORP', 'CORPORATION', 'CO', 'COMPANY', 'LLP', 'THE', 'M', 'S', 'MS'}
+OPERATOR_FUZZY_CUTOFF = float(os.getenv('OPERATOR_FUZZY_CUTOFF', '0.9'))
+OPERATOR_ALIAS_TTL_SECONDS = float(os.getenv('OPERATOR_ALIAS_TTL_SECONDS', '300'))
+_operator_lock = threading.RLock()
+_operator_alias_table = None
+_operator_alias_loaded_at = 0.0
+_operator_canonical_cache = {}
+_operator_registry = {}
+
+def normalize_operator_key(name):
+    if name is None or (not isinstance(name, str) and pd.isna(name)):
+        return 'UNKNOWN'
+    key = str(name).upper().replace('&', ' AND ')
+    key = re.sub(r'[^A-Z0-9]+', ' ', key)
+    tokens = [token for token in key.split() if token not in OPERATOR_KEY_STOPWORDS]
+    return ' '.join(tokens) if tokens else 'UNKNOWN'
+
+def operator_display_name(key):
+    # Stable spelling for a key with no alias: "AIR INDIA LTD", "Air India" and "air india" all read "Air India".
+    return ' '.join(token if any(ch.isdigit() for ch in token) else token.capitalize() for token in key.split())
+
+def load_operator_aliases():
+    global _operator_alias_table, _operator_alias_loaded_at
+    with _operator_lock:
+        if _operator_alias_table is None or time.time() - _operator_alias_loaded_at >= OPERATOR_ALIAS_TTL_SECONDS:
+            table = {}
+            try:
+                for doc in db.collection("operator_aliases").stream():
+                    data = doc.to_dict()
+                    if data.get('canonical'):
+                        table[normalize_operator_key(data.get('alias', doc.id))] = data['canonical']
+                logger.info(f"Loaded {len(table)} operator aliases at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            except Exception as e:
+                logger.warning(f"Failed to load operator aliases, continuing without them: {e} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+                table = dict(_operator_alias_table or {})
+            if table != _operator_alias_table:
+                _operator_canonical_cache.clear()
+                for canonical in table.values():
+                    _operator_registry[normalize_operator_key(canonical)] = canonical
+            _operator_alias_table = table
+            _operator_alias_loaded_at = time.time()
+        return _operator_alias_table
+
+def persist_fuzzy_alias(alias_key, display_name, canonical):
+    # create() fails if another worker already recorded this key; its decision is the one everybody uses.
+    doc_ref = db.collection("operator_aliases").document(alias_key)
+    try:
+        doc_ref.create({'alias': display_name, 'canonical': canonical, 'source': 'fuzzy', 'updated_at': firestore.SERVER_TIMESTAMP})
+        return canonical
+    except exceptions.Conflict:
+        existing = doc_ref.get()
+        return (existing.to_dict() or {}).get('canonical') or canonical if existing.exists else canonical
+    except Exception as e:
+        logger.warning(f"Failed to persist fuzzy operator alias '{display_name}' -> '{canonical}': {e} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        return canonical
+
+def canonicalize_operator_name(raw_name):
+    if raw_name is None or (not isinstance(raw_name, str) and pd.isna(raw_name)):
+        return 'Unknown'
+    display_name = re.sub(r'\s+', ' ', str(raw_name)).strip()
+    if not display_name or display_name.upper() in ('N/A', 'NAN', 'UNKNOWN'):
+        return 'Unknown'
+
+    aliases = load_operator_aliases()
+    cached = _operator_canonical_cache.get(raw_name)
+    if cached is not None:
+        return cached
+
+    with _operator_lock:
+        key = normalize_operator_key(display_name)
+        canonical = aliases.get(key) or _operator_registry.get(key)
+        if canonical is None:
+            # Names that differ only in a number ("Air Charter 1" vs "Air Charter 11") are never fuzzy-merged.
+            numbers = re.findall(r'\d+', key)
+            matches = [match for match in difflib.get_close_matches(key, sorted(_operator_registry), n=3, cutoff=OPERATOR_FUZZY_CUTOFF)
+                       if re.findall(r'\d+', match) == numbers][:1]
+            if matches:
+                canonical = persist_fuzzy_alias(key, display_name, _operator_registry[matches[0]])
+                aliases[key] = canonical
+                logger.debug(f"Fuzzy-matched operator '{display_name}' to '{canonical}' at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            else:
+                canonical = operator_display_name(key)
+            _operator_registry[key] = canonical
+        _operator_canonical_cache[raw_name] = canonical
+    return canonical
+
+def canonicalize_operator_column(series):
+    mapping = {raw_name: canonicalize_operator_name(raw_name) for raw_name in series.dropna().unique()}
+    return series.map(mapping).fillna('Unknown')
+
+def operator_join_key(stored_name):
+    # Read-only: rows are canonicalized at ingest, so a join only consults the alias table (for documents
+    # written before an alias was added) and never fuzzy-matches or records anything.
+    display_name = '' if stored_name is None or (not isinstance(stored_name, str) and pd.isna(stored_name)) else str(stored_name).strip()
+    if not display_name or display_name.upper() in ('N/A', 'NAN', 'UNKNOWN'):
+        return 'UNKNOWN'
+    key = normalize_operator_key(display_name)
+    canonical = load_operator_aliases().get(key)
+    return normalize_operator_key(canonical) if canonical else key
+
+def set_operator_alias(alias, canonical):
+    alias_key = normalize_operator_key(alias)
+    @firestore_retry()
+    def set_alias_doc():
+        db.collection("operator_aliases").document(alias_key).set({'alias': alias, 'canonical': canonical, 'updated_at': firestore.SERVER_TIMESTAMP})
+    set_alias_doc()
+    with _operator_lock:
+        load_operator_aliases()[alias_key] = canonical
+        _operator_registry[normalize_operator_key(canonical)] = canonical
+        _operator_canonical_cache.clear()
+    return alias_key
+
+# Mergeable distribution sketches. A quantile digest is a list of (mean, weight) centroids whose
+# sizes follow the t-digest arcsine scale (fine at the tails, coarse in the middle); building,
+# merging and compressing are all vectorized sorts plus reduceat. Histograms use fixed edges so
+# merging is element-wise addition. Both are stored as flat lists (Firestore has no nested arrays).
+DIGEST_COMPRESSION = 100
+SKETCH_METRICS = ['Airtime_Hours', 'Landing', 'UDF_Charge']
+SKETCH_DIMENSIONS = {'operator': 'Operator_Name', 'region': 'Region', 'airport': 'Airport_Name', 'all': None}
+HISTOGRAM_EDGES = {
+    'Airtime_Hours': [0, 1, 2, 4, 6, 8, 10, 12, 14, 18, 24, 36, 48, 72],
+    'Landing': [0, 0.01, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000],
+    'UDF_Charge': [0, 0.01, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000, 500000, 1000000]
+}
+
+def compress_centroids(means, weights):
+    order = np.argsort(means, kind='mergesort')
+    means, weights = means[order], weights[order]
+    total = weights.sum()
+    q_mid = (np.cumsum(weights) - weights / 2) / total
+    k = np.floor(DIGEST_COMPRESSION / (2 * np.pi) * np.arcsin(np.clip(2 * q_mid - 1, -1.0, 1.0)))
+    starts = np.r_[0, np.flatnonzero(np.diff(k)) + 1]
+    merged_weights = np.add.reduceat(weights, starts)
+    merged_means = np.add.reduceat(means * weights, starts) / merged_weights
+    return merged_means, merged_weights
+
+def build_metric_sketch(metric, values):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[np.isfinite(values)]
+    sketch = {'count': int(len(values)), 'min': None, 'max': None, 'means': [], 'weights': [],
+              'histogram': [0] * len(HISTOGRAM_EDGES[metric])}
+    if len(values) == 0:
+        return sketch
+    means, weights = compress_centroids(values, np.ones(len(values)))
+    counts, _ = np.histogram(values, bins=HISTOGRAM_EDGES[metric] + [np.inf])
+    sketch.update({'min': float(values.min()), 'max': float(values.max()), 'means': means.tolist(),
+                   'weights': weights.tolist(), 'histogram': counts.astype(int).tolist()})
+    return sketch
+
+def merge_metric_sketch(a, b):
+    if not a or not a.get('count'):
+        return dict(b)
+    if not b or not b.get('count'):
+        return dict(a)
+    means, weights = compress_centroids(np.asarray(a['means'] + b['means'], dtype=np.float64),
+                                        np.asarray(a['weights'] + b['weights'], dtype=np.float64))
+    return {'count': a['count'] + b['count'], 'min': min(a['min'], b['min']), 'max': max(a['max'], b['max']),
+            'means': means.tolist(), 'weights': weights.tolist(),
+            'histogram': [x + y for x, y in zip(a['histogram'], b['histogram'])]}
+
+def sketch_quantile(sketch, q):
+    if not sketch or not sketch.get('count'):
+        return None
+    weights = np.asarray(sketch['weights'], dtype=np.float64)
+    mids = (np.cumsum(weights) - weights / 2) / weights.sum()
+    return float(np.interp(q, np.r_[0.0, mids, 1.0], np.r_[sketch['min'], sketch['means'], sketch['max']]))
+
+def build_dataset_sketches(frame):
+    values = {metric: pd.to_numeric(frame[metric], errors='coerce') for metric in SKETCH_METRICS if metric in frame.columns}
+    if 'Airtime_Hours' in values and 'Arrival_GMT' in frame.columns and 'Departure_GMT' in frame.columns:
+        # Rows whose times failed to parse carry a placeholder 0.00 airtime; keep them out of the distribution.
+        timed = (frame['Arrival_GMT'] != "") & (frame['Departure_GMT'] != "")
+        values['Airtime_Hours'] = values['Airtime_Hours'].where(timed)
+    sketches = {}
+    for dimension, column in SKETCH_DIMENSIONS.items():
+        if column is not None and column not in frame.columns:
+            continue
+        keys = frame[column].fillna('Unknown').astype(str) if column else pd.Series('All', index=frame.index)
+        sketches[dimension] = {}
+        for metric, series in values.items():
+            sketches[dimension][metric] = {str(group): build_metric_sketch(metric, group_values.to_numpy())
+                                          for group, group_values in series.groupby(keys, sort=False)}
+    return sketches
+
+def merge_dataset_sketches(target, source):
+    for dimension, metrics in source.items():
+        for metric, groups in metrics.items():
+            merged = target.setdefault(dimension, {}).setdefault(metric, {})
+            for group, sketch in groups.items():
+                merged[group] = merge_metric_sketch(merged.get(group), sketch)
+    return target
+
+def save_dataset_sketches(doc_id, sketches):
+    sketch_collection = db.collection("analysis_results").document(doc_id).collection("sketches")
+    for dimension, metrics in sketches.items():
+        for metric, groups in metrics.items():
+            @firestore_retry()
+            def set_sketch_doc():
+                sketch_collection.document(f"{dimension}__{metric}").set({
+                    'dimension': dimension, 'metric': metric, 'edges': HISTOGRAM_EDGES[metric],
+                    'compression': DIGEST_COMPRESSION, 'groups': groups
+                })
+            set_sketch_doc()
+
+def load_dataset_sketch(doc_id, dimension, metric):
+    doc = db.collection("analysis_results").document(doc_id).collection("sketches").document(f"{dimension}__{metric}").get()
+    return doc.to_dict().get('groups', {}) if doc.exists else None
+
+def describe_sketch(sketch, metric, percentiles, include_histogram=False):
+    description = {f"p{p:g}": sketch_quantile(sketch, p / 100) for p in percentiles}
+    if include_histogram:
+        description['histogram'] = {'edges': HISTOGRAM_EDGES[metric], 'counts': sketch.get('histogram', []) if sketch else []}
+    return description
+
+# Mergeable cardinality (HyperLogLog) and heavy-hitter (top-k) summaries. Registers are stored as raw
+# bytes and merged with an element-wise max, so distinct counts are estimates (about 1.6% standard error).
+# A top-k summary is each sheet's exact value counts truncated to the TOPK_CAPACITY largest; merging sums
+# the counts and truncates again. 'error' accumulates the largest count dropped by every truncation, so it
+# bounds both how far a listed count may be low and the count of any value missing from the list.
+HLL_PRECISION = 12
+HLL_REGISTERS = 1 << HLL_PRECISION
+TOPK_CAPACITY = 100
+DISTINCT_FIELDS = ['operators', 'registrations', 'aircraft_types', 'routes']
+HEAVY_HITTER_FIELDS = ['operators', 'airports']
+
+def stable_hash64(value):
+    return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+def build_hll(values):
+    registers = np.zeros(HLL_REGISTERS, dtype=np.uint8)
+    uniques = pd.unique(pd.Series(values).dropna().astype(str))
+    if len(uniques) == 0:
+        return registers
+    index = np.empty(len(uniques), dtype=np.int64)
+    rank = np.empty(len(uniques), dtype=np.uint8)
+    tail_bits = 64 - HLL_PRECISION
+    for i, value in enumerate(uniques):
+        hashed = stable_hash64(value)
+        index[i] = hashed >> tail_bits
+        rank[i] = tail_bits - (hashed & ((1 << tail_bits) - 1)).bit_length() + 1
+    np.maximum.at(registers, index, rank)
+    return registers
+
+def hll_from_bytes(raw):
+    return np.frombuffer(raw, dtype=np.uint8).copy() if raw else np.zeros(HLL_REGISTERS, dtype=np.uint8)
+
+def merge_hll(a, b):
+    return np.maximum(a, b)
+
+def hll_estimate(registers):
+    m = float(HLL_REGISTERS)
+    estimate = (0.7213 / (1 + 1.079 / m)) * m * m / np.sum(np.power(2.0, -registers.astype(np.float64)))
+    zeros = int(np.count_nonzero(registers == 0))
+    if estimate <= 2.5 * m and zeros:
+        estimate = m * np.log(m / zeros)
+    return int(round(estimate))
+
+def build_heavy_hitters(values):
+    counts = pd.Series(values).dropna().astype(str).value_counts()
+    kept = counts.iloc[:TOPK_CAPACITY]
+    return {'items': kept.index.tolist(), 'counts': [int(c) for c in kept.tolist()],
+            'error': int(counts.iloc[TOPK_CAPACITY]) if len(counts) > TOPK_CAPACITY else 0}
+
+def merge_heavy_hitters(a, b):
+    if not a:
+        return b
+    if not b:
+        return a
+    combined = {}
+    for summary in (a, b):
+        for item, count in zip(summary['items'], summary['counts']):
+            combined[item] = combined.get(item, 0) + count
+    ranked = sorted(combined.items(), key=lambda pair: (-pair[1], pair[0]))
+    dropped = ranked[TOPK_CAPACITY][1] if len(ranked) > TOPK_CAPACITY else 0
+    ranked = ranked[:TOPK_CAPACITY]
+    return {'items': [item for item, _ in ranked], 'counts': [count for _, count in ranked],
+            'error': a.get('error', 0) + b.get('error', 0) + dropped}
+
+def build_distinct_sketches(frame):
+    def column(name):
+        return frame[name] if name in frame.columns else pd.Series(dtype=object)
+    routes = pd.concat([column('Dep_Location').astype(str) + '>' + column('Airport_Code').astype(str),
+                        column('Airport_Code').astype(str) + '>' + column('Dest_Location').astype(str)])
+    return {
+        'distinct': {
+            'operators': build_hll(column('Operator_Name')),
+            'registrations': build_hll(column('Reg_No')[column('Reg_No') != 'Unknown']),
+            'aircraft_types': build_hll(column('Aircraft_Type')),
+            'routes': build_hll(routes)
+        },
+        'heavy_hitters': {
+            'operators': build_heavy_hitters(column('Operator_Name')),
+            'airports': build_heavy_hitters(column('Airport_Name'))
+        }
+    }
+
+def merge_distinct_sketches(target, source):
+    for field, registers in source.get('distinct', {}).items():
+        current = target.setdefault('distinct', {}).get(field)
+        target['distinct'][field] = registers if current is None else merge_hll(current, registers)
+    for field, summary in source.get('heavy_hitters', {}).items():
+        hitters = target.setdefault('heavy_hitters', {})
+        hitters[field] = merge_heavy_hitters(hitters.get(field), summary)
+    return target
+
+def serialize_distinct_sketches(sketches):
+    return {
+        'distinct_sketches': {field: registers.tobytes() for field, registers in sketches.get('distinct', {}).items()},
+        'heavy_hitters': sketches.get('heavy_hitters', {})
+    }
+
+def deserialize_distinct_sketches(data):
+    return {
+        'distinct': {field: hll_from_bytes(raw) for field, raw in (data.get('distinct_sketches') or {}).items()},
+        'heavy_hitters': data.get('heavy_hitters') or {}
+    }
+
+def distinct_stats(sketches, top_n=10):
+    stats = {f"approx_unique_{field}": hll_estimate(registers) for field, registers in sketches.get('distinct', {}).items()}
+    approximate = list(stats)
+    for field, summary in sketches.get('heavy_hitters', {}).items():
+        stats[f"top_{field}"] = [{'name': item, 'count': count} for item, count in zip(summary['items'][:top_n], summary['counts'][:top_n])]
+        stats[f"top_{field}_error"] = summary.get('error', 0)
+        if stats[f"top_{field}_error"]:
+            approximate.append(f"top_{field}")
+    stats['approximate_fields'] = approximate
+    return stats
+
+# Traffic cubes: per airport, movement counts and charges by IST day x hour-of-day. Each airport is one
+# document holding its sorted day list plus flat day-major arrays of len(days) * 24 per measure (Firestore
+# has no nested arrays); the 'ALL' document sums every airport so the default view is a single read.
+CUBE_MEASURES = ['arrivals', 'departures', 'landing_charges', 'udf_charges']
+CUBE_ALL_AIRPORTS = 'ALL'
+
+def cube_slots(frame, local_column, airport_codes):
+    local_times = pd.to_datetime(resolve_column(frame, local_column, ''), errors='coerce', utc=True).dt.tz_convert('Asia/Kolkata')
+    valid = local_times.notna()
+    return pd.DataFrame({
+        'airport': airport_codes[valid],
+        'day': local_times[valid].dt.strftime('%Y-%m-%d'),
+        'hour': local_times[valid].dt.hour
+    }), valid
+
+def build_traffic_cube(frame):
+    airport_codes = resolve_column(frame, 'Airport_Code', '').fillna('').astype(str).str.strip().str.upper().replace('', 'UNKNOWN')
+    arrivals, arr_valid = cube_slots(frame, 'Arr_Local', airport_codes)
+    arrivals['arrivals'] = 1
+    arrivals['landing_charges'] = pd.to_numeric(resolve_column(frame, 'Landing'), errors='coerce').fillna(0.0)[arr_valid]
+    departures, dep_valid = cube_slots(frame, 'Dep_Local', airport_codes)
+    departures['departures'] = 1
+    departures['udf_charges'] = pd.to_numeric(resolve_column(frame, 'UDF_Charge'), errors='coerce').fillna(0.0)[dep_valid]
+    slots = pd.concat([arrivals, departures], ignore_index=True).fillna(0)
+    if slots.empty:
+        return {}
+    slots = slots.groupby(['airport', 'day', 'hour'], sort=True)[CUBE_MEASURES].sum().reset_index()
+
+    cube = {}
+    for airport, rows in itertools.chain(slots.groupby('airport'), [(CUBE_ALL_AIRPORTS, slots)]):
+        days = sorted(rows['day'].unique())
+        position = rows['day'].map({day: i for i, day in enumerate(days)}).to_numpy() * 24 + rows['hour'].to_numpy()
+        entry = {'days': days}
+        for measure in CUBE_MEASURES:
+            values = np.zeros(len(days) * 24)
+            np.add.at(values, position, rows[measure].to_numpy(dtype=float))
+            entry[measure] = values.tolist()
+        cube[airport] = entry
+    return cube
+
+def merge_traffic_cube_entry(target, source):
+    if target is None:
+        return {'days': list(source['days']), **{measure: list(source[measure]) for measure in CUBE_MEASURES}}
+    days = sorted(set(target['days']) | set(source['days']))
+    index = {day: i for i, day in enumerate(days)}
+    merged = {'days': days}
+    for measure in CUBE_MEASURES:
+        values = np.zeros(len(days) * 24)
+        for entry in (target, source):
+            offsets = np.repeat([index[day] * 24 for day in entry['days']], 24) + np.tile(np.arange(24), len(entry['days']))
+            np.add.at(values, offsets, np.asarray(entry[measure], dtype=float))
+        merged[measure] = values.tolist()
+    return merged
+
+def merge_traffic_cubes(target, source):
+    for airport, entry in source.items():
+        target[airport] = merge_traffic_cube_entry(target.get(airport), entry)
+    return target
+
+def cube_doc_id(airport):
+    return re.sub(r'[^A-Za-z0-9_-]', '_', airport) or 'UNKNOWN'
+
+def save_traffic_cube(doc_id, cube):
+    cube_collection = db.collection("analysis_results").document(doc_id).collection("cubes")
+    written = set()
+    for airport, entry in cube.items():
+        @firestore_retry()
+        def set_cube_doc():
+            cube_collection.document(cube_doc_id(airport)).set({'airport': airport, **entry})
+        set_cube_doc()
+        written.add(cube_doc_id(airport))
+    for reference in cube_collection.list_documents():
+        if reference.id not in written:
+            reference.delete()
+
+def load_traffic_cube(doc_id, airport=CUBE_ALL_AIRPORTS):
+    doc = db.collection("analysis_results").document(doc_id).collection("cubes").document(cube_doc_id(airport)).get()
+    return doc.to_dict() if doc.exists else None
+
+def slice_traffic_cube(entry, measure, start=None, end=None):
+    values = np.add(entry['arrivals'], entry['departures']).tolist() if measure == 'movements' else entry[measure]
+    days = [(i, day) for i, day in enumerate(entry['days']) if (not start or day >= start) and (not end or day <= end)]
+    return [(day, values[i * 24:(i + 1) * 24]) for i, day in days]
+
+# Origin-destination routes. Every movement row contributes an inbound leg (Dep_Location -> Airport_Code,
+# Arr_GCD, landing charge) and an outbound leg (Airport_Code -> Dest_Location, Dep_GCD, UDF). Codes are
+# factorized to integers so pairs aggregate in one groupby; the result is kept as a sparse pair map, and
+# stored as parallel coordinate arrays in the 'routes' subcollection.
+ROUTE_LEGS = [
+    ('Dep_Location', 'Airport_Code', 'Arr_GCD', 'Landing'),
+    ('Airport_Code', 'Dest_Location', 'Dep_GCD', 'UDF_Charge'),
+]
+ROUTE_SORT_KEYS = {'movements': 0, 'distance': 1, 'charges': 2}
+
+def build_route_matrix(frame):
+    operators = resolve_column(frame, 'Operator_Name', 'Unknown').fillna('Unknown').astype(str)
+    legs = pd.concat([
+        pd.DataFrame({
+            'origin': normalize_location_codes(resolve_column(frame, origin_col, '')),
+            'dest': normalize_location_codes(resolve_column(frame, dest_col, '')),
+            'operator': operators,
+            'distance': pd.to_numeric(resolve_column(frame, distance_col), errors='coerce').fillna(0.0),
+            'charges': pd.to_numeric(resolve_column(frame, charge_col), errors='coerce').fillna(0.0)
+        })
+        for origin_col, dest_col, distance_col, charge_col in ROUTE_LEGS
+    ], ignore_index=True).dropna(subset=['origin', 'dest'])
+    matrix = {'pairs': {}, 'operators': {}}
+    if legs.empty:
+        return matrix
+
+    codes, airports = pd.factorize(pd.concat([legs['origin'], legs['dest']], ignore_index=True))
+    size = len(airports)
+    legs['pair'] = codes[:len(legs)] * size + codes[len(legs):]
+    pairs = legs.groupby('pair').agg(movements=('pair', 'size'), distance=('distance', 'sum'), charges=('charges', 'sum'))
+    for pair, movements, distance, charges in pairs.itertuples():
+        matrix['pairs'][(airports[pair // size], airports[pair % size])] = [int(movements), float(distance), float(charges)]
+    by_operator = legs.groupby(['operator', 'pair']).agg(movements=('pair', 'size'), charges=('charges', 'sum'))
+    for (operator, pair), movements, charges in by_operator.itertuples():
+        matrix['operators'][(operator, airports[pair // size], airports[pair % size])] = [int(movements), float(charges)]
+    return matrix
+
+def merge_route_matrices(target, source):
+    for section in ('pairs', 'operators'):
+        merged = target.setdefault(section, {})
+        for key, values in source.get(section, {}).items():
+            current = merged.get(key)
+            merged[key] = list(values) if current is None else [a + b for a, b in zip(current, values)]
+    return target
+
+def encode_route_matrix(matrix):
+    airports = sorted({code for origin, dest in matrix['pairs'] for code in (origin, dest)})
+    index = {code: i for i, code in enumerate(airports)}
+    operators = sorted({operator for operator, _, _ in matrix['operators']})
+    operator_index = {operator: i for i, operator in enumerate(operators)}
+    pairs = sorted(matrix['pairs'].items())
+    routes = sorted(matrix['operators'].items())
+    return {
+        'matrix': {
+            'airports': airports,
+            'origin': [index[origin] for (origin, _), _ in pairs],
+            'dest': [index[dest] for (_, dest), _ in pairs],
+            'movements': [values[0] for _, values in pairs],
+            'distance': [values[1] for _, values in pairs],
+            'charges': [values[2] for _, values in pairs]
+        },
+        'operators': {
+            'airports': airports,
+            'operators': operators,
+            'operator': [operator_index[operator] for (operator, _, _), _ in routes],
+            'origin': [index[origin] for (_, origin, _), _ in routes],
+            'dest': [index[dest] for (_, _, dest), _ in routes],
+            'movements': [values[0] for _, values in routes],
+            'charges': [values[1] for _, values in routes]
+        }
+    }
+
+def decode_route_matrix(docs):
+    matrix = {'pairs': {}, 'operators': {}}
+    pairs = docs.get('matrix') or {}
+    airports = pairs.get('airports', [])
+    for origin, dest, movements, distance, charges in zip(pairs.get('origin', []), pairs.get('dest', []), pairs.get('movements', []), pairs.get('distance', []), pairs.get('charges', [])):
+        matrix['pairs'][(airports[origin], airports[dest])] = [movements, distance, charges]
+    routes = docs.get('operators') or {}
+    airports = routes.get('airports', [])
+    operators = routes.get('operators', [])
+    for operator, origin, dest, movements, charges in zip(routes.get('operator', []), routes.get('origin', []), routes.get('dest', []), routes.get('movements', []), routes.get('charges', [])):
+        matrix['operators'][(operators[operator], airports[origin], airports[dest])] = [movements, charges]
+    return matrix
+
+def save_route_matrix(doc_id, matrix):
+    route_collection = db.collection("analysis_results").document(doc_id).collection("routes")
+    for name, payload in encode_route_matrix(matrix).items():
+        @firestore_retry()
+        def set_route_doc():
+            route_collection.document(name).set(payload)
+        set_route_doc()
+
+def load_route_matrix(doc_id):
+    route_collection = db.collection("analysis_results").document(doc_id).collection("routes")
+    docs = {name: route_collection.document(name).get() for name in ('matrix', 'operators')}
+    if not docs['matrix'].exists:
+        return None
+    return decode_route_matrix({name: doc.to_dict() for name, doc in docs.items() if doc.exists})
+
+def route_entry(origin, dest, movements, distance, charges):
+    return {
+        'Origin': origin, 'Destination': dest, 'Movements': movements,
+        'Total_Distance': round(distance, 2), 'Avg_Distance': round(distance / movements, 2) if movements else 0.0,
+        'Charges': round(charges, 2)
+    }
+
+def airport_route_totals(matrix):
+    totals = {}
+    for (origin, dest), (movements, distance, charges) in matrix['pairs'].items():
+        for airport, direction in ((origin, 'Outbound'), (dest, 'Inbound')):
+            entry = totals.setdefault(airport, {'Airport_Code': airport, 'Inbound_Movements': 0, 'Outbound_Movements': 0,
+                                                'Inbound_Distance': 0.0, 'Outbound_Distance': 0.0, 'Inbound_Charges': 0.0, 'Outbound_Charges': 0.0})
+            entry[f'{direction}_Movements'] += movements
+            entry[f'{direction}_Distance'] += distance
+            entry[f'{direction}_Charges'] += charges
+    return totals
+
+# Streaming column summaries, one accumulator per column, rendered in describe()'s {column: {stat: value}} layout.
+# Numeric columns keep count, mean, the sum of squared deviations (m2), min, max and a quantile digest; blocks are
+# folded in with Chan's parallel update and the digests merged, so sheets and files combine without revisiting rows.
+# count/mean/std/min/max are exact; the 25/50/75% quartiles are interpolated from the digest. Other (text) columns
+# keep count, a HyperLogLog for 'unique' (exact within a sheet, an estimate once merged) and a top-k summary for
+# 'top'/'freq'. A column that is numeric in one sheet and text in another keeps only its numeric accumulator.
+SUMMARY_STATS = ['count', 'unique', 'top', 'freq', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+
+def new_numeric_summary():
+    return {'kind': 'numeric', 'count': 0, 'mean': 0.0, 'm2': 0.0, 'min': None, 'max': None, 'means': [], 'weights': []}
+
+def new_object_summary():
+    return {'kind': 'object', 'count': 0, 'unique': None, 'distinct': None, 'top': None}
+
+def merge_numeric_summary(target, source):
+    if not source['count']:
+        return target
+    if not target['count']:
+        target.update(source)
+        return target
+    count = target['count'] + source['count']
+    delta = source['mean'] - target['mean']
+    target['mean'] += delta * source['count'] / count
+    target['m2'] += source['m2'] + delta * delta * target['count'] * source['count'] / count
+    target['count'] = count
+    target['min'] = min(target['min'], source['min'])
+    target['max'] = max(target['max'], source['max'])
+    means, weights = compress_centroids(np.asarray(target['means'] + source['means'], dtype=np.float64),
+                                        np.asarray(target['weights'] + source['weights'], dtype=np.float64))
+    target['means'], target['weights'] = means.tolist(), weights.tolist()
+    return target
+
+def merge_object_summary(target, source):
+    # The exact distinct count only survives a single block; merged columns fall back to the HyperLogLog.
+    target['unique'] = source['unique'] if not target['count'] else (target['unique'] if not source['count'] else None)
+    target['count'] += source['count']
+    if source['distinct'] is not None:
+        target['distinct'] = source['distinct'] if target['distinct'] is None else merge_hll(target['distinct'], source['distinct'])
+    target['top'] = merge_heavy_hitters(target['top'], source['top'])
+    return target
+
+def merge_column_summary(summaries, col, source):
+    target = summaries.get(col)
+    if target is None or (target['kind'] == 'object' and source['kind'] == 'numeric'):
+        summaries[col] = target = new_numeric_summary() if source['kind'] == 'numeric' else new_object_summary()
+    if target['kind'] != source['kind']:
+        return target
+    return merge_numeric_summary(target, source) if target['kind'] == 'numeric' else merge_object_summary(target, source)
+
+def update_numeric_summaries(summaries, frame):
+    for col in frame.select_dtypes(include='number').columns:
+        values = frame[col].to_numpy(dtype=float)
+        values = values[~np.isnan(values)]
+        block = new_numeric_summary()
+        if values.size:
+            mean = float(values.mean())
+            means, weights = compress_centroids(values, np.ones(values.size))
+            block.update(count=int(values.size), mean=mean, m2=float(((values - mean) ** 2).sum()),
+                         min=float(values.min()), max=float(values.max()), means=means.tolist(), weights=weights.tolist())
+        merge_column_summary(summaries, col, block)
+    for col in frame.select_dtypes(exclude=['number', 'datetime', 'datetimetz', 'timedelta']).columns:
+        values = frame[col].dropna()
+        block = new_object_summary()
+        if len(values):
+            block.update(count=int(len(values)), unique=int(values.astype(str).nunique()), distinct=build_hll(values),
+                         top=build_heavy_hitters(values))
+        merge_column_summary(summaries, col, block)
+    return summaries
+
+def merge_numeric_summaries(target, source):
+    for col, summary in source.items():
+        merge_column_summary(target, col, dict(summary))
+    return target
+
+def finalize_column_summary(summary):
+    stats = dict.fromkeys(SUMMARY_STATS, '')
+    stats['count'] = float(summary['count'])
+    if summary['kind'] == 'object':
+        if summary['count']:
+            stats['unique'] = summary['unique'] if summary['unique'] is not None else hll_estimate(summary['distinct'])
+            stats['top'] = summary['top']['items'][0]
+            stats['freq'] = summary['top']['counts'][0]
+        return stats
+    if summary['count']:
+        stats.update({'mean': summary['mean'], 'min': summary['min'], 'max': summary['max'],
+                      '25%': sketch_quantile(summary, 0.25), '50%': sketch_quantile(summary, 0.5), '75%': sketch_quantile(summary, 0.75)})
+    if summary['count'] > 1:
+        stats['std'] = (summary['m2'] / (summary['count'] - 1)) ** 0.5
+    return stats
+
+def finalize_numeric_summary(summaries):
+    return {col: finalize_column_summary(summary) for col, summary in summaries.items()}
+
+# Row ids are content addressed: a hash of the fields that identify a movement (or a base operator), so the
+# same row gets the same id in every upload regardless of its position. Exact repeats get an occurrence suffix.
+MOVEMENT_ID_COLUMNS = ['Reg_No', 'Airport_Code', 'Arr_Datetime_GMT', 'Dep_Datetime_GMT', 'Arr_Flight_No', 'Dep_Flight_No']
+
+def row_id_component(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return ''
+    return str(value).strip().upper()
+
+def suffix_duplicate_ids(ids):
+    ids = pd.Series(ids, dtype=object)
+    occurrence = ids.groupby(ids).cumcount()
+    return ids.where(occurrence == 0, ids + '_' + occurrence.astype(str)).tolist()
+
+def hashed_row_ids(frame, columns, prefix):
+    parts = [frame[col].map(row_id_component) if col in frame.columns else pd.Series('', index=frame.index) for col in columns]
+    keys = parts[0].str.cat(parts[1:], sep='\x1f') if len(parts) > 1 else parts[0]
+    return suffix_duplicate_ids([f"{prefix}{hashlib.blake2b(key.encode('utf-8'), digest_size=8).hexdigest()}" for key in keys])
+
+# Billing audit rules. Each rule is a conjunction ('all') and optional disjunction ('any') of named
+# predicates; every predicate is a whole-column boolean mask computed at most once per sheet, so adding
+# a rule that reuses existing predicates costs one extra mask AND rather than another pass over rows.
+AUDIT_PAX_COLUMNS = ['OLD_IN_PAX', 'OLD_US_PAX', 'NEW_IN_PAX', 'NEW_US_PAX']
+AUDIT_ROW_ID_CHUNK = 5000
+
+def audit_unbilled(frame, column):
+    return resolve_column(frame, column, '').fillna('').astype(str).str.strip().str.lower() != 'billed'
+
+def audit_rcs(frame, column):
+    return resolve_column(frame, column, '').fillna('').astype(str).str.strip().str.upper() == 'RCS'
+
+AUDIT_PREDICATES = {
+    'landing_charged': lambda frame: resolve_column(frame, 'Landing') > 0,
+    'parking_charged': lambda frame: resolve_column(frame, 'Parking') > 0,
+    'udf_charged': lambda frame: resolve_column(frame, 'UDF_Charge') > 0,
+    'landing_free': lambda frame: resolve_column(frame, 'Landing') <= 0,
+    'arr_unbilled': lambda frame: audit_unbilled(frame, 'Arr_Bill_Status'),
+    'dep_unbilled': lambda frame: audit_unbilled(frame, 'Dep_Bill_Status'),
+    'udf_unbilled': lambda frame: audit_unbilled(frame, 'UDF_Bill_Status'),
+    'heavy_aircraft': lambda frame: resolve_column(frame, 'Max_Allup_Wt') >= app.config['AUDIT_HEAVY_AIRCRAFT_WT'],
+    'no_pax': lambda frame: sum(resolve_column(frame, col) for col in AUDIT_PAX_COLUMNS) <= 0,
+    'rcs_flight': lambda frame: audit_rcs(frame, 'Arr_RCS_Status') | audit_rcs(frame, 'Dep_RCS_Status'),
+}
+
+AUDIT_RULES = [
+    {'id': 'landing_charged_unbilled', 'description': 'Landing charge levied but arrival leg not billed', 'all': ['landing_charged', 'arr_unbilled']},
+    {'id': 'parking_charged_unbilled', 'description': 'Parking charge levied but departure leg not billed', 'all': ['parking_charged', 'dep_unbilled']},
+    {'id': 'udf_charged_unbilled', 'description': 'UDF levied but not billed', 'all': ['udf_charged', 'udf_unbilled']},
+    {'id': 'heavy_aircraft_no_landing', 'description': 'Heavy aircraft movement with zero landing charge', 'all': ['heavy_aircraft', 'landing_free']},
+    {'id': 'udf_without_pax', 'description': 'UDF levied on a movement with no passengers', 'all': ['udf_charged', 'no_pax']},
+    {'id': 'rcs_flight_charged', 'description': 'RCS flight carrying landing or parking charges', 'all': ['rcs_flight'], 'any': ['landing_charged', 'parking_charged']},
+]
+
+def evaluate_audit_rules(frame, row_ids, rules=AUDIT_RULES):
+    masks = {}
+    def mask(name):
+        if name not in masks:
+            masks[name] = AUDIT_PREDICATES[name](frame).to_numpy(dtype=bool)
+        return masks[name]
+
+    ids = np.asarray(row_ids, dtype=object)
+    audit = {'counts': {}, 'row_ids': {}}
+    for rule in rules:
+        hits = np.ones(len(frame), dtype=bool)
+        for name in rule.get('all', []):
+            hits &= mask(name)
+        if rule.get('any'):
+            hits &= np.logical_or.reduce([mask(name) for name in rule['any']])
+        audit['counts'][rule['id']] = int(hits.sum())
+        audit['row_ids'][rule['id']] = ids[hits].tolist()
+    return audit
+
+def merge_audit_results(target, source, prefix=''):
+    counts = target.setdefault('counts', {})
+    for rule_id, count in source.get('counts', {}).items():
+        counts[rule_id] = counts.get(rule_id, 0) + count
+    for rule_id, row_ids in source.get('row_ids', {}).items():
+        target.setdefault('row_ids', {}).setdefault(rule_id, []).extend(f"{prefix}{row_id}" for row_id in row_ids)
+    return target
+
+def audit_summary(audit):
+    counts = audit.get('counts', {})
+    return {
+        'rules': [{'id': rule['id'], 'description': rule['description'], 'count': counts.get(rule['id'], 0)} for rule in AUDIT_RULES],
+        'total_violations': sum(counts.values()),
+        'heavy_aircraft_wt': app.config['AUDIT_HEAVY_AIRCRAFT_WT']
+    }
+
+def save_audit_results(doc_id, audit):
+    audit_collection = db.collection("analysis_results").document(doc_id).collection("audit")
+    written = set()
+    for rule_id, row_ids in audit.get('row_ids', {}).items():
+        for i in range(0, len(row_ids), AUDIT_ROW_ID_CHUNK):
+            audit_doc_id = f"{rule_id}__{i // AUDIT_ROW_ID_CHUNK}"
+            @firestore_retry()
+            def set_audit_chunk():
+                audit_collection.document(audit_doc_id).set({
+                    'rule': rule_id, 'chunk': i // AUDIT_ROW_ID_CHUNK, 'row_ids': row_ids[i:i + AUDIT_ROW_ID_CHUNK]
+                })
+            set_audit_chunk()
+            written.add(audit_doc_id)
+    # A batch rewritten in place may have had more violations before; drop the chunks no longer in use.
+    for reference in audit_collection.list_documents():
+        if reference.id not in written:
+            reference.delete()
+
+def load_audit_row_ids(doc_id, rule_id):
+    chunks = db.collection("analysis_results").document(doc_id).collection("audit").where(
+        filter=firestore.FieldFilter('rule', '==', rule_id)).stream()
+    row_ids = []
+    for chunk in sorted((doc.to_dict() for doc in chunks), key=lambda chunk: chunk.get('chunk', 0)):
+        row_ids.extend(chunk.get('row_ids', []))
+    return row_ids
+
 def determine_billing_status(row, charge_col, bill_status_col):
     charge = float(row.get(charge_col, 0.0))
     return 'billed' if charge > 0 else row.get(bill_status_col, 'unbilled')
 
-def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
+def process_excel_file(file, file_type='departure', filename="upload.xlsx", reuse_doc_ids=None):
+    # reuse_doc_ids maps sheet -> existing doc id (an in-place batch re-upload); those docs only get the changed chunks.
     try:
         stream = io.BytesIO(file.read())
         if stream.read(1) == b'':
@@ -175,67 +1182,28 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
             return {"error": "Empty file stream"}
         stream.seek(0)
 
+        file_format = detect_upload_format(stream)
         try:
-            excel = pd.ExcelFile(stream, engine='openpyxl')
+            sheet_names = list_upload_sheets(stream, file_format, filename)
         except Exception as e:
-            logger.error(f"Failed to read Excel file {filename}: {e} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
-            return {"error": f"Failed to read Excel file: {str(e)}"}
+            logger.error(f"Failed to read {file_format} file {filename}: {e} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            return {"error": f"Failed to read {'Excel' if file_format in ('xlsx', 'xls') else file_format.upper()} file: {str(e)}"}
 
         result = {}
-        for sheet in excel.sheet_names:
-            logger.info(f"Processing sheet: {sheet} in {filename} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
-            stream.seek(0)
-            
-            # --- START AGGRESSIVE HEADER FIX ---
-            
-            if file_type == 'departure':
-                # 1. Define the EXPECTED column names explicitly (using the normalized names)
-                # This list MUST match the columns in your file, in order, after normalization.
-                departure_normalized_columns = [
-                    'SL_No', 'Airport_Code', 'Airport_Name', 'Region', 'Profit_Center', 'Operator_Name',
-                    'CA12_No', 'Reg_No', 'Max_Allup_Wt', 'Seating_Capacity', 'Helicopter',
-                    'Aircraft_Type', 'Arr_Date', 'Arr_GMT', 'Arr_Flight_No', 'Dep_Location', 
-                    'Arr_Nature', 'Arr_GCD', 'Arr_Sch', 'Arr_RCS_Status', 'Arr_RCS_Category',
-                    'Dep_Date', 'Dep_GMT', 'Dep_Flight_No', 'Dest_Location', 'Dep_Nature', 
-                    'Dep_GCD', 'Dep_Sch', 'Dep_RCS_Status', 'Dep_RCS_Category', 'Credit_Facility',
-                    'Operator_Type', 'Landing', 'Parking', 'Open_Parking', 'Housing', 'RNFC', 
-                    'TNLC', 'Arr_Watch', 'Dep_Watch', 'Counter', 'XRay', 'UDF_Charge', 
-                    'OLD_IN_PAX', 'OLD_US_PAX', 'NEW_IN_PAX', 'NEW_US_PAX', 'OLD_IN_RATE',
-                    'OLD_US_RATE', 'NEW_IN_RATE', 'NEW_US_RATE', 'Unique_Id', 'Arr_Bill_Status',
-                    'Dep_Bill_Status', 'UDF_Bill_Status'
-                ]
-
-                # 2. Skip the first 3 rows: 2 metadata rows + 1 actual header row.
-                # This ensures the DataFrame starts directly at the DATA.
-                skip_rows = 3 
-                
-                # Load the DataFrame with NO HEADER, starting from the first data row
-                df = pd.read_excel(stream, sheet_name=sheet, skiprows=skip_rows, header=None, engine='openpyxl')
-                
-                # 3. Rename columns using the pre-defined list. This guarantees the 'Operator_Name' exists.
-                if len(df.columns) >= len(departure_normalized_columns):
-                    df = df.iloc[:, :len(departure_normalized_columns)] # Trim excess columns
-                    df.columns = departure_normalized_columns
-                else:
-                    # Fallback error if the data rows don't even have enough columns
-                    logger.error("Data columns count is less than expected departure columns. Cannot force headers.")
-                    result[sheet] = {"error": f"File structure error: Expected {len(departure_normalized_columns)} columns, found only {len(df.columns)} after skipping {skip_rows} rows."}
-                    return result
-
-                logger.debug(f"Applied aggressive header fix: skiprows={skip_rows}. Columns forced.")
-                
-            else: # file_type == 'base' (Header is at row 1, index 0)
-                # Use default behavior (header=0) and then normalize names.
-                df = pd.read_excel(stream, sheet_name=sheet, header=0, engine='openpyxl')
-                df.columns = [normalize_column_name(col) for col in df.columns]
-                logger.debug(f"Loaded base file with header=0 and applied normalization.")
+        for sheet in sheet_names:
+            logger.info(f"Processing sheet: {sheet} in {filename} ({file_format}) at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            # Every format is loaded into the same normalized columns, so everything below is format-agnostic.
+            try:
+                df = load_upload_sheet(stream, file_format, sheet, file_type)
+            except ValueError as e:
+                logger.error(f"Could not load sheet {sheet} from {filename}: {e} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+                result[sheet] = {"error": str(e)}
+                return result
 
             # Logging for validation
             logger.info(f"Raw DataFrame shape for {sheet}: {df.shape} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
             logger.info(f"Normalized columns in {sheet}: {list(df.columns)} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
 
-            # --- END AGGRESSIVE HEADER FIX ---
-
             if df.empty or df.columns.empty:
                 logger.warning(f"Sheet {sheet} is empty or has no columns in {filename} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
                 result[sheet] = {"error": "Empty sheet or no columns detected"}
@@ -255,7 +1223,10 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
                 df['Reg_No'] = 'Unknown'
 
             df = clean_out_of_range(df)
+            # Resolve operator spellings over the distinct values only; rows then just look up the result.
+            df['Operator_Name'] = canonicalize_operator_column(df['Operator_Name'])
             processed_data = []
+            audit = {}
             if file_type == 'departure':
                 date_columns = ['Arr_Date', 'Dep_Date']
                 for col in date_columns:
@@ -269,17 +1240,21 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
 
                 df['Arr_Datetime_GMT'] = df.apply(lambda row: parse_excel_serial_date(row.get('Arr_Date'), row.get('Arr_GMT')), axis=1)
                 df['Dep_Datetime_GMT'] = df.apply(lambda row: parse_excel_serial_date(row.get('Dep_Date'), row.get('Dep_GMT')), axis=1)
+                df['Unique_Id'] = hashed_row_ids(df, MOVEMENT_ID_COLUMNS, 'FLIGHT_')
 
                 numeric_columns = [
                     'Max_Allup_Wt', 'Seating_Capacity', 'Landing', 'Parking', 'Open_Parking',
                     'Housing', 'RNFC', 'TNLC', 'Arr_Watch', 'Dep_Watch', 'Counter', 'XRay',
                     'UDF_Charge', 'OLD_IN_PAX', 'OLD_US_PAX', 'NEW_IN_PAX', 'NEW_US_PAX',
-                    'OLD_IN_RATE', 'OLD_US_RATE', 'NEW_IN_RATE', 'NEW_US_RATE'
+                    'OLD_IN_RATE', 'OLD_US_RATE', 'NEW_IN_RATE', 'NEW_US_RATE', 'Arr_GCD', 'Dep_GCD'
                 ]
                 for col in numeric_columns:
                     if col in df.columns:
                         df[col] = pd.to_numeric(df[col], errors='coerce').fillna(0.0)
 
+                # Audit against the bill statuses as uploaded, before charges are allowed to override them.
+                audit = evaluate_audit_rules(df, df['Unique_Id'].tolist())
+
                 df['UDF_Bill_Status'] = df.apply(lambda row: determine_billing_status(row, 'UDF_Charge', 'UDF_Bill_Status'), axis=1)
                 df['Arr_Bill_Status'] = df.apply(lambda row: determine_billing_status(row, 'Landing', 'Arr_Bill_Status'), axis=1)
                 df['Dep_Bill_Status'] = df.apply(lambda row: determine_billing_status(row, 'Parking', 'Dep_Bill_Status'), axis=1)
@@ -322,21 +1297,26 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
                     logger.debug(f"Row {index} in {sheet} - Raw Region: '{raw_region}', Processed: '{region}' at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
 
                     processed_row = {
-                        'Unique_Id': f"FLIGHT_{index}_{current_date.strftime('%Y%m%d%H%M%S')}",
+                        'Unique_Id': row['Unique_Id'],
                         'Arrival_GMT': arr_gmt.isoformat() if arr_gmt else "",
                         'Departure_GMT': dep_gmt.isoformat() if dep_gmt else "",
                         'Dep_Location': str(row.get('Dep_Location', '')),
                         'Dest_Location': str(row.get('Dest_Location', '')),
+                        'Airport_Code': str(row.get('Airport_Code', '')),
                         'Airport_Name': str(row.get('Airport_Name', '')),
                         'Operator_Name': operator_name,
                         'Region': region,
                         'Aircraft_Type': str(row.get('Aircraft_Type', '') or 'Unknown'),
                         'Reg_No': reg_no,
+                        'Arr_Flight_No': str(row.get('Arr_Flight_No', '')) if pd.notna(row.get('Arr_Flight_No')) else "",
+                        'Dep_Flight_No': str(row.get('Dep_Flight_No', '')) if pd.notna(row.get('Dep_Flight_No')) else "",
                         'Airtime_Hours': f"{airtime_hours:.2f}",
                         'Airtime_Color': airtime_color,
                         'Dep_Local': dep_local.isoformat() if dep_local else "",
                         'Arr_Local': arr_local.isoformat() if arr_local else "",
                         'Linkage_Status': linkage_status,
+                        'Arr_GCD': float(row.get('Arr_GCD', 0.0)),
+                        'Dep_GCD': float(row.get('Dep_GCD', 0.0)),
                         'Landing': float(row.get('Landing', 0.0)),
                         'Parking': float(row.get('Parking', 0.0)),
                         'Open_Parking': float(row.get('Open_Parking', 0.0)),
@@ -363,17 +1343,14 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
                     }
                     processed_data.append(processed_row)
             else:  # file_type == 'base'
-                for index, row in df.iterrows():
-                    processed_row = {
-                        'Unique_Id': f"BASE_{index}_{current_date.strftime('%Y%m%d%H%M%S')}",
-                        'Operator_Name': str(row.get('Operator_Name', 'Unknown')),
-                        'Assessment': float(row.get('Assessment', 0.0)),
-                        'Realisation': float(row.get('Realisation', 0.0)),
-                        'Closing_Balance': float(row.get('Closing_Balance', 0.0)),
-                        'Fleet_Count': float(row.get('Fleet_Count', 0.0)),
-                        'file_type': file_type
-                    }
-                    processed_data.append(processed_row)
+                base_frame = pd.DataFrame({
+                    'Unique_Id': hashed_row_ids(df, ['Operator_Name'], 'BASE_'),
+                    'Operator_Name': df['Operator_Name'].astype(str)
+                })
+                for col in BASE_NUMERIC_COLUMNS:
+                    base_frame[col] = df[col].astype(float) if col in df.columns else 0.0
+                base_frame['file_type'] = file_type
+                processed_data = base_frame.to_dict(orient='records')
 
             uploaded_data = pd.DataFrame(processed_data)
             if uploaded_data.empty or uploaded_data.columns.empty:
@@ -450,7 +1427,9 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
                 else:
                     logger.warning(f"No valid data for pie chart in {sheet} - Fleet_Count counts empty after filtering at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
 
-            doc_id = f"analysis_{file_type}_{sheet}_{current_date.strftime('%Y%m%d%H%M%S')}"
+            # The random suffix keeps ids unique across sheets and across concurrent uploads within the same second.
+            doc_id = (reuse_doc_ids or {}).get(sheet) or f"analysis_{file_type}_{sheet}_{ist_now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+            previous_chunks = [reference.id for reference in list_chunk_references(doc_id)] if (reuse_doc_ids or {}).get(sheet) else None
             data_dict = uploaded_data.to_dict(orient='records')
             for record in data_dict:
                 for key, value in record.items():
@@ -460,10 +1439,10 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
                         record[key] = ""
                     elif pd.isna(value):
                         record[key] = ""
+            data_dict.sort(key=row_sort_key)
 
-            max_chunk_size = 900000
-            chunk_size = 500
-            data_chunks = [data_dict[i:i + chunk_size] for i in range(0, len(data_dict), chunk_size)]
+            distinct_sketches = build_distinct_sketches(uploaded_data) if file_type == 'departure' else {}
+            numeric_summaries = update_numeric_summaries({}, uploaded_data)
 
             main_doc = {
                 'sheet_name': sheet,
@@ -494,26 +1473,40 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
                     'total_realisation': float(uploaded_data['Realisation'].sum()) if file_type == 'base' and 'Realisation' in uploaded_data.columns else 0.0,
                     'total_closing_balance': float(uploaded_data['Closing_Balance'].sum()) if file_type == 'base' and 'Closing_Balance' in uploaded_data.columns else 0.0
                 },
-                'summary': uploaded_data.describe(exclude=['datetime64[ns, UTC]']).fillna('').to_dict() if not uploaded_data.empty else {},
+                'summary': finalize_numeric_summary(numeric_summaries),
                 'chart_bar': chart_base64_bar,
                 'chart_pie': chart_base64_pie,
                 'formal_summary': f"The analysis of '{sheet}' shows {len(uploaded_data)} records for {file_type} data, with {uploaded_data['Operator_Name'].nunique()} operators." if not uploaded_data.empty else "No data processed",
                 'timestamp': firestore.SERVER_TIMESTAMP,
                 'total_records': len(uploaded_data)
             }
+            if distinct_sketches:
+                main_doc['stats'].update(distinct_stats(distinct_sketches))
+                main_doc.update(serialize_distinct_sketches(distinct_sketches))
+            if audit:
+                main_doc['audit'] = audit_summary(audit)
+            chunk_plan = write_doc_chunks(doc_id, data_dict, previous_chunks)
+            main_doc['chunks'] = chunk_plan['chunks']
             @firestore_retry()
             def set_main_doc():
                 db.collection("analysis_results").document(doc_id).set(main_doc)
                 logger.info(f"Successfully saved main document {doc_id} to Firestore at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
             set_main_doc()
-
-            for i, chunk in enumerate(data_chunks):
-                sub_doc_id = f"data_chunk_{i}"
-                @firestore_retry()
-                def set_data_chunk():
-                    db.collection("analysis_results").document(doc_id).collection("data").document(sub_doc_id).set({'records': chunk})
-                    logger.info(f"Successfully saved data chunk {sub_doc_id} for {doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
-                set_data_chunk()
+            delete_doc_chunks(doc_id, chunk_plan['stale_chunks'])
+            if not snapshot_matches(open_doc_snapshot(doc_id), chunk_plan['chunks']):
+                write_doc_snapshot(doc_id, data_dict, chunk_plan['chunks'])
+            if audit:
+                save_audit_results(doc_id, audit)
+
+            sketches = build_dataset_sketches(uploaded_data) if file_type == 'departure' else {}
+            if sketches:
+                save_dataset_sketches(doc_id, sketches)
+            traffic_cube = build_traffic_cube(uploaded_data) if file_type == 'departure' else {}
+            if traffic_cube:
+                save_traffic_cube(doc_id, traffic_cube)
+            route_matrix = build_route_matrix(uploaded_data) if file_type == 'departure' else {}
+            if route_matrix:
+                save_route_matrix(doc_id, route_matrix)
 
             result[sheet] = {
                 'sheet_name': sheet,
@@ -524,7 +1517,12 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
                 'chart_bar': chart_base64_bar,
                 'chart_pie': chart_base64_pie,
                 'formal_summary': main_doc['formal_summary'],
-                'doc_id': doc_id
+                'doc_id': doc_id,
+                'audit': main_doc.get('audit', {}),
+                # Internal mergeable summaries and the typed rows for the /upload batch; popped before any response is sent.
+                '_aggregates': {'sketches': sketches, 'distinct': distinct_sketches, 'audit': audit, 'summary': numeric_summaries, 'cube': traffic_cube, 'routes': route_matrix,
+                                'partial': build_partial_aggregate(uploaded_data) if file_type == 'departure' else {}, 'records': data_dict,
+                                'writes': doc_write_stats(chunk_plan, [main_doc, sketches, audit, traffic_cube, encode_route_matrix(route_matrix) if route_matrix else {}])}
             }
 
         return result
@@ -538,7 +1536,834 @@ def process_excel_file(file, file_type='departure', filename="upload.xlsx"):
                 buf.close()
         plt.close('all')
 
+# Columnar on-disk snapshots of processed docs. Written once at upload, then memory-mapped read-only,
+# so every gunicorn worker on the host shares one page-cache copy instead of holding its own rows.
+# Layout: SNAPSHOT_DIR/<doc_id>/manifest.json + part_<n>/c<i>.npy (+ c<i>.json dictionary for categories).
+# The manifest records the content-hashed chunk ids the snapshot was built from; readers compare them with the
+# main doc's 'chunks' before trusting it, so a doc re-uploaded in place through another host is never served stale.
+# Columns are typed like the Firestore chunks they mirror: numbers stay numbers, blanks stay "", and
+# anything mixed round-trips through JSON, so a doc reads the same whichever path serves it.
+SNAPSHOT_BLOCK_ROWS = 2048
+SNAPSHOT_DICTIONARY_MAX_RATIO = 0.5
+# Every mapped column holds a file descriptor, so the reader cache is an LRU bounded by mapped files;
+# columns are mapped lazily, only when a reader asks for them.
+SNAPSHOT_CACHE_MAX_FILES = int(os.getenv('SNAPSHOT_CACHE_MAX_FILES', '256'))
+SNAPSHOT_RETENTION_DAYS = float(os.getenv('SNAPSHOT_RETENTION_DAYS', '30'))
+SNAPSHOT_MAX_BYTES = int(float(os.getenv('SNAPSHOT_MAX_GB', '20')) * 1024 ** 3)
+SNAPSHOT_PRUNE_INTERVAL_SECONDS = 600
+_snapshot_cache = collections.OrderedDict()
+_snapshot_lock = threading.Lock()
+_snapshot_last_prune = 0.0
+
+def snapshot_path(doc_id):
+    return os.path.join(app.config['SNAPSHOT_DIR'], secure_filename(doc_id))
+
+def is_blank(value):
+    return isinstance(value, str) and value == ""
+
+def snapshot_column_kind(values):
+    present = [v for v in values if not is_blank(v)]
+    if any(v is None or isinstance(v, (bool, np.bool_)) for v in present):
+        return 'json'
+    if all(isinstance(v, (int, np.integer)) for v in present) and present:
+        return 'int'
+    if all(isinstance(v, (float, np.floating)) for v in present) and present:
+        return 'float'
+    if all(isinstance(v, str) for v in values):
+        return 'text'
+    return 'json'
+
+class SnapshotWriter:
+    def __init__(self, doc_id):
+        self.doc_id = doc_id
+        self.tmp_dir = f"{snapshot_path(doc_id)}.tmp-{os.getpid()}-{threading.get_ident()}"
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        os.makedirs(self.tmp_dir)
+        self.parts = []
+        self.columns = []
+
+    def add_part(self, records):
+        if not records:
+            return
+        part_name = f"part_{len(self.parts)}"
+        part_dir = os.path.join(self.tmp_dir, part_name)
+        os.makedirs(part_dir)
+        columns = {}
+        for record in records:
+            for key in record:
+                columns.setdefault(key, None)
+        part_columns = {}
+        for col in columns:
+            values = [record.get(col, "") for record in records]
+            file_name = f"c{len(part_columns)}"
+            kind = snapshot_column_kind(values)
+            if kind in ('int', 'float'):
+                # Blanks are stored as NaN and read back as ""; ints only widen to float when blanks force it.
+                blanks = any(is_blank(v) for v in values)
+                dtype = np.float64 if kind == 'float' or blanks else np.int64
+                np.save(os.path.join(part_dir, f"{file_name}.npy"), np.asarray([np.nan if is_blank(v) else v for v in values], dtype=dtype))
+                part_columns[col] = {'kind': kind, 'file': file_name}
+                continue
+            if kind == 'json':
+                values = [json.dumps(v, default=str) for v in values]
+            categories = pd.unique(np.asarray(values, dtype=object))
+            if len(categories) <= max(1, len(values) * SNAPSHOT_DICTIONARY_MAX_RATIO):
+                codes = pd.Index(categories).get_indexer(values).astype(np.int32)
+                np.save(os.path.join(part_dir, f"{file_name}.npy"), codes)
+                with open(os.path.join(part_dir, f"{file_name}.json"), 'w', encoding='utf-8') as handle:
+                    json.dump(categories.tolist(), handle)
+                part_columns[col] = {'kind': 'category', 'file': file_name, 'json': kind == 'json'}
+            else:
+                encoded = [v.encode('utf-8') for v in values]
+                np.save(os.path.join(part_dir, f"{file_name}.npy"), np.asarray(encoded, dtype=f"S{max(1, max(len(v) for v in encoded))}"))
+                part_columns[col] = {'kind': 'bytes', 'file': file_name, 'json': kind == 'json'}
+        for col in part_columns:
+            if col not in self.columns:
+                self.columns.append(col)
+        self.parts.append({'name': part_name, 'rows': len(records), 'columns': part_columns})
+
+    def commit(self, chunk_ids):
+        manifest = {'doc_id': self.doc_id, 'chunks': list(chunk_ids), 'columns': self.columns, 'parts': self.parts,
+                    'rows': sum(part['rows'] for part in self.parts), 'version': f"{time.time():.6f}-{os.getpid()}"}
+        with open(os.path.join(self.tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as handle:
+            json.dump(manifest, handle)
+        final_dir = snapshot_path(self.doc_id)
+        stale_dir = f"{final_dir}.stale-{os.getpid()}-{threading.get_ident()}"
+        if os.path.exists(final_dir):
+            os.replace(final_dir, stale_dir)
+        os.replace(self.tmp_dir, final_dir)
+        shutil.rmtree(stale_dir, ignore_errors=True)
+        logger.info(f"Snapshot written for {self.doc_id}: {manifest['rows']} rows in {len(self.parts)} part(s) at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        prune_snapshots()
+
+    def abort(self):
+        # The doc is being rewritten, so an older snapshot of it would now serve stale rows: drop it too.
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        delete_doc_snapshot(self.doc_id)
+
+def write_doc_snapshot(doc_id, records, chunk_ids):
+    if not app.config['SNAPSHOTS_ENABLED']:
+        return
+    writer = None
+    try:
+        writer = SnapshotWriter(doc_id)
+        writer.add_part(records)
+        writer.commit(chunk_ids)
+    except Exception as e:
+        if writer:
+            writer.abort()
+        else:
+            delete_doc_snapshot(doc_id)
+        logger.warning(f"Failed to write snapshot for {doc_id}, readers will fall back to Firestore: {e} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+
+def delete_doc_snapshot(doc_id):
+    final_dir = snapshot_path(doc_id)
+    stale_dir = f"{final_dir}.stale-{os.getpid()}-{threading.get_ident()}"
+    try:
+        os.replace(final_dir, stale_dir)
+    except OSError:
+        return
+    shutil.rmtree(stale_dir, ignore_errors=True)
+    with _snapshot_lock:
+        _snapshot_cache.pop(doc_id, None)
+
+def snapshot_dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+def prune_snapshots(force=False):
+    # Snapshots are a cache of Firestore, so anything older than SNAPSHOT_RETENTION_DAYS goes, then the oldest
+    # go until the directory fits SNAPSHOT_MAX_GB. Readers of a pruned doc fall back to Firestore; memory maps
+    # already open stay valid after the files are unlinked. Runs at most every few minutes per process.
+    global _snapshot_last_prune
+    now = time.time()
+    with _snapshot_lock:
+        if not force and now - _snapshot_last_prune < SNAPSHOT_PRUNE_INTERVAL_SECONDS:
+            return
+        _snapshot_last_prune = now
+    root = app.config['SNAPSHOT_DIR']
+    try:
+        entries = list(os.scandir(root))
+    except OSError:
+        return
+    snapshots = []
+    for entry in entries:
+        if not entry.is_dir():
+            continue
+        try:
+            modified = entry.stat().st_mtime
+        except OSError:
+            continue
+        if '.tmp-' in entry.name or '.stale-' in entry.name:
+            # Leftovers of a crashed writer; live writers finish well within an hour.
+            if now - modified > 3600:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+        if now - modified > SNAPSHOT_RETENTION_DAYS * 86400:
+            delete_doc_snapshot(entry.name)
+            continue
+        snapshots.append((modified, entry.name, snapshot_dir_size(entry.path)))
+    total = sum(size for _, _, size in snapshots)
+    for _, name, size in sorted(snapshots):
+        if total <= SNAPSHOT_MAX_BYTES:
+            break
+        delete_doc_snapshot(name)
+        total -= size
+
+def trim_snapshot_cache():
+    # Caller holds _snapshot_lock. Evicted entries just lose their references; any reader still iterating
+    # one keeps its arrays alive, and the mappings (and fds) are released when it finishes.
+    while len(_snapshot_cache) > 1 and sum(entry['mapped'] for entry in _snapshot_cache.values()) > SNAPSHOT_CACHE_MAX_FILES:
+        _snapshot_cache.popitem(last=False)
+
+def open_doc_snapshot(doc_id):
+    if not app.config['SNAPSHOTS_ENABLED']:
+        return None
+    manifest_path = os.path.join(snapshot_path(doc_id), 'manifest.json')
+    try:
+        mtime = os.stat(manifest_path).st_mtime_ns
+    except OSError:
+        with _snapshot_lock:
+            _snapshot_cache.pop(doc_id, None)
+        return None
+    with _snapshot_lock:
+        cached = _snapshot_cache.get(doc_id)
+        if cached and cached['mtime'] == mtime:
+            _snapshot_cache.move_to_end(doc_id)
+            return cached
+        try:
+            with open(manifest_path, encoding='utf-8') as handle:
+                manifest = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        parts = [{'rows': part['rows'], 'dir': os.path.join(snapshot_path(doc_id), part['name']), 'columns': part['columns'], 'arrays': {}}
+                 for part in manifest['parts']]
+        cached = {'mtime': mtime, 'manifest': manifest, 'parts': parts, 'mapped': 0}
+        _snapshot_cache[doc_id] = cached
+        trim_snapshot_cache()
+        return cached
+
+def snapshot_matches(snapshot, chunk_ids):
+    return bool(snapshot and chunk_ids and snapshot['manifest'].get('chunks') == list(chunk_ids))
+
+def snapshot_column(snapshot, part, col):
+    with _snapshot_lock:
+        loaded = part['arrays'].get(col)
+        if loaded is None:
+            spec = part['columns'][col]
+            array = np.load(os.path.join(part['dir'], f"{spec['file']}.npy"), mmap_mode='r')
+            categories = None
+            if spec['kind'] == 'category':
+                with open(os.path.join(part['dir'], f"{spec['file']}.json"), encoding='utf-8') as handle:
+                    categories = json.load(handle)
+                if spec.get('json'):
+                    categories = [json.loads(value) for value in categories]
+            loaded = part['arrays'][col] = (spec['kind'], array, categories, spec.get('json', False))
+            snapshot['mapped'] += 1
+            trim_snapshot_cache()
+        return loaded
+
+def decode_snapshot_block(kind, block, categories, is_json):
+    if kind == 'int':
+        values = block.tolist()
+        return values if block.dtype.kind == 'i' else ["" if v != v else int(v) for v in values]
+    if kind == 'float':
+        return ["" if v != v else v for v in block.tolist()]
+    if kind == 'category':
+        return [categories[code] for code in block.tolist()]
+    decoded = [value.decode('utf-8') for value in block.tolist()]
+    return [json.loads(value) for value in decoded] if is_json else decoded
+
+def iter_snapshot_records(snapshot, fields=None):
+    for part in snapshot['parts']:
+        columns = [col for col in (fields or part['columns']) if col in part['columns']]
+        arrays = [snapshot_column(snapshot, part, col) for col in columns]
+        for start in range(0, part['rows'], SNAPSHOT_BLOCK_ROWS):
+            stop = min(start + SNAPSHOT_BLOCK_ROWS, part['rows'])
+            decoded = [decode_snapshot_block(kind, array[start:stop], categories, is_json) for kind, array, categories, is_json in arrays]
+            for values in zip(*decoded):
+                yield dict(zip(columns, values))
+
+# Chunk documents are stored column-wise ({'cols': {field: [values]}, 'count': n}) so a reader can ask
+# Firestore for just the fields it needs; legacy chunks holding a 'records' list are still decoded.
+def encode_chunk(records, digests=None):
+    names = list(dict.fromkeys(name for record in records for name in record))
+    chunk = {'cols': {name: [record.get(name, "") for record in records] for name in names}, 'count': len(records)}
+    if digests is not None:
+        chunk['digests'] = digests
+    return chunk
+
+def decode_chunk(data, fields=None):
+    if 'cols' in data:
+        columns = data['cols']
+        names = [name for name in (fields or columns) if name in columns]
+        return [dict(zip(names, values)) for values in zip(*(columns[name] for name in names))] if names else [{} for _ in range(data.get('count', 0))]
+    records = data.get('records', [])
+    if fields:
+        return [{name: record[name] for name in fields if name in record} for record in records]
+    return records
+
+def chunk_sort_key(reference):
+    suffix = reference.id.rsplit('_', 1)[-1]
+    return (0, int(suffix), reference.id) if suffix.isdigit() else (1, 0, reference.id)
+
+def chunk_field_paths(fields):
+    if not fields:
+        return None
+    return [FieldPath('cols', name).to_api_repr() for name in fields] + ['count', 'records']
+
+# Rows are written sorted by Unique_Id and cut where the id hash hits CHUNK_BOUNDARY_MODULUS (or at
+# CHUNK_MAX_ROWS), and each chunk is named after a hash of its contents. Editing a few rows therefore
+# only changes the chunks that hold them, and a re-upload can skip every chunk that already exists.
+CHUNK_MAX_ROWS = 500
+CHUNK_BOUNDARY_MODULUS = 256
+
+def row_sort_key(record):
+    return str(record.get('Unique_Id', ''))
+
+def row_digest(record):
+    return hashlib.blake2b(json.dumps(record, sort_keys=True, default=str).encode('utf-8'), digest_size=8).hexdigest()
+
+def content_defined_chunks(records):
+    chunks = []
+    current = []
+    for record in records:
+        current.append(record)
+        if len(current) >= CHUNK_MAX_ROWS or stable_hash64(row_sort_key(record)) % CHUNK_BOUNDARY_MODULUS == 0:
+            chunks.append(current)
+            current = []
+    if current:
+        chunks.append(current)
+    return chunks
+
+def write_doc_chunks(doc_id, records, previous_chunks=None, plan=None):
+    # Passing the plan from a previous call appends to the same document, so a batch can be written one file at a time.
+    collection = db.collection("analysis_results").document(doc_id).collection("data")
+    existing = set(previous_chunks or [])
+    if plan is None:
+        plan = {'chunks': [], 'digests': {}, 'chunks_written': 0, 'rows_written': 0, 'bytes_written': 0, 'bytes_total': 0}
+    for chunk in content_defined_chunks(records):
+        digests = [row_digest(record) for record in chunk]
+        ids = [row_sort_key(record) for record in chunk]
+        plan['digests'].update(zip(ids, digests))
+        chunk_id = f"data_chunk_{hashlib.blake2b('|'.join(ids + digests).encode('utf-8'), digest_size=10).hexdigest()}"
+        plan['chunks'].append(chunk_id)
+        payload = encode_chunk(chunk, digests)
+        size = len(json.dumps(payload, default=str))
+        plan['bytes_total'] += size
+        if chunk_id in existing:
+            continue
+
+        @firestore_retry()
+        def set_data_chunk():
+            collection.document(chunk_id).set(payload)
+        set_data_chunk()
+        plan['chunks_written'] += 1
+        plan['rows_written'] += len(chunk)
+        plan['bytes_written'] += size
+    current = set(plan['chunks'])
+    plan['stale_chunks'] = [chunk_id for chunk_id in (previous_chunks or []) if chunk_id not in current]
+    logger.info(f"Wrote {plan['chunks_written']}/{len(plan['chunks'])} chunk(s) ({plan['rows_written']} rows) for {doc_id} at {ist_now().strftime('%Y-%m-%d %H:%M:%S IST')}")
+    return plan
+
+def delete_documents(references):
+    for start in range(0, len(references), 400):
+        batch = db.batch()
+        for reference in references[start:start + 400]:
+            batch.delete(reference)
+
+        @firestore_retry()
+        def commit_deletes():
+            batch.commit()
+        commit_deletes()
+
+def delete_doc_chunks(doc_id, chunk_ids):
+    collection = db.collection("analysis_results").document(doc_id).collection("data")
+    delete_documents([collection.document(chunk_id) for chunk_id in chunk_ids])
+
+# Every subcollection an analysis doc can own; deleting a doc removes all of them and its local snapshot.
+ANALYSIS_SUBCOLLECTIONS = ['data', 'sketches', 'audit', 'cubes', 'routes']
+
+def delete_analysis_doc(doc_id):
+    doc_ref = db.collection("analysis_results").document(doc_id)
+    for name in ANALYSIS_SUBCOLLECTIONS:
+        delete_documents(list(doc_ref.collection(name).list_documents()))
+    delete_documents([doc_ref])
+    delete_doc_snapshot(doc_id)
+    logger.info(f"Deleted analysis doc {doc_id} and its subcollections at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+
+def doc_write_stats(plan, full_writes=()):
+    # Chunks are written only when new; the main doc and its derived docs (sketches, audit, cube, routes)
+    # are rewritten in full every time, so their size counts as written and as total.
+    full_bytes = sum(len(json.dumps(payload, default=str)) for payload in full_writes if payload)
+    return {
+        'chunks_total': len(plan['chunks']),
+        'chunks_written': plan['chunks_written'],
+        'chunks_deleted': len(plan['stale_chunks']),
+        'rows_written': plan['rows_written'],
+        'bytes_written': plan['bytes_written'] + full_bytes,
+        'bytes_total': plan['bytes_total'] + full_bytes
+    }
+
+def merge_write_stats(target, source):
+    for key, value in source.items():
+        target[key] = target.get(key, 0) + value
+    return target
+
+def load_chunk_ids(doc_id):
+    manifest = db.collection("analysis_results").document(doc_id).get(field_paths=['chunks'])
+    return (manifest.to_dict() or {}).get('chunks') if manifest.exists else None
+
+def list_chunk_references(doc_id, chunk_ids=None):
+    doc_ref = db.collection("analysis_results").document(doc_id)
+    if chunk_ids is None:
+        chunk_ids = load_chunk_ids(doc_id)
+    if chunk_ids:
+        return [doc_ref.collection("data").document(chunk_id) for chunk_id in chunk_ids]
+    return sorted(doc_ref.collection("data").list_documents(), key=chunk_sort_key)
+
+def load_row_digests(doc_id, chunk_ids):
+    collection = db.collection("analysis_results").document(doc_id).collection("data")
+
+    def fetch_digests(chunk_id):
+        data = collection.document(chunk_id).get(field_paths=['cols.Unique_Id', 'digests', 'records']).to_dict() or {}
+        ids = data.get('cols', {}).get('Unique_Id') or [record.get('Unique_Id', '') for record in data.get('records', [])]
+        return zip(ids, data.get('digests') or [None] * len(ids))
+
+    digests = {}
+    with ThreadPoolExecutor(max_workers=max(1, min(app.config['FETCH_WORKERS'], len(chunk_ids)))) as executor:
+        for pairs in executor.map(fetch_digests, chunk_ids):
+            digests.update(pairs)
+    return digests
+
+def diff_row_digests(previous, current):
+    added = current.keys() - previous.keys()
+    removed = previous.keys() - current.keys()
+    changed = [row_id for row_id in current.keys() & previous.keys() if current[row_id] != previous[row_id]]
+    return {
+        'rows_added': len(added),
+        'rows_changed': len(changed),
+        'rows_removed': len(removed),
+        'rows_unchanged': len(current) - len(added) - len(changed)
+    }
+
+def iter_chunk_records(doc_id, fields=None, chunk_ids=None):
+    references = list_chunk_references(doc_id, chunk_ids)
+    if not references:
+        return
+    field_paths = chunk_field_paths(fields)
+
+    @firestore_retry()
+    def fetch_chunk(reference):
+        snapshot = reference.get(field_paths=field_paths)
+        return decode_chunk(snapshot.to_dict() or {}, fields) if snapshot.exists else []
+
+    # Sliding window: at most FETCH_WORKERS chunks are in flight, and rows are yielded in chunk order
+    # as soon as the head of the window lands, so the first rows arrive regardless of batch size.
+    window = max(1, min(app.config['FETCH_WORKERS'], len(references)))
+    executor = ThreadPoolExecutor(max_workers=window)
+    pending = collections.deque()
+    try:
+        remaining = iter(references)
+        for reference in itertools.islice(remaining, window):
+            pending.append(executor.submit(fetch_chunk, reference))
+        while pending:
+            rows = pending.popleft().result()
+            reference = next(remaining, None)
+            if reference is not None:
+                pending.append(executor.submit(fetch_chunk, reference))
+            yield from rows
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+def iter_doc_records(doc_id, fields=None):
+    snapshot = open_doc_snapshot(doc_id)
+    if snapshot is None:
+        yield from iter_chunk_records(doc_id, fields)
+        return
+    chunk_ids = load_chunk_ids(doc_id)
+    if snapshot_matches(snapshot, chunk_ids):
+        yield from iter_snapshot_records(snapshot, fields)
+        return
+    # The doc was rewritten (or deleted) since this host built its snapshot: drop it and read Firestore.
+    logger.info(f"Snapshot for {doc_id} is stale, reading from Firestore at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+    delete_doc_snapshot(doc_id)
+    yield from iter_chunk_records(doc_id, fields, chunk_ids)
+
+def peek_records(records):
+    first = next(records, None)
+    if first is None:
+        return None
+    return itertools.chain([first], records)
+
+# Aircraft rotation / linkage chains: every movement row is an arrival at Airport_Code
+# (coming from Dep_Location) followed by a departure to Dest_Location. Consecutive rows of
+# the same Reg_No must therefore chain Dest_Location -> next Airport_Code.
+LINKAGE_COLUMNS = [
+    'Unique_Id', 'Reg_No', 'Operator_Name', 'Airport_Code', 'Airport_Name',
+    'Dep_Location', 'Dest_Location', 'Arrival_GMT', 'Departure_GMT'
+]
+LINKAGE_ISSUE_TYPES = ['missing_leg', 'routing_mismatch', 'overlap']
+MISSING_LOCATION_VALUES = {'', 'NAN', 'NONE', 'N/A', 'NA', 'UNKNOWN', 'NULL'}
+
+def normalize_location_codes(series):
+    codes = series.fillna('').astype(str).str.strip().str.upper()
+    return codes.where(~codes.isin(MISSING_LOCATION_VALUES))
+
+def build_linkage_chains(records):
+    frame = pd.DataFrame.from_records(records)
+    for col in LINKAGE_COLUMNS:
+        if col not in frame.columns:
+            frame[col] = ''
+    frame = frame[LINKAGE_COLUMNS].copy()
+    if frame.empty:
+        return frame
+
+    frame['Reg_No'] = frame['Reg_No'].fillna('').astype(str).str.strip().str.upper()
+    frame['Arr_Time'] = pd.to_datetime(frame['Arrival_GMT'], utc=True, errors='coerce')
+    frame['Dep_Time'] = pd.to_datetime(frame['Departure_GMT'], utc=True, errors='coerce')
+    frame['Event_Time'] = frame['Arr_Time'].fillna(frame['Dep_Time'])
+    for col in ['Airport_Code', 'Dep_Location', 'Dest_Location']:
+        frame[col] = normalize_location_codes(frame[col])
+
+    # Single O(n log n) sort; every chain check below is a vectorized comparison with the next row.
+    frame = frame[~frame['Reg_No'].isin(MISSING_LOCATION_VALUES)]
+    frame = frame.sort_values(['Reg_No', 'Event_Time'], kind='mergesort', na_position='last').reset_index(drop=True)
+    nxt = frame.shift(-1)
+    linked = frame['Reg_No'].eq(nxt['Reg_No'])
+
+    frame['Next_Unique_Id'] = nxt['Unique_Id'].where(linked)
+    frame['Next_Airport_Code'] = nxt['Airport_Code'].where(linked)
+    frame['Turnaround_Hours'] = (frame['Dep_Time'] - frame['Arr_Time']).dt.total_seconds() / 3600
+    frame['Transit_Hours'] = ((nxt['Arr_Time'] - frame['Dep_Time']).dt.total_seconds() / 3600).where(linked)
+    frame['missing_leg'] = linked & frame['Dest_Location'].notna() & nxt['Airport_Code'].notna() & frame['Dest_Location'].ne(nxt['Airport_Code'])
+    frame['routing_mismatch'] = linked & frame['Airport_Code'].notna() & nxt['Dep_Location'].notna() & frame['Airport_Code'].ne(nxt['Dep_Location'])
+    frame['overlap'] = linked & (nxt['Arr_Time'] < frame['Dep_Time']).fillna(False)
+    frame['Linked'] = linked
+    return frame
+
+def summarize_linkage_by_operator(chains):
+    if chains.empty:
+        return []
+    grouped = chains.groupby('Operator_Name', sort=True)
+    summary = pd.DataFrame({
+        'Aircraft_Count': grouped['Reg_No'].nunique(),
+        'Movement_Count': grouped.size(),
+        'Link_Count': grouped['Linked'].sum(),
+        'Missing_Leg_Count': grouped['missing_leg'].sum(),
+        'Routing_Mismatch_Count': grouped['routing_mismatch'].sum(),
+        'Overlap_Count': grouped['overlap'].sum(),
+        'Avg_Turnaround_Hours': grouped['Turnaround_Hours'].mean(),
+        'Avg_Transit_Hours': grouped['Transit_Hours'].mean()
+    }).reset_index()
+    summary = summary.astype(object).where(summary.notna(), None)
+    records = summary.to_dict(orient='records')
+    for record in records:
+        for key in ['Aircraft_Count', 'Movement_Count', 'Link_Count', 'Missing_Leg_Count', 'Routing_Mismatch_Count', 'Overlap_Count']:
+            record[key] = int(record[key])
+        for key in ['Avg_Turnaround_Hours', 'Avg_Transit_Hours']:
+            record[key] = round(float(record[key]), 2) if record[key] is not None else None
+    return records
+
+def linkage_leg_to_dict(leg):
+    return {
+        'Unique_Id': leg['Unique_Id'],
+        'Next_Unique_Id': leg['Next_Unique_Id'] if pd.notna(leg['Next_Unique_Id']) else None,
+        'Reg_No': leg['Reg_No'],
+        'Operator_Name': leg['Operator_Name'],
+        'Airport_Code': leg['Airport_Code'] if pd.notna(leg['Airport_Code']) else None,
+        'Dep_Location': leg['Dep_Location'] if pd.notna(leg['Dep_Location']) else None,
+        'Dest_Location': leg['Dest_Location'] if pd.notna(leg['Dest_Location']) else None,
+        'Next_Airport_Code': leg['Next_Airport_Code'] if pd.notna(leg['Next_Airport_Code']) else None,
+        'Arrival_GMT': leg['Arr_Time'].isoformat() if pd.notna(leg['Arr_Time']) else "",
+        'Departure_GMT': leg['Dep_Time'].isoformat() if pd.notna(leg['Dep_Time']) else "",
+        'Turnaround_Hours': round(float(leg['Turnaround_Hours']), 2) if pd.notna(leg['Turnaround_Hours']) else None,
+        'Transit_Hours': round(float(leg['Transit_Hours']), 2) if pd.notna(leg['Transit_Hours']) else None,
+        'Issues': [issue for issue in LINKAGE_ISSUE_TYPES if leg[issue]]
+    }
+
+# Cross-batch analytics: each batch is folded chunk by chunk into a small per-operator rollup,
+# so comparing many batches only ever holds one chunk per worker plus the rollups in memory.
+COMPARE_MODES = ['side_by_side', 'merged']
+COMPARE_COUNT_METRICS = ['Flight_Count', 'Arr_Billed_Count', 'Dep_Billed_Count', 'UDF_Billed_Count']
+COMPARE_SUM_METRICS = ['Total_Landing_Charges', 'Total_Parking_Charges', 'Total_UDF_Charges']
+# Batch ids are analysis_departure_<YYYYmmddHHMMSS>_<8 hex> (older batches have no suffix).
+BATCH_DOC_ID_PATTERN = re.compile(r'^analysis_departure_\d{14}(_[0-9a-f]{8})?$')
+
+def new_operator_rollup():
+    rollup = {metric: 0 for metric in COMPARE_COUNT_METRICS}
+    rollup.update({metric: 0.0 for metric in COMPARE_SUM_METRICS})
+    return rollup
+
+def merge_operator_rollups(target, source):
+    for operator_name, metrics in source.items():
+        merged = target.setdefault(operator_name, new_operator_rollup())
+        for metric in COMPARE_COUNT_METRICS + COMPARE_SUM_METRICS:
+            merged[metric] += metrics.get(metric, 0)
+    return target
+
+def total_operator_rollups(operators):
+    total = new_operator_rollup()
+    for metrics in operators.values():
+        for metric in COMPARE_COUNT_METRICS + COMPARE_SUM_METRICS:
+            total[metric] += metrics.get(metric, 0)
+    return total
+
+def finalize_rollup_metrics(metrics):
+    result = dict(metrics)
+    flights = result['Flight_Count']
+    result['Arr_Billing_Rate'] = round(result['Arr_Billed_Count'] / flights, 4) if flights else 0.0
+    result['UDF_Billing_Rate'] = round(result['UDF_Billed_Count'] / flights, 4) if flights else 0.0
+    return result
+
+# Per-file partial aggregates for the /upload batch. Every partial is plain counts and sums, so the
+# batch stats are the element-wise merge of one small partial per sheet instead of a pass over rows.
+PARTIAL_COUNT_STATS = {'arr_billed_count': 'Arr_Bill_Status', 'dep_billed_count': 'Dep_Bill_Status', 'udf_billed_count': 'UDF_Bill_Status'}
+PARTIAL_CHARGE_STATS = {
+    'total_landing_charges': 'Landing', 'total_parking_charges': 'Parking', 'total_open_parking_charges': 'Open_Parking',
+    'total_housing_charges': 'Housing', 'total_rnfc_charges': 'RNFC', 'total_tnlc_charges': 'TNLC',
+    'total_arr_watch_charges': 'Arr_Watch', 'total_dep_watch_charges': 'Dep_Watch', 'total_counter_charges': 'Counter',
+    'total_xray_charges': 'XRay', 'total_udf_charges': 'UDF_Charge'
+}
+
+def new_partial_aggregate():
+    partial = {'flights': 0, 'airtime_sum': 0.0, 'airtime_count': 0, 'operator_rollup': {}}
+    partial.update({stat: 0 for stat in PARTIAL_COUNT_STATS})
+    partial.update({stat: 0.0 for stat in PARTIAL_CHARGE_STATS})
+    return partial
+
+def build_partial_aggregate(frame):
+    partial = new_partial_aggregate()
+    partial['flights'] = len(frame)
+    if 'Airtime_Hours' in frame.columns:
+        airtime = pd.to_numeric(frame['Airtime_Hours'], errors='coerce').dropna()
+        partial['airtime_sum'] = float(airtime.sum())
+        partial['airtime_count'] = int(airtime.count())
+    billed = {stat: frame[col] == 'billed' if col in frame.columns else pd.Series(False, index=frame.index) for stat, col in PARTIAL_COUNT_STATS.items()}
+    charges = {stat: pd.to_numeric(frame[col], errors='coerce').fillna(0.0) if col in frame.columns else pd.Series(0.0, index=frame.index) for stat, col in PARTIAL_CHARGE_STATS.items()}
+    partial.update({stat: int(mask.sum()) for stat, mask in billed.items()})
+    partial.update({stat: float(values.sum()) for stat, values in charges.items()})
+    if 'Operator_Name' in frame.columns and not frame.empty:
+        operators = frame['Operator_Name'].map(lambda name: str(name).strip() if pd.notna(name) else '')
+        operators = operators.where(~operators.str.upper().isin(['', 'N/A']), 'Unknown')
+        grouped = pd.DataFrame({
+            'Flight_Count': 1,
+            'Arr_Billed_Count': billed['arr_billed_count'].astype(int),
+            'Dep_Billed_Count': billed['dep_billed_count'].astype(int),
+            'UDF_Billed_Count': billed['udf_billed_count'].astype(int),
+            'Total_Landing_Charges': charges['total_landing_charges'],
+            'Total_Parking_Charges': charges['total_parking_charges'],
+            'Total_UDF_Charges': charges['total_udf_charges']
+        }, index=frame.index).groupby(operators).sum()
+        partial['operator_rollup'] = {
+            str(operator_name): {metric: (int(value) if metric in COMPARE_COUNT_METRICS else float(value)) for metric, value in metrics.items()}
+            for operator_name, metrics in grouped.to_dict(orient='index').items()
+        }
+    return partial
+
+def merge_partial_aggregates(target, source):
+    for key, value in source.items():
+        if key == 'operator_rollup':
+            merge_operator_rollups(target.setdefault('operator_rollup', {}), value)
+        else:
+            target[key] = target.get(key, 0) + value
+    return target
+
+def partial_aggregate_stats(partial):
+    stats = {'total_flights': partial.get('flights', 0)}
+    stats['avg_airtime'] = partial['airtime_sum'] / partial['airtime_count'] if partial.get('airtime_count') else 0.0
+    stats.update({stat: partial.get(stat, 0) for stat in PARTIAL_COUNT_STATS})
+    stats.update({stat: partial.get(stat, 0.0) for stat in PARTIAL_CHARGE_STATS})
+    return stats
+
+ROLLUP_FIELDS = ['Operator_Name', 'file_type', 'Arr_Bill_Status', 'Dep_Bill_Status', 'UDF_Bill_Status', 'Landing', 'Parking', 'UDF_Charge']
+
+def rollup_doc_by_operator(doc_id):
+    # Batches written by /upload carry the merged per-file rollup; older documents are folded from their rows.
+    stored = db.collection("analysis_results").document(doc_id).get(field_paths=['operator_rollup'])
+    if stored.exists and (stored.to_dict() or {}).get('operator_rollup'):
+        return stored.to_dict()['operator_rollup']
+    operators = {}
+    found = False
+    for row in iter_doc_records(doc_id, ROLLUP_FIELDS):
+        found = True
+        if row.get('file_type', 'departure') != 'departure':
+            continue
+        raw_operator = row.get('Operator_Name')
+        operator_name = str(raw_operator).strip() if raw_operator and pd.notna(raw_operator) else 'Unknown'
+        if operator_name.upper() == 'N/A' or not operator_name:
+            operator_name = 'Unknown'
+        rollup = operators.setdefault(operator_name, new_operator_rollup())
+        rollup['Flight_Count'] += 1
+        rollup['Arr_Billed_Count'] += 1 if row.get('Arr_Bill_Status') == 'billed' else 0
+        rollup['Dep_Billed_Count'] += 1 if row.get('Dep_Bill_Status') == 'billed' else 0
+        rollup['UDF_Billed_Count'] += 1 if row.get('UDF_Bill_Status') == 'billed' else 0
+        rollup['Total_Landing_Charges'] += float(row.get('Landing', 0.0) or 0.0)
+        rollup['Total_Parking_Charges'] += float(row.get('Parking', 0.0) or 0.0)
+        rollup['Total_UDF_Charges'] += float(row.get('UDF_Charge', 0.0) or 0.0)
+    return operators if found else None
+
+def fetch_batch_rollups(doc_ids):
+    with ThreadPoolExecutor(max_workers=max(1, min(app.config['FETCH_WORKERS'], len(doc_ids)))) as executor:
+        return dict(zip(doc_ids, executor.map(rollup_doc_by_operator, doc_ids)))
+
+def load_distinct_sketches(doc_id):
+    doc = db.collection('analysis_results').document(doc_id).get(field_paths=['distinct_sketches', 'heavy_hitters'])
+    return deserialize_distinct_sketches(doc.to_dict() or {}) if doc.exists else {}
+
+def fetch_batch_distinct_sketches(doc_ids):
+    with ThreadPoolExecutor(max_workers=max(1, min(app.config['FETCH_WORKERS'], len(doc_ids)))) as executor:
+        return dict(zip(doc_ids, executor.map(load_distinct_sketches, doc_ids)))
+
+def list_batch_doc_ids(start_date, end_date):
+    collection = db.collection("analysis_results")
+    start_ref = collection.document(f"analysis_departure_{start_date.strftime('%Y%m%d')}000000")
+    end_ref = collection.document(f"analysis_departure_{end_date.strftime('%Y%m%d')}235959_ffffffff")
+    query = (collection
+             .where(filter=firestore.FieldFilter(FieldPath.document_id(), '>=', start_ref))
+             .where(filter=firestore.FieldFilter(FieldPath.document_id(), '<=', end_ref))
+             .select(['sheet_name']))
+    return [doc.id for doc in query.stream() if BATCH_DOC_ID_PATTERN.match(doc.id)]
+
+# Base (financial) <-> departure reconciliation. The base side is small (one row per customer),
+# so it is the build side of the hash table; departure chunks are streamed through as the probe side.
+JOIN_BASE_METRICS = ['Assessment', 'Realisation', 'Closing_Balance', 'Fleet_Count']
+JOIN_DEPARTURE_FIELDS = ['Operator_Name', 'file_type', 'Landing', 'UDF_Charge']
+
+def build_base_join_table(records):
+    table = {}
+    key_cache = {}
+    for row in records:
+        raw_name = row.get('Operator_Name')
+        key = key_cache.get(raw_name)
+        if key is None:
+            key = key_cache[raw_name] = operator_join_key(raw_name)
+        entry = table.setdefault(key, {'Base_Operator_Names': set(), **{metric: 0.0 for metric in JOIN_BASE_METRICS}})
+        entry['Base_Operator_Names'].add(str(raw_name))
+        for metric in JOIN_BASE_METRICS:
+            entry[metric] += float(row.get(metric, 0.0) or 0.0)
+    return table
+
+def probe_departure_join(records):
+    movements = {}
+    key_cache = {}
+    for row in records:
+        if row.get('file_type', 'departure') != 'departure':
+            continue
+        raw_name = row.get('Operator_Name')
+        key = key_cache.get(raw_name)
+        if key is None:
+            key = key_cache[raw_name] = operator_join_key(raw_name)
+        entry = movements.get(key)
+        if entry is None:
+            entry = movements[key] = {'Departure_Operator_Names': set(), 'Movement_Count': 0, 'Total_Landing_Charges': 0.0, 'Total_UDF_Charges': 0.0}
+        entry['Departure_Operator_Names'].add(str(raw_name))
+        entry['Movement_Count'] += 1
+        entry['Total_Landing_Charges'] += float(row.get('Landing', 0.0) or 0.0)
+        entry['Total_UDF_Charges'] += float(row.get('UDF_Charge', 0.0) or 0.0)
+    return movements
+
+def join_base_and_departure(base_table, movements, how='outer'):
+    if how == 'inner':
+        keys = base_table.keys() & movements.keys()
+    elif how == 'left':
+        keys = base_table.keys()
+    else:
+        keys = base_table.keys() | movements.keys()
+
+    joined = []
+    for key in sorted(keys):
+        base = base_table.get(key)
+        movement = movements.get(key)
+        assessment = base['Assessment'] if base else 0.0
+        computed_charges = (movement['Total_Landing_Charges'] + movement['Total_UDF_Charges']) if movement else 0.0
+        joined.append({
+            'Operator_Key': key,
+            'Match': 'matched' if base and movement else 'base_only' if base else 'departure_only',
+            'Base_Operator_Names': sorted(base['Base_Operator_Names']) if base else [],
+            'Departure_Operator_Names': sorted(movement['Departure_Operator_Names']) if movement else [],
+            'Movement_Count': movement['Movement_Count'] if movement else 0,
+            'Total_Landing_Charges': round(movement['Total_Landing_Charges'], 2) if movement else 0.0,
+            'Total_UDF_Charges': round(movement['Total_UDF_Charges'], 2) if movement else 0.0,
+            'Computed_Charges': round(computed_charges, 2),
+            **{metric: round(base[metric], 2) if base else 0.0 for metric in JOIN_BASE_METRICS},
+            'Realisation_Ratio': round(base['Realisation'] / assessment, 4) if base and assessment else None,
+            'Outstanding_Ratio': round(base['Closing_Balance'] / assessment, 4) if base and assessment else None,
+            'Computed_To_Assessed_Ratio': round(computed_charges / assessment, 4) if assessment else None
+        })
+    return joined
+
+def compute_metric_deltas(current, previous):
+    deltas = {}
+    for metric, value in current.items():
+        if metric not in previous:
+            continue
+        change = value - previous[metric]
+        deltas[metric] = {
+            'change': round(change, 4),
+            'change_pct': round(change / previous[metric] * 100, 2) if previous[metric] else None
+        }
+    return deltas
+
+# Opt-in request profiling. An admin sends "X-Profile: 1" (or ?profile=1) together with
+# "X-Admin-Token: <PROFILE_ADMIN_TOKEN>"; that one request runs under cProfile, the stats are saved to
+# PROFILE_DIR for download from /profiles/<id>, and the top functions by cumulative time are logged.
+# Other requests only pay for the flag lookup. Work done on ThreadPoolExecutor workers is not captured.
+PROFILE_ID_PATTERN = re.compile(r'^[a-z_]+_\d{14}_[0-9a-f]{8}$')
+_profile_lock = threading.Lock()
+
+def profile_admin_authorized():
+    token = app.config['PROFILE_ADMIN_TOKEN']
+    return bool(token) and hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+
+def profile_requested():
+    flag = request.headers.get('X-Profile') or request.args.get('profile')
+    return bool(flag) and flag.lower() in ('1', 'true', 'yes') and request.method != 'OPTIONS'
+
+def save_request_profile(profiler, endpoint):
+    profile_id = f"{endpoint}_{ist_now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], f"{profile_id}.prof"))
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).strip_dirs().sort_stats('cumulative').print_stats(app.config['PROFILE_TOP_N'])
+    logger.info(f"Profile {profile_id} for {request.method} {request.full_path} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}:\n{summary.getvalue()}")
+    return profile_id
+
+def profiled_route(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not app.config['PROFILE_ADMIN_TOKEN'] or not profile_requested():
+            return view(*args, **kwargs)
+        if not profile_admin_authorized():
+            logger.warning(f"Rejected profiling request for {request.path} without a valid admin token at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({'success': False, 'error': 'Profiling requires a valid X-Admin-Token'}), 403)
+            response.headers['Access-Control-Allow-Origin'] = request.headers.get('Origin', '*')
+            return response
+        # One profiled request per process at a time; a concurrent one is served normally and says so.
+        if not _profile_lock.acquire(blocking=False):
+            response = make_response(view(*args, **kwargs))
+            response.headers['X-Profile-Status'] = 'busy'
+            return response
+        try:
+            profiler = cProfile.Profile()
+            response = make_response(profiler.runcall(view, *args, **kwargs))
+            response.headers['X-Profile-Id'] = save_request_profile(profiler, view.__name__)
+            response.headers['X-Profile-Status'] = 'saved'
+            return response
+        finally:
+            _profile_lock.release()
+    return wrapper
+
 @app.route('/upload', methods=['POST', 'OPTIONS'])
+@profiled_route
 def upload():
     if request.method == 'OPTIONS':
         response = make_response('', 204)
@@ -559,109 +2384,194 @@ def upload():
         return resp
 
     try:
-        batch_doc_id = f"analysis_departure_{current_date.strftime('%Y%m%d%H%M%S')}"
+        # Re-uploading against an existing batch (form field 'doc_id') rewrites that batch in place and only
+        # writes the chunks whose rows were added or changed.
+        base_doc_id = (request.form.get('doc_id') or '').strip()
+        previous_chunks = None
+        if base_doc_id:
+            if not BATCH_DOC_ID_PATTERN.match(base_doc_id):
+                resp = make_response(jsonify({'success': False, 'error': f"doc_id {base_doc_id} is not a batch analysis id"}), 400)
+                resp.headers['Access-Control-Allow-Origin'] = request.headers.get('Origin', '*')
+                return resp
+            previous_chunks = [reference.id for reference in list_chunk_references(base_doc_id)]
+            if not previous_chunks:
+                resp = make_response(jsonify({'success': False, 'error': f"No data found for doc_id {base_doc_id}"}), 404)
+                resp.headers['Access-Control-Allow-Origin'] = request.headers.get('Origin', '*')
+                return resp
+            # The per-sheet docs of the previous upload are diffed in place too, matched by sheet key.
+            previous_sheet_docs = db.collection("analysis_results").document(base_doc_id).get(field_paths=['sheet_docs']).to_dict() or {}
+            previous_sheet_docs = previous_sheet_docs.get('sheet_docs') or {}
+        else:
+            previous_sheet_docs = {}
+        batch_doc_id = base_doc_id or f"analysis_departure_{ist_now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}"
 
         all_sheets = {}
-        all_processed_rows = []          # <-- will be chunked later
-        all_stats = {
-            'total_flights': 0, 'unique_operators': 0, 'top_operator': None,
-            'avg_airtime': 0.0, 'arr_billed_count': 0, 'dep_billed_count': 0,
-            'udf_billed_count': 0, 'total_landing_charges': 0.0,
-            'total_parking_charges': 0.0, 'total_open_parking_charges': 0.0,
-            'total_housing_charges': 0.0, 'total_rnfc_charges': 0.0,
-            'total_tnlc_charges': 0.0, 'total_arr_watch_charges': 0.0,
-            'total_dep_watch_charges': 0.0, 'total_counter_charges': 0.0,
-            'total_xray_charges': 0.0, 'total_udf_charges': 0.0,
-            'total_operators': 0, 'total_assessment': 0.0,
-            'total_realisation': 0.0, 'total_closing_balance': 0.0
-        }
-
+        batch_partial = new_partial_aggregate()
+        batch_columns = []
+        batch_preview = []
+        filename_counts = collections.Counter()
+        sheet_docs = {}
+        sheet_writes = {}
         chart_bar_b64 = ''
         chart_pie_b64 = ''
-
-        for idx, file in enumerate(departure_files):
-            if not file.filename.lower().endswith(('.xlsx', '.xls')):
-                logger.warning(f"Skipping non-Excel file {file.filename}")
-                continue
-
-            logger.info(f"Processing departure file {idx+1}/{len(departure_files)}: {file.filename}")
-            sheet_result = process_excel_file(file, file_type='departure', filename=file.filename)
-
-            for sheet, data in sheet_result.items():
-                if 'error' in data:
-                    all_sheets[f"{file.filename}__{sheet}"] = data
+        batch_sketches = {}
+        batch_distinct = {}
+        batch_audit = {}
+        batch_summary = {}
+        batch_cube = {}
+        batch_routes = {'pairs': {}, 'operators': {}}
+
+        # Each sheet's full typed rows are streamed straight into the batch chunks (and snapshot) and then
+        # released; only the mergeable per-file aggregates are kept for the combined document.
+        previous_digests = load_row_digests(batch_doc_id, previous_chunks) if previous_chunks else None
+        chunk_plan = None
+        snapshot = SnapshotWriter(batch_doc_id) if app.config['SNAPSHOTS_ENABLED'] else None
+        try:
+            for idx, file in enumerate(departure_files):
+                if not file.filename.lower().endswith(UPLOAD_EXTENSIONS):
+                    logger.warning(f"Skipping unsupported file {file.filename}")
                     continue
 
-                for row in data.get('rows', []):
-                    row['Unique_Id'] = f"{file.filename}__{row['Unique_Id']}"
-
-                all_sheets[f"{file.filename}__{sheet}"] = data
-
-                processed_df = pd.DataFrame(data.get('rows', []))
-                if not processed_df.empty:
-                    processed_df['source_file'] = file.filename
-                    all_processed_rows.append(processed_df)
-
-                file_stats = data.get('stats', {})
-                for k in all_stats:
-                    if k in file_stats and isinstance(file_stats[k], (int, float)):
-                        all_stats[k] += float(file_stats[k])
-
-                if not chart_bar_b64 and data.get('chart_bar'):
-                    chart_bar_b64 = data['chart_bar']
-                if not chart_pie_b64 and data.get('chart_pie'):
-                    chart_pie_b64 = data['chart_pie']
-
-        if not all_processed_rows:
-            raise ValueError("No valid data extracted from any file")
-
-        full_df = pd.concat(all_processed_rows, ignore_index=True)
-        all_stats['total_flights'] = len(full_df)
-        all_stats['unique_operators'] = full_df['Operator_Name'].nunique()
-        all_stats['top_operator'] = full_df['Operator_Name'].value_counts().idxmax() if not full_df['Operator_Name'].empty else 'Unknown'
-
-        data_dict = full_df.to_dict(orient='records')
-        for rec in data_dict:
-            for k, v in rec.items():
-                if pd.isna(v):
-                    rec[k] = ""
-
-        max_chunk_size = 900000
-        chunk_size = 500
-        data_chunks = [data_dict[i:i + chunk_size] for i in range(0, len(data_dict), chunk_size)]
-
-        main_doc = {
-            'sheet_name': 'combined_departure_batch',
-            'file_type': 'departure',
-            'columns': full_df.columns.tolist(),
-            'rows': full_df.head(100).fillna('').to_dict(orient='records'),
-            'stats': all_stats,
-            'summary': full_df.describe(exclude=['datetime64[ns, UTC]']).fillna('').to_dict(),
-            'chart_bar': chart_bar_b64,
-            'chart_pie': chart_pie_b64,
-            'formal_summary': f"Batch analysis of {len(departure_files)} departure file(s) – {len(full_df)} total flight records, {full_df['Operator_Name'].nunique()} unique operators.",
-            'timestamp': firestore.SERVER_TIMESTAMP,
-            'total_records': len(full_df)
-        }
+                logger.info(f"Processing departure file {idx+1}/{len(departure_files)}: {file.filename}")
+                # Sheet keys are unique within the batch even when the same file name is uploaded twice. Row ids
+                # and audit entries are both prefixed with the sheet key, so audit ids always name batch rows.
+                filename_counts[file.filename] += 1
+                file_key = file.filename if filename_counts[file.filename] == 1 else f"{file.filename}#{filename_counts[file.filename]}"
+                reuse_doc_ids = {key[len(file_key) + 2:]: doc_id for key, doc_id in previous_sheet_docs.items() if key.startswith(f"{file_key}__")}
+                sheet_result = process_excel_file(file, file_type='departure', filename=file.filename, reuse_doc_ids=reuse_doc_ids)
+
+                for sheet, data in sheet_result.items():
+                    sheet_key = f"{file_key}__{sheet}"
+                    if 'error' in data:
+                        all_sheets[sheet_key] = data
+                        continue
 
-        @firestore_retry()
-        def set_main():
-            db.collection("analysis_results").document(batch_doc_id).set(main_doc)
+                    aggregates = data.pop('_aggregates', {})
+                    merge_dataset_sketches(batch_sketches, aggregates.get('sketches', {}))
+                    merge_distinct_sketches(batch_distinct, aggregates.get('distinct', {}))
+                    merge_numeric_summaries(batch_summary, aggregates.get('summary', {}))
+                    merge_traffic_cubes(batch_cube, aggregates.get('cube', {}))
+                    merge_route_matrices(batch_routes, aggregates.get('routes', {}))
+                    merge_audit_results(batch_audit, aggregates.get('audit', {}), prefix=f"{sheet_key}__")
+                    merge_partial_aggregates(batch_partial, aggregates.get('partial', {}))
+                    merge_write_stats(sheet_writes, aggregates.get('writes', {}))
+                    sheet_docs[sheet_key] = data['doc_id']
+
+                    records = aggregates.pop('records', [])
+                    for record in records:
+                        record['Unique_Id'] = f"{sheet_key}__{record['Unique_Id']}"
+                        record['source_file'] = file.filename
+                    records.sort(key=row_sort_key)
+                    batch_columns.extend(key for key in (records[0] if records else {}) if key not in batch_columns)
+                    batch_preview.extend(records[:100 - len(batch_preview)])
+                    chunk_plan = write_doc_chunks(batch_doc_id, records, previous_chunks, plan=chunk_plan)
+                    if snapshot:
+                        try:
+                            snapshot.add_part(records)
+                        except Exception as e:
+                            snapshot.abort()
+                            snapshot = None
+                            logger.warning(f"Failed to write snapshot for {batch_doc_id}, readers will fall back to Firestore: {e} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+                    del records
+
+                    all_sheets[sheet_key] = data
+
+                    if not chart_bar_b64 and data.get('chart_bar'):
+                        chart_bar_b64 = data['chart_bar']
+                    if not chart_pie_b64 and data.get('chart_pie'):
+                        chart_pie_b64 = data['chart_pie']
+
+            if not batch_partial['flights']:
+                raise ValueError("No valid data extracted from any file")
+
+            # Batch stats are merged from the per-file partials; unique_operators and top_operator are exact from
+            # the merged operator rollup, while the other distinct counts come from the per-file sketches. Neither rescans rows.
+            all_stats = {
+                'total_flights': 0, 'unique_operators': 0, 'top_operator': None,
+                'avg_airtime': 0.0, 'arr_billed_count': 0, 'dep_billed_count': 0,
+                'udf_billed_count': 0, 'total_landing_charges': 0.0,
+                'total_parking_charges': 0.0, 'total_open_parking_charges': 0.0,
+                'total_housing_charges': 0.0, 'total_rnfc_charges': 0.0,
+                'total_tnlc_charges': 0.0, 'total_arr_watch_charges': 0.0,
+                'total_dep_watch_charges': 0.0, 'total_counter_charges': 0.0,
+                'total_xray_charges': 0.0, 'total_udf_charges': 0.0,
+                'total_operators': 0, 'total_assessment': 0.0,
+                'total_realisation': 0.0, 'total_closing_balance': 0.0
+            }
+            all_stats.update(partial_aggregate_stats(batch_partial))
+            all_stats.update(distinct_stats(batch_distinct))
+            operator_rollup = batch_partial['operator_rollup']
+            all_stats['unique_operators'] = len(operator_rollup)
+            all_stats['top_operator'] = min(operator_rollup, key=lambda name: (-operator_rollup[name]['Flight_Count'], name)) if operator_rollup else 'Unknown'
+            total_records = batch_partial['flights']
 
-        set_main()
+            main_doc = {
+                'sheet_name': 'combined_departure_batch',
+                'file_type': 'departure',
+                'columns': batch_columns,
+                'rows': batch_preview,
+                'stats': all_stats,
+                'summary': finalize_numeric_summary(batch_summary),
+                'chart_bar': chart_bar_b64,
+                'chart_pie': chart_pie_b64,
+                'formal_summary': f"Batch analysis of {len(departure_files)} departure file(s) – {total_records} total flight records, {all_stats['unique_operators']} unique operators.",
+                'timestamp': firestore.SERVER_TIMESTAMP,
+                'total_records': total_records,
+                'operator_rollup': batch_partial['operator_rollup'],
+                'audit': audit_summary(batch_audit),
+                'chunks': chunk_plan['chunks'],
+                'sheet_docs': sheet_docs,
+                **serialize_distinct_sketches(batch_distinct)
+            }
 
-        for i, chunk in enumerate(data_chunks):
-            sub_id = f"data_chunk_{i}"
             @firestore_retry()
-            def set_chunk():
-                db.collection("analysis_results").document(batch_doc_id).collection("data").document(sub_id).set({'records': chunk})
-            set_chunk()
+            def set_main():
+                db.collection("analysis_results").document(batch_doc_id).set(main_doc)
+
+            set_main()
+            if snapshot:
+                try:
+                    snapshot.commit(chunk_plan['chunks'])
+                except Exception as e:
+                    snapshot.abort()
+                    logger.warning(f"Failed to write snapshot for {batch_doc_id}, readers will fall back to Firestore: {e} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+                snapshot = None
+        except Exception:
+            if snapshot:
+                snapshot.abort()
+            raise
+        delete_doc_chunks(batch_doc_id, chunk_plan['stale_chunks'])
+        save_dataset_sketches(batch_doc_id, batch_sketches)
+        save_audit_results(batch_doc_id, batch_audit)
+        save_traffic_cube(batch_doc_id, batch_cube)
+        save_route_matrix(batch_doc_id, batch_routes)
+        # Per-sheet docs of the previous upload whose sheet is gone from this one are no longer linked from the
+        # batch; delete them rather than leave orphans behind.
+        current_sheet_doc_ids = set(sheet_docs.values())
+        sheets_removed = sorted(key for key, doc_id in previous_sheet_docs.items() if doc_id not in current_sheet_doc_ids)
+        for key in sheets_removed:
+            delete_analysis_doc(previous_sheet_docs[key])
 
         response_payload = {
             'success': True,
             'doc_id': batch_doc_id,
+            'audit': main_doc['audit'],
             'sheets': all_sheets
         }
+        if previous_digests is not None:
+            # Write figures cover everything this upload wrote: the batch doc and every per-sheet doc, each with
+            # its changed chunks plus the main and derived docs that are always rewritten.
+            writes = doc_write_stats(chunk_plan, [main_doc, batch_sketches, batch_audit, batch_cube, encode_route_matrix(batch_routes)])
+            merge_write_stats(writes, sheet_writes)
+            response_payload['diff'] = {
+                'base_doc_id': base_doc_id,
+                **diff_row_digests(previous_digests, chunk_plan['digests']),
+                **writes,
+                'rows_total': total_records,
+                'sheet_docs_reused': sum(1 for doc_id in sheet_docs.values() if doc_id in previous_sheet_docs.values()),
+                'sheets_removed': sheets_removed,
+                'write_volume_saved': round(1 - writes['bytes_written'] / writes['bytes_total'], 4) if writes['bytes_total'] else 0.0
+            }
         resp = make_response(jsonify(response_payload), 200)
         resp.headers['Access-Control-Allow-Origin'] = request.headers.get('Origin', '*')
         logger.info(f"Batch upload successful – doc_id: {batch_doc_id}")
@@ -674,6 +2584,7 @@ def upload():
         return resp
 
 @app.route('/analyze', methods=['POST', 'OPTIONS'])
+@profiled_route
 def analyze():
     if request.method == 'OPTIONS':
         response = make_response('', 204)
@@ -687,7 +2598,7 @@ def analyze():
     base_file = request.files.get('base_file')
     logger.debug(f"Received file for /analyze: base={base_file.filename if base_file else 'None'} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
 
-    if not base_file or not base_file.filename or not base_file.filename.lower().endswith(('.xlsx', '.xls')):
+    if not base_file or not base_file.filename or not base_file.filename.lower().endswith(UPLOAD_EXTENSIONS):
         logger.error(f"No valid base file provided in /analyze request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
         response = make_response(jsonify({'success': False, 'error': 'Valid base Excel file is required'}), 400)
         origin = request.headers.get('Origin')
@@ -696,6 +2607,9 @@ def analyze():
 
     try:
         result = process_excel_file(base_file, file_type='base', filename=base_file.filename)
+        for sheet_data in result.values():
+            if isinstance(sheet_data, dict):
+                sheet_data.pop('_aggregates', None)
         if any('error' in sheet_data for sheet_data in result.values()):
             logger.error(f"Base file processing failed with errors: {result} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
             response = make_response(jsonify({'success': False, 'sheets': result}), 400)
@@ -716,7 +2630,17 @@ def analyze():
         response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
         return response
 
+SEARCH_FIELDS = [
+    'Reg_No', 'Arr_Local', 'Airport_Name', 'Operator_Name', 'Aircraft_Type', 'Unique_Id', 'Airtime_Hours',
+    'Linkage_Status', 'Arr_Bill_Status', 'Dep_Bill_Status', 'UDF_Bill_Status', 'Landing', 'UDF_Charge'
+]
+STATS_FIELDS = [
+    'file_type', 'Unique_Id', 'Operator_Name', 'Region', 'Airport_Name', 'Airtime_Hours', 'Linkage_Status',
+    'Arr_Bill_Status', 'Dep_Bill_Status', 'UDF_Bill_Status', 'Landing', 'UDF_Charge'
+]
+
 @app.route('/search', methods=['GET', 'OPTIONS'])
+@profiled_route
 def search():
     if request.method == 'OPTIONS':
         response = make_response('', 204)
@@ -739,9 +2663,8 @@ def search():
             response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
             return response
 
-        collection = db.collection("analysis_results").document(doc_id).collection("data")
-        docs = collection.get()
-        if not docs:
+        records = peek_records(iter_doc_records(doc_id, SEARCH_FIELDS))
+        if records is None:
             logger.warning(f"No data found for doc_id {doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
             response = make_response(jsonify({"error": f"No data found for doc_id {doc_id}"}), 404)
             origin = request.headers.get('Origin')
@@ -749,41 +2672,42 @@ def search():
             return response
 
         results = []
-        for doc in docs:
-            data = doc.to_dict().get('records', [])
-            for row in data:
-                reg_no = str(row.get('Reg_No', '')).lower()
-                arr_local = row.get('Arr_Local')
-                arr_date = 'Unknown'
-                if arr_local and isinstance(arr_local, str):
-                    try:
-                        arr_date = datetime.fromisoformat(arr_local.replace(' IST', '')).strftime('%Y-%m-%d')
-                    except ValueError:
-                        arr_date = 'Unknown'
+        for row in records:
+            reg_no = str(row.get('Reg_No', '')).lower()
+            arr_local = row.get('Arr_Local')
+            arr_date = 'Unknown'
+            if arr_local and isinstance(arr_local, str):
+                try:
+                    arr_date = datetime.fromisoformat(arr_local.replace(' IST', '')).strftime('%Y-%m-%d')
+                except ValueError:
+                    arr_date = 'Unknown'
                 
-                airport_name = str(row.get('Airport_Name', '')).lower()
-                operator_name = str(row.get('Operator_Name', '')).lower()
-                aircraft_type = str(row.get('Aircraft_Type', '')).lower()
+            airport_name = str(row.get('Airport_Name', '')).lower()
+            operator_name = str(row.get('Operator_Name', '')).lower()
+            aircraft_type = str(row.get('Aircraft_Type', '')).lower()
 
-                if query and not (query in reg_no or query in arr_date.lower() or query in airport_name or query in operator_name or query in aircraft_type):
-                    continue
+            if query and not (query in reg_no or query in arr_date.lower() or query in airport_name or query in operator_name or query in aircraft_type):
+                continue
                 
-                results.append({
-                    'Reg_No': reg_no,
-                    'Arr_Date': arr_date,
-                    'Airport_Name': row.get('Airport_Name', 'N/A'),
-                    'Operator_Name': row.get('Operator_Name', 'Unknown'),
-                    'Aircraft_Type': row.get('Aircraft_Type', 'Unknown'),
-                    'Count': 1,
-                    'Unique_Id': row.get('Unique_Id', 'N/A'),
-                    'Airtime_Hours': row.get('Airtime_Hours', '0.00'),
-                    'Linkage_Status': row.get('Linkage_Status', 'Unknown'),
-                    'Arr_Bill_Status': row.get('Arr_Bill_Status', 'unbilled'),
-                    'Dep_Bill_Status': row.get('Dep_Bill_Status', 'unbilled'),
-                    'UDF_Bill_Status': row.get('UDF_Bill_Status', 'unbilled'),
-                    'Landing': f"₹{float(row.get('Landing', 0.0)):.2f}",
-                    'UDF_Charge': f"₹{float(row.get('UDF_Charge', 0.0)):.2f}"
-                })
+            results.append({
+                'Reg_No': reg_no,
+                'Arr_Date': arr_date,
+                'Airport_Name': row.get('Airport_Name', 'N/A'),
+                'Operator_Name': row.get('Operator_Name', 'Unknown'),
+                'Aircraft_Type': row.get('Aircraft_Type', 'Unknown'),
+                'Count': 1,
+                'Unique_Id': row.get('Unique_Id', 'N/A'),
+                'Airtime_Hours': row.get('Airtime_Hours', '0.00'),
+                'Linkage_Status': row.get('Linkage_Status', 'Unknown'),
+                'Arr_Bill_Status': row.get('Arr_Bill_Status', 'unbilled'),
+                'Dep_Bill_Status': row.get('Dep_Bill_Status', 'unbilled'),
+                'UDF_Bill_Status': row.get('UDF_Bill_Status', 'unbilled'),
+                'Landing': f"₹{float(row.get('Landing', 0.0)):.2f}",
+                'UDF_Charge': f"₹{float(row.get('UDF_Charge', 0.0)):.2f}"
+            })
+            # Rows stream in chunk order, so nothing past the requested page needs to be fetched.
+            if len(results) >= page * limit + limit:
+                break
 
         start_idx = page * limit
         end_idx = start_idx + limit
@@ -802,6 +2726,7 @@ def search():
         return response
 
 @app.route('/stats', methods=['GET', 'OPTIONS'])
+@profiled_route
 def stats():
     if request.method == 'OPTIONS':
         response = make_response('', 204)
@@ -815,16 +2740,23 @@ def stats():
     try:
         doc_id = request.args.get('doc_id')
         group_by = request.args.get('group_by', 'operator').lower()
+        percentiles = [float(p) for p in request.args.get('percentiles', '').split(',') if p.strip()]
+        sketch_metrics = [m for m in request.args.get('metrics', ','.join(SKETCH_METRICS)).split(',') if m in SKETCH_METRICS]
+        include_histogram = request.args.get('histogram', '').lower() in ('1', 'true', 'yes')
         if not doc_id:
             logger.error(f"No doc_id provided in /stats request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
             response = make_response(jsonify({"error": "doc_id is required"}), 400)
             origin = request.headers.get('Origin')
             response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
             return response
+        if any(p < 0 or p > 100 for p in percentiles):
+            response = make_response(jsonify({"error": "percentiles must be between 0 and 100"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
 
-        collection = db.collection("analysis_results").document(doc_id).collection("data")
-        docs = collection.get()
-        if not docs:
+        records = peek_records(iter_doc_records(doc_id, STATS_FIELDS))
+        if records is None:
             logger.warning(f"No data found for doc_id {doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
             response = make_response(jsonify({"error": f"No data found for doc_id {doc_id}"}), 404)
             origin = request.headers.get('Origin')
@@ -834,52 +2766,50 @@ def stats():
         stats_summary = []
         if group_by == 'operator':
             operator_stats = {}
-            for doc in docs:
-                data = doc.to_dict().get('records', [])
-                for row in data:
-                    if row.get('file_type') != 'departure':
-                        continue
-                    raw_operator = row.get('Operator_Name')
-                    operator_name = str(raw_operator).strip() if raw_operator and pd.notna(raw_operator) and raw_operator != '' else 'Unknown'
-                    if operator_name.upper() == 'N/A' or not operator_name:
-                        operator_name = 'Unknown'
-                        logger.warning(f"Operator_Name missing or invalid for row {row.get('Unique_Id', 'Unknown')}, setting to 'Unknown' at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
-
-                    operator_stats.setdefault(operator_name, {
-                        'Operator_Name': operator_name,
-                        'Region': row.get('Region', 'Unknown'),
-                        'Flight_Count': 0,
-                        'Avg_Airtime_Hours': 0.0,
-                        'Total_Hours': 0.0,
-                        'Same_Linkage_Count': 0,
-                        'Different_Linkage_Count': 0,
-                        'Arr_Billed_Count': 0,
-                        'Arr_UnBilled_Count': 0,
-                        'Dep_Billed_Count': 0,
-                        'Dep_UnBilled_Count': 0,
-                        'UDF_Billed_Count': 0,
-                        'UDF_UnBilled_Count': 0,
-                        'Total_Landing_Charges': 0.0,
-                        'Total_UDF_Charges': 0.0
-                    })
-                    operator_stats[operator_name]['Flight_Count'] += 1
-                    airtime = float(row.get('Airtime_Hours', 0.0)) if row.get('Airtime_Hours') and pd.notna(row.get('Airtime_Hours')) else 0.0
-                    operator_stats[operator_name]['Avg_Airtime_Hours'] += airtime
-                    arr_gmt = row.get('Arr_Datetime_GMT')
-                    dep_gmt = row.get('Dep_Datetime_GMT')
-                    if arr_gmt and dep_gmt and isinstance(arr_gmt, datetime) and isinstance(dep_gmt, datetime):
-                        airtime_hours = abs((dep_gmt - arr_gmt).total_seconds() / 3600)
-                        operator_stats[operator_name]['Total_Hours'] += airtime_hours
-                    operator_stats[operator_name]['Same_Linkage_Count'] += 1 if row.get('Linkage_Status') == 'Same' else 0
-                    operator_stats[operator_name]['Different_Linkage_Count'] += 1 if row.get('Linkage_Status') == 'Different' else 0
-                    operator_stats[operator_name]['Arr_Billed_Count'] += 1 if row.get('Arr_Bill_Status') == 'billed' else 0
-                    operator_stats[operator_name]['Arr_UnBilled_Count'] += 1 if row.get('Arr_Bill_Status') == 'unbilled' else 0
-                    operator_stats[operator_name]['Dep_Billed_Count'] += 1 if row.get('Dep_Bill_Status') == 'billed' else 0
-                    operator_stats[operator_name]['Dep_UnBilled_Count'] += 1 if row.get('Dep_Bill_Status') == 'unbilled' else 0
-                    operator_stats[operator_name]['UDF_Billed_Count'] += 1 if row.get('UDF_Bill_Status') == 'billed' else 0
-                    operator_stats[operator_name]['UDF_UnBilled_Count'] += 1 if row.get('UDF_Bill_Status') == 'unbilled' else 0
-                    operator_stats[operator_name]['Total_Landing_Charges'] += float(row.get('Landing', 0.0))
-                    operator_stats[operator_name]['Total_UDF_Charges'] += float(row.get('UDF_Charge', 0.0))
+            for row in records:
+                if row.get('file_type') != 'departure':
+                    continue
+                raw_operator = row.get('Operator_Name')
+                operator_name = str(raw_operator).strip() if raw_operator and pd.notna(raw_operator) and raw_operator != '' else 'Unknown'
+                if operator_name.upper() == 'N/A' or not operator_name:
+                    operator_name = 'Unknown'
+                    logger.warning(f"Operator_Name missing or invalid for row {row.get('Unique_Id', 'Unknown')}, setting to 'Unknown' at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+
+                operator_stats.setdefault(operator_name, {
+                    'Operator_Name': operator_name,
+                    'Region': row.get('Region', 'Unknown'),
+                    'Flight_Count': 0,
+                    'Avg_Airtime_Hours': 0.0,
+                    'Total_Hours': 0.0,
+                    'Same_Linkage_Count': 0,
+                    'Different_Linkage_Count': 0,
+                    'Arr_Billed_Count': 0,
+                    'Arr_UnBilled_Count': 0,
+                    'Dep_Billed_Count': 0,
+                    'Dep_UnBilled_Count': 0,
+                    'UDF_Billed_Count': 0,
+                    'UDF_UnBilled_Count': 0,
+                    'Total_Landing_Charges': 0.0,
+                    'Total_UDF_Charges': 0.0
+                })
+                operator_stats[operator_name]['Flight_Count'] += 1
+                airtime = float(row.get('Airtime_Hours', 0.0)) if row.get('Airtime_Hours') and pd.notna(row.get('Airtime_Hours')) else 0.0
+                operator_stats[operator_name]['Avg_Airtime_Hours'] += airtime
+                arr_gmt = row.get('Arr_Datetime_GMT')
+                dep_gmt = row.get('Dep_Datetime_GMT')
+                if arr_gmt and dep_gmt and isinstance(arr_gmt, datetime) and isinstance(dep_gmt, datetime):
+                    airtime_hours = abs((dep_gmt - arr_gmt).total_seconds() / 3600)
+                    operator_stats[operator_name]['Total_Hours'] += airtime_hours
+                operator_stats[operator_name]['Same_Linkage_Count'] += 1 if row.get('Linkage_Status') == 'Same' else 0
+                operator_stats[operator_name]['Different_Linkage_Count'] += 1 if row.get('Linkage_Status') == 'Different' else 0
+                operator_stats[operator_name]['Arr_Billed_Count'] += 1 if row.get('Arr_Bill_Status') == 'billed' else 0
+                operator_stats[operator_name]['Arr_UnBilled_Count'] += 1 if row.get('Arr_Bill_Status') == 'unbilled' else 0
+                operator_stats[operator_name]['Dep_Billed_Count'] += 1 if row.get('Dep_Bill_Status') == 'billed' else 0
+                operator_stats[operator_name]['Dep_UnBilled_Count'] += 1 if row.get('Dep_Bill_Status') == 'unbilled' else 0
+                operator_stats[operator_name]['UDF_Billed_Count'] += 1 if row.get('UDF_Bill_Status') == 'billed' else 0
+                operator_stats[operator_name]['UDF_UnBilled_Count'] += 1 if row.get('UDF_Bill_Status') == 'unbilled' else 0
+                operator_stats[operator_name]['Total_Landing_Charges'] += float(row.get('Landing', 0.0))
+                operator_stats[operator_name]['Total_UDF_Charges'] += float(row.get('UDF_Charge', 0.0))
 
             for operator in operator_stats:
                 flight_count = operator_stats[operator]['Flight_Count']
@@ -890,51 +2820,49 @@ def stats():
 
         elif group_by == 'region':
             region_stats = {}
-            for doc in docs:
-                data = doc.to_dict().get('records', [])
-                for row in data:
-                    if row.get('file_type') != 'departure':
-                        continue
-                    raw_region = row.get('Region')
-                    region = str(raw_region).strip() if raw_region and pd.notna(raw_region) and raw_region != '' else 'Unknown'
-                    if region.upper() == 'N/A' or not region:
-                        region = 'Unknown'
-                        logger.warning(f"Region missing or invalid for row {row.get('Unique_Id', 'Unknown')}, setting to 'Unknown' at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
-
-                    region_stats.setdefault(region, {
-                        'Region': region,
-                        'Flight_Count': 0,
-                        'Avg_Airtime_Hours': 0.0,
-                        'Total_Hours': 0.0,
-                        'Same_Linkage_Count': 0,
-                        'Different_Linkage_Count': 0,
-                        'Arr_Billed_Count': 0,
-                        'Arr_UnBilled_Count': 0,
-                        'Dep_Billed_Count': 0,
-                        'Dep_UnBilled_Count': 0,
-                        'UDF_Billed_Count': 0,
-                        'UDF_UnBilled_Count': 0,
-                        'Total_Landing_Charges': 0.0,
-                        'Total_UDF_Charges': 0.0
-                    })
-                    region_stats[region]['Flight_Count'] += 1
-                    airtime = float(row.get('Airtime_Hours', 0.0)) if row.get('Airtime_Hours') and pd.notna(row.get('Airtime_Hours')) else 0.0
-                    region_stats[region]['Avg_Airtime_Hours'] += airtime
-                    arr_gmt = row.get('Arr_Datetime_GMT')
-                    dep_gmt = row.get('Dep_Datetime_GMT')
-                    if arr_gmt and dep_gmt and isinstance(arr_gmt, datetime) and isinstance(dep_gmt, datetime):
-                        airtime_hours = abs((dep_gmt - arr_gmt).total_seconds() / 3600)
-                        region_stats[region]['Total_Hours'] += airtime_hours
-                    region_stats[region]['Same_Linkage_Count'] += 1 if row.get('Linkage_Status') == 'Same' else 0
-                    region_stats[region]['Different_Linkage_Count'] += 1 if row.get('Linkage_Status') == 'Different' else 0
-                    region_stats[region]['Arr_Billed_Count'] += 1 if row.get('Arr_Bill_Status') == 'billed' else 0
-                    region_stats[region]['Arr_UnBilled_Count'] += 1 if row.get('Arr_Bill_Status') == 'unbilled' else 0
-                    region_stats[region]['Dep_Billed_Count'] += 1 if row.get('Dep_Bill_Status') == 'billed' else 0
-                    region_stats[region]['Dep_UnBilled_Count'] += 1 if row.get('Dep_Bill_Status') == 'unbilled' else 0
-                    region_stats[region]['UDF_Billed_Count'] += 1 if row.get('UDF_Bill_Status') == 'billed' else 0
-                    region_stats[region]['UDF_UnBilled_Count'] += 1 if row.get('UDF_Bill_Status') == 'unbilled' else 0
-                    region_stats[region]['Total_Landing_Charges'] += float(row.get('Landing', 0.0))
-                    region_stats[region]['Total_UDF_Charges'] += float(row.get('UDF_Charge', 0.0))
+            for row in records:
+                if row.get('file_type') != 'departure':
+                    continue
+                raw_region = row.get('Region')
+                region = str(raw_region).strip() if raw_region and pd.notna(raw_region) and raw_region != '' else 'Unknown'
+                if region.upper() == 'N/A' or not region:
+                    region = 'Unknown'
+                    logger.warning(f"Region missing or invalid for row {row.get('Unique_Id', 'Unknown')}, setting to 'Unknown' at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+
+                region_stats.setdefault(region, {
+                    'Region': region,
+                    'Flight_Count': 0,
+                    'Avg_Airtime_Hours': 0.0,
+                    'Total_Hours': 0.0,
+                    'Same_Linkage_Count': 0,
+                    'Different_Linkage_Count': 0,
+                    'Arr_Billed_Count': 0,
+                    'Arr_UnBilled_Count': 0,
+                    'Dep_Billed_Count': 0,
+                    'Dep_UnBilled_Count': 0,
+                    'UDF_Billed_Count': 0,
+                    'UDF_UnBilled_Count': 0,
+                    'Total_Landing_Charges': 0.0,
+                    'Total_UDF_Charges': 0.0
+                })
+                region_stats[region]['Flight_Count'] += 1
+                airtime = float(row.get('Airtime_Hours', 0.0)) if row.get('Airtime_Hours') and pd.notna(row.get('Airtime_Hours')) else 0.0
+                region_stats[region]['Avg_Airtime_Hours'] += airtime
+                arr_gmt = row.get('Arr_Datetime_GMT')
+                dep_gmt = row.get('Dep_Datetime_GMT')
+                if arr_gmt and dep_gmt and isinstance(arr_gmt, datetime) and isinstance(dep_gmt, datetime):
+                    airtime_hours = abs((dep_gmt - arr_gmt).total_seconds() / 3600)
+                    region_stats[region]['Total_Hours'] += airtime_hours
+                region_stats[region]['Same_Linkage_Count'] += 1 if row.get('Linkage_Status') == 'Same' else 0
+                region_stats[region]['Different_Linkage_Count'] += 1 if row.get('Linkage_Status') == 'Different' else 0
+                region_stats[region]['Arr_Billed_Count'] += 1 if row.get('Arr_Bill_Status') == 'billed' else 0
+                region_stats[region]['Arr_UnBilled_Count'] += 1 if row.get('Arr_Bill_Status') == 'unbilled' else 0
+                region_stats[region]['Dep_Billed_Count'] += 1 if row.get('Dep_Bill_Status') == 'billed' else 0
+                region_stats[region]['Dep_UnBilled_Count'] += 1 if row.get('Dep_Bill_Status') == 'unbilled' else 0
+                region_stats[region]['UDF_Billed_Count'] += 1 if row.get('UDF_Bill_Status') == 'billed' else 0
+                region_stats[region]['UDF_UnBilled_Count'] += 1 if row.get('UDF_Bill_Status') == 'unbilled' else 0
+                region_stats[region]['Total_Landing_Charges'] += float(row.get('Landing', 0.0))
+                region_stats[region]['Total_UDF_Charges'] += float(row.get('UDF_Charge', 0.0))
 
             for region in region_stats:
                 flight_count = region_stats[region]['Flight_Count']
@@ -945,23 +2873,32 @@ def stats():
 
         elif group_by == 'airport':
             airport_stats = {}
-            for doc in docs:
-                data = doc.to_dict().get('records', [])
-                for row in data:
-                    if row.get('file_type') != 'departure':
-                        continue
-                    airport = row.get('Airport_Name', 'Unknown')
-                    airport_stats.setdefault(airport, {
-                        'Airport_Name': airport,
-                        'Flight_Count': 0,
-                        'Total_Landing_Charges': 0.0,
-                        'Total_UDF_Charges': 0.0
-                    })
-                    airport_stats[airport]['Flight_Count'] += 1
-                    airport_stats[airport]['Total_Landing_Charges'] += float(row.get('Landing', 0.0))
-                    airport_stats[airport]['Total_UDF_Charges'] += float(row.get('UDF_Charge', 0.0))
+            for row in records:
+                if row.get('file_type') != 'departure':
+                    continue
+                airport = row.get('Airport_Name', 'Unknown')
+                airport_stats.setdefault(airport, {
+                    'Airport_Name': airport,
+                    'Flight_Count': 0,
+                    'Total_Landing_Charges': 0.0,
+                    'Total_UDF_Charges': 0.0
+                })
+                airport_stats[airport]['Flight_Count'] += 1
+                airport_stats[airport]['Total_Landing_Charges'] += float(row.get('Landing', 0.0))
+                airport_stats[airport]['Total_UDF_Charges'] += float(row.get('UDF_Charge', 0.0))
             stats_summary = list(airport_stats.values())
 
+        if (percentiles or include_histogram) and group_by in SKETCH_DIMENSIONS:
+            group_column = SKETCH_DIMENSIONS[group_by]
+            for metric in sketch_metrics:
+                groups = load_dataset_sketch(doc_id, group_by, metric)
+                if groups is None:
+                    logger.warning(f"No {metric} sketches stored for doc_id {doc_id}, skipping percentiles at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+                    continue
+                for entry in stats_summary:
+                    sketch = groups.get(str(entry.get(group_column, 'Unknown')))
+                    entry.setdefault('Percentiles', {})[metric] = describe_sketch(sketch, metric, percentiles, include_histogram)
+
         logger.info(f"Stats summary for group_by '{group_by}' and doc_id {doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {len(stats_summary)} records")
         response = make_response(jsonify(stats_summary), 200)
         origin = request.headers.get('Origin')
@@ -974,6 +2911,64 @@ def stats():
         response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
         return response
 
+@app.route('/export', methods=['GET', 'OPTIONS'])
+def export():
+    if request.method == 'OPTIONS':
+        response = make_response('', 204)
+        origin = request.headers.get('Origin')
+        logger.debug(f"OPTIONS request origin: {origin} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    try:
+        doc_id = request.args.get('doc_id')
+        if not doc_id:
+            logger.error(f"No doc_id provided in /export request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": "doc_id is required"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        records = iter_doc_records(doc_id)
+        first = next(records, None)
+        if first is None:
+            logger.warning(f"No data found for doc_id {doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": f"No data found for doc_id {doc_id}"}), 404)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        records = itertools.chain([first], records)
+        snapshot = open_doc_snapshot(doc_id)
+        fieldnames = snapshot['manifest']['columns'] if snapshot else list(first.keys())
+
+        def generate():
+            buffer = io.StringIO()
+            writer = csv.DictWriter(buffer, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            for count, row in enumerate(records, start=1):
+                writer.writerow(row)
+                if count % SNAPSHOT_BLOCK_ROWS == 0:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate(0)
+            yield buffer.getvalue()
+
+        response = Response(stream_with_context(generate()), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f"attachment; filename=export_{secure_filename(doc_id)}.csv"
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        logger.info(f"CSV export started for doc_id {doc_id} ({'snapshot' if snapshot else 'firestore'}) at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        return response
+    except Exception as e:
+        logger.error(f"Error in /export at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {str(e)}\n{traceback.format_exc()}")
+        response = make_response(jsonify({"error": str(e), "details": traceback.format_exc()}), 500)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+
 @app.route('/download_dashboard_pdf', methods=['GET', 'OPTIONS'])
 def download_dashboard_pdf():
     if request.method == 'OPTIONS':
@@ -1087,5 +3082,568 @@ def download_dashboard_pdf():
         response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
         return response
 
+@app.route('/linkage', methods=['GET', 'OPTIONS'])
+def linkage():
+    if request.method == 'OPTIONS':
+        response = make_response('', 204)
+        origin = request.headers.get('Origin')
+        logger.debug(f"OPTIONS request origin: {origin} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    try:
+        doc_id = request.args.get('doc_id')
+        reg_no = request.args.get('reg_no', '').strip().upper()
+        operator = request.args.get('operator', '').strip()
+        page = int(request.args.get('page', '0'))
+        limit = int(request.args.get('limit', '100'))
+        if not doc_id:
+            logger.error(f"No doc_id provided in /linkage request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": "doc_id is required"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        records = [row for row in iter_doc_records(doc_id, LINKAGE_COLUMNS + ['file_type']) if row.get('file_type', 'departure') == 'departure']
+        if not records:
+            logger.warning(f"No data found for doc_id {doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": f"No data found for doc_id {doc_id}"}), 404)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        chains = build_linkage_chains(records)
+        if operator:
+            chains = chains[chains['Operator_Name'] == operator]
+
+        issue_mask = chains[LINKAGE_ISSUE_TYPES].any(axis=1)
+        issues = chains[issue_mask]
+        start_idx = page * limit
+        result = {
+            'doc_id': doc_id,
+            'total_movements': len(records),
+            'chained_movements': int(len(chains)),
+            'aircraft_count': int(chains['Reg_No'].nunique()),
+            'issue_counts': {issue: int(chains[issue].sum()) for issue in LINKAGE_ISSUE_TYPES},
+            'operators': summarize_linkage_by_operator(chains),
+            'issues': [linkage_leg_to_dict(leg) for _, leg in issues.iloc[start_idx:start_idx + limit].iterrows()],
+            'total_issues': int(len(issues))
+        }
+        if reg_no:
+            result['chain'] = [linkage_leg_to_dict(leg) for _, leg in chains[chains['Reg_No'] == reg_no].iterrows()]
+
+        logger.info(f"Linkage chains for doc_id {doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {result['aircraft_count']} aircraft, {result['total_issues']} issues")
+        response = make_response(jsonify(result), 200)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+    except Exception as e:
+        logger.error(f"Error in /linkage at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {str(e)}\n{traceback.format_exc()}")
+        response = make_response(jsonify({"error": str(e), "details": traceback.format_exc()}), 500)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+
+@app.route('/audit', methods=['GET', 'OPTIONS'])
+def audit():
+    if request.method == 'OPTIONS':
+        response = make_response('', 204)
+        origin = request.headers.get('Origin')
+        logger.debug(f"OPTIONS request origin: {origin} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    try:
+        doc_id = request.args.get('doc_id')
+        rule_id = request.args.get('rule', '').strip()
+        page = int(request.args.get('page', '0'))
+        limit = int(request.args.get('limit', '100'))
+        if not doc_id:
+            logger.error(f"No doc_id provided in /audit request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": "doc_id is required"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+        if rule_id and rule_id not in {rule['id'] for rule in AUDIT_RULES}:
+            response = make_response(jsonify({"error": f"Unknown audit rule '{rule_id}'", "rules": [rule['id'] for rule in AUDIT_RULES]}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        doc = db.collection("analysis_results").document(doc_id).get(field_paths=['audit'])
+        summary = (doc.to_dict() or {}).get('audit') if doc.exists else None
+        if not summary:
+            logger.warning(f"No audit results found for doc_id {doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": f"No audit results found for doc_id {doc_id}"}), 404)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        result = {'doc_id': doc_id, **summary}
+        if rule_id:
+            row_ids = load_audit_row_ids(doc_id, rule_id)
+            start_idx = page * limit
+            result['rule'] = rule_id
+            result['row_ids'] = row_ids[start_idx:start_idx + limit]
+            result['total_row_ids'] = len(row_ids)
+
+        logger.info(f"Audit results for doc_id {doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {summary.get('total_violations', 0)} violations")
+        response = make_response(jsonify(result), 200)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+    except Exception as e:
+        logger.error(f"Error in /audit at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {str(e)}\n{traceback.format_exc()}")
+        response = make_response(jsonify({"error": str(e), "details": traceback.format_exc()}), 500)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+
+@app.route('/timeseries', methods=['GET', 'OPTIONS'])
+def timeseries():
+    if request.method == 'OPTIONS':
+        response = make_response('', 204)
+        origin = request.headers.get('Origin')
+        logger.debug(f"OPTIONS request origin: {origin} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    try:
+        doc_ids = [d.strip() for d in request.args.get('doc_id', '').split(',') if d.strip()]
+        airport = request.args.get('airport', CUBE_ALL_AIRPORTS).strip().upper() or CUBE_ALL_AIRPORTS
+        view = request.args.get('view', 'heatmap').lower()
+        metric = request.args.get('metric', 'movements')
+        granularity = request.args.get('granularity', 'hour').lower()
+        start = request.args.get('start')
+        end = request.args.get('end')
+        if not doc_ids:
+            logger.error(f"No doc_id provided in /timeseries request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": "doc_id is required"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+        if metric not in CUBE_MEASURES + ['movements'] or view not in ('heatmap', 'series') or granularity not in ('hour', 'day'):
+            response = make_response(jsonify({"error": f"metric must be one of {CUBE_MEASURES + ['movements']}, view heatmap|series, granularity hour|day"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        with ThreadPoolExecutor(max_workers=max(1, min(app.config['FETCH_WORKERS'], len(doc_ids)))) as executor:
+            entries = list(executor.map(lambda doc_id: load_traffic_cube(doc_id, airport), doc_ids))
+        merged = None
+        for entry in entries:
+            if entry:
+                merged = merge_traffic_cube_entry(merged, entry)
+        if merged is None:
+            logger.warning(f"No traffic cube found for {doc_ids} / {airport} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": f"No traffic data found for airport {airport}"}), 404)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        days = slice_traffic_cube(merged, metric, start, end)
+        result = {'doc_ids': doc_ids, 'airport': airport, 'metric': metric, 'view': view}
+        if view == 'heatmap':
+            result['days'] = [day for day, _ in days]
+            result['hours'] = list(range(24))
+            result['values'] = [hours for _, hours in days]
+        elif granularity == 'day':
+            result['series'] = [{'period': day, 'value': sum(hours)} for day, hours in days]
+        else:
+            result['series'] = [{'period': f"{day}T{hour:02d}:00+05:30", 'value': value} for day, hours in days for hour, value in enumerate(hours)]
+
+        logger.info(f"Timeseries {view} for {airport} over {len(doc_ids)} doc(s) at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {len(days)} day(s)")
+        response = make_response(jsonify(result), 200)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+    except Exception as e:
+        logger.error(f"Error in /timeseries at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {str(e)}\n{traceback.format_exc()}")
+        response = make_response(jsonify({"error": str(e), "details": traceback.format_exc()}), 500)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+
+@app.route('/routes', methods=['GET', 'OPTIONS'])
+def routes():
+    if request.method == 'OPTIONS':
+        response = make_response('', 204)
+        origin = request.headers.get('Origin')
+        logger.debug(f"OPTIONS request origin: {origin} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    try:
+        doc_ids = [d.strip() for d in request.args.get('doc_id', '').split(',') if d.strip()]
+        view = request.args.get('view', 'top').lower()
+        sort_by = request.args.get('sort_by', 'movements').lower()
+        limit = int(request.args.get('limit', '20'))
+        airport = request.args.get('airport', '').strip().upper()
+        operator = request.args.get('operator', '').strip()
+        if not doc_ids:
+            logger.error(f"No doc_id provided in /routes request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": "doc_id is required"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+        if view not in ('top', 'airport', 'operator') or sort_by not in ROUTE_SORT_KEYS:
+            response = make_response(jsonify({"error": f"view must be top|airport|operator and sort_by one of {list(ROUTE_SORT_KEYS)}"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        with ThreadPoolExecutor(max_workers=max(1, min(app.config['FETCH_WORKERS'], len(doc_ids)))) as executor:
+            loaded = list(executor.map(load_route_matrix, doc_ids))
+        if not any(loaded):
+            logger.warning(f"No route matrix found for {doc_ids} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": f"No route data found for doc_id {','.join(doc_ids)}"}), 404)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+        matrix = {'pairs': {}, 'operators': {}}
+        for entry in loaded:
+            if entry:
+                merge_route_matrices(matrix, entry)
+
+        key = ROUTE_SORT_KEYS[sort_by]
+        result = {'doc_ids': doc_ids, 'view': view, 'total_routes': len(matrix['pairs'])}
+        if view == 'top':
+            ranked = sorted(matrix['pairs'].items(), key=lambda item: item[1][key], reverse=True)[:limit]
+            result['routes'] = [route_entry(origin, dest, *values) for (origin, dest), values in ranked]
+        elif view == 'airport':
+            totals = airport_route_totals(matrix)
+            if airport:
+                result['airport'] = totals.get(airport, {'Airport_Code': airport})
+                inbound = [(pair, values) for pair, values in matrix['pairs'].items() if pair[1] == airport]
+                outbound = [(pair, values) for pair, values in matrix['pairs'].items() if pair[0] == airport]
+                result['inbound'] = [route_entry(o, d, *values) for (o, d), values in sorted(inbound, key=lambda item: item[1][key], reverse=True)[:limit]]
+                result['outbound'] = [route_entry(o, d, *values) for (o, d), values in sorted(outbound, key=lambda item: item[1][key], reverse=True)[:limit]]
+            else:
+                result['airports'] = sorted(totals.values(), key=lambda entry: entry['Inbound_Movements'] + entry['Outbound_Movements'], reverse=True)
+        else:
+            route_sets = {}
+            for (name, origin, dest), (movements, charges) in matrix['operators'].items():
+                route_sets.setdefault(name, []).append({'Origin': origin, 'Destination': dest, 'Movements': movements, 'Charges': round(charges, 2)})
+            if operator:
+                operator_routes = route_sets.get(operator) or route_sets.get(canonicalize_operator_name(operator), [])
+                result['operator'] = operator
+                result['routes'] = sorted(operator_routes, key=lambda entry: entry['Movements'], reverse=True)[:limit]
+                result['route_count'] = len(operator_routes)
+            else:
+                result['operators'] = sorted(({
+                    'Operator_Name': name,
+                    'Route_Count': len(entries),
+                    'Movements': sum(entry['Movements'] for entry in entries),
+                    'Top_Routes': sorted(entries, key=lambda entry: entry['Movements'], reverse=True)[:5]
+                } for name, entries in route_sets.items()), key=lambda entry: entry['Movements'], reverse=True)
+
+        logger.info(f"Route view '{view}' over {len(doc_ids)} doc(s) at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {result['total_routes']} routes")
+        response = make_response(jsonify(result), 200)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+    except Exception as e:
+        logger.error(f"Error in /routes at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {str(e)}\n{traceback.format_exc()}")
+        response = make_response(jsonify({"error": str(e), "details": traceback.format_exc()}), 500)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+
+@app.route('/compare', methods=['GET', 'POST', 'OPTIONS'])
+def compare():
+    if request.method == 'OPTIONS':
+        response = make_response('', 204)
+        origin = request.headers.get('Origin')
+        logger.debug(f"OPTIONS request origin: {origin} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    try:
+        payload = (request.get_json(silent=True) or {}) if request.method == 'POST' else {}
+        doc_ids = payload.get('doc_ids') or [d.strip() for d in request.args.get('doc_ids', '').split(',') if d.strip()]
+        start = payload.get('start') or request.args.get('start')
+        end = payload.get('end') or request.args.get('end')
+        mode = str(payload.get('mode') or request.args.get('mode', 'side_by_side')).lower()
+        raw_percentiles = payload.get('percentiles') or request.args.get('percentiles', '')
+        if isinstance(raw_percentiles, str):
+            raw_percentiles = [p for p in raw_percentiles.split(',') if p.strip()]
+        try:
+            percentiles = [float(p) for p in (raw_percentiles if isinstance(raw_percentiles, list) else [raw_percentiles])]
+        except (TypeError, ValueError):
+            response = make_response(jsonify({"error": "percentiles must be a comma-separated list of numbers"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+        if not all(0 <= p <= 100 for p in percentiles):
+            response = make_response(jsonify({"error": "percentiles must be between 0 and 100"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+        if mode not in COMPARE_MODES:
+            response = make_response(jsonify({"error": f"mode must be one of {', '.join(COMPARE_MODES)}"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        if not doc_ids and start and end:
+            try:
+                start_date, end_date = datetime.strptime(start, '%Y-%m-%d'), datetime.strptime(end, '%Y-%m-%d')
+            except (TypeError, ValueError):
+                response = make_response(jsonify({"error": "start and end must be dates in YYYY-MM-DD format"}), 400)
+                origin = request.headers.get('Origin')
+                response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+                return response
+            doc_ids = list_batch_doc_ids(start_date, end_date)
+        doc_ids = sorted(set(doc_ids))
+        if not doc_ids:
+            logger.error(f"No doc_ids or date range provided in /compare request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": "doc_ids or start/end (YYYY-MM-DD) is required"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+        if len(doc_ids) > app.config['MAX_COMPARE_BATCHES']:
+            response = make_response(jsonify({"error": f"At most {app.config['MAX_COMPARE_BATCHES']} batches can be compared, got {len(doc_ids)}"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        rollups = fetch_batch_rollups(doc_ids)
+        missing = [doc_id for doc_id in doc_ids if rollups[doc_id] is None]
+        found = [doc_id for doc_id in doc_ids if rollups[doc_id] is not None]
+        if not found:
+            response = make_response(jsonify({"error": "No data found for the requested batches", "missing": missing}), 404)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        merged_operators = {}
+        batch_totals = {}
+        for doc_id in found:
+            merge_operator_rollups(merged_operators, rollups[doc_id])
+            batch_totals[doc_id] = finalize_rollup_metrics(total_operator_rollups(rollups[doc_id]))
+
+        batch_distinct = fetch_batch_distinct_sketches(found)
+        merged_distinct = {}
+        for doc_id in found:
+            merge_distinct_sketches(merged_distinct, batch_distinct[doc_id])
+
+        merged_total = total_operator_rollups(merged_operators)
+        result = {
+            'doc_ids': found,
+            'missing': missing,
+            'mode': mode,
+            'merged': {
+                'totals': finalize_rollup_metrics(merged_total),
+                'distinct': distinct_stats(merged_distinct),
+                'operators': [dict(Operator_Name=name, **finalize_rollup_metrics(metrics)) for name, metrics in sorted(merged_operators.items())]
+            }
+        }
+
+        batch_percentiles = {}
+        if percentiles:
+            merged_sketches = {}
+            for doc_id in found:
+                batch_percentiles[doc_id] = {}
+                for metric in SKETCH_METRICS:
+                    sketch = (load_dataset_sketch(doc_id, 'all', metric) or {}).get('All')
+                    if sketch:
+                        merged_sketches[metric] = merge_metric_sketch(merged_sketches.get(metric), sketch)
+                        batch_percentiles[doc_id][metric] = describe_sketch(sketch, metric, percentiles)
+            result['merged']['percentiles'] = {metric: describe_sketch(sketch, metric, percentiles) for metric, sketch in merged_sketches.items()}
+
+        if mode == 'side_by_side':
+            totals = []
+            previous = None
+            for doc_id in found:
+                entry = {'doc_id': doc_id, **batch_totals[doc_id]}
+                entry['deltas'] = compute_metric_deltas(batch_totals[doc_id], previous) if previous else {}
+                entry['distinct'] = distinct_stats(batch_distinct[doc_id])
+                if percentiles:
+                    entry['percentiles'] = batch_percentiles.get(doc_id, {})
+                previous = batch_totals[doc_id]
+                totals.append(entry)
+            operators = []
+            for operator_name in sorted(merged_operators):
+                batches = []
+                previous = None
+                for doc_id in found:
+                    metrics = finalize_rollup_metrics(rollups[doc_id].get(operator_name, new_operator_rollup()))
+                    batches.append({'doc_id': doc_id, **metrics, 'deltas': compute_metric_deltas(metrics, previous) if previous else {}})
+                    previous = metrics
+                operators.append({'Operator_Name': operator_name, 'batches': batches})
+            result['batches'] = totals
+            result['operators'] = operators
+
+        logger.info(f"Compared {len(found)} batches ({len(missing)} missing) in mode '{mode}' at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response = make_response(jsonify(result), 200)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+    except Exception as e:
+        logger.error(f"Error in /compare at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {str(e)}\n{traceback.format_exc()}")
+        response = make_response(jsonify({"error": str(e), "details": traceback.format_exc()}), 500)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+
+@app.route('/join', methods=['GET', 'OPTIONS'])
+def join():
+    if request.method == 'OPTIONS':
+        response = make_response('', 204)
+        origin = request.headers.get('Origin')
+        logger.debug(f"OPTIONS request origin: {origin} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    try:
+        base_doc_id = request.args.get('base_doc_id')
+        departure_doc_id = request.args.get('departure_doc_id')
+        how = request.args.get('how', 'outer').lower()
+        if not base_doc_id or not departure_doc_id:
+            logger.error(f"Missing base_doc_id or departure_doc_id in /join request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": "base_doc_id and departure_doc_id are required"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+        if how not in ('inner', 'left', 'outer'):
+            response = make_response(jsonify({"error": "how must be one of inner, left, outer"}), 400)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            base_future = executor.submit(lambda: build_base_join_table(iter_doc_records(base_doc_id, ['Operator_Name'] + JOIN_BASE_METRICS)))
+            movements_future = executor.submit(lambda: probe_departure_join(iter_doc_records(departure_doc_id, JOIN_DEPARTURE_FIELDS)))
+            base_table = base_future.result()
+            movements = movements_future.result()
+
+        missing = [doc_id for doc_id, data in ((base_doc_id, base_table), (departure_doc_id, movements)) if not data]
+        if missing:
+            logger.warning(f"No data found for doc_ids {missing} in /join at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({"error": f"No data found for doc_id(s) {', '.join(missing)}"}), 404)
+            origin = request.headers.get('Origin')
+            response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+            return response
+
+        joined = join_base_and_departure(base_table, movements, how)
+        result = {
+            'base_doc_id': base_doc_id,
+            'departure_doc_id': departure_doc_id,
+            'how': how,
+            'matched_operators': sum(1 for row in joined if row['Match'] == 'matched'),
+            'base_only_operators': sum(1 for row in joined if row['Match'] == 'base_only'),
+            'departure_only_operators': sum(1 for row in joined if row['Match'] == 'departure_only'),
+            'operators': joined
+        }
+        logger.info(f"Joined base {base_doc_id} with departure {departure_doc_id} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {len(joined)} operators, {result['matched_operators']} matched")
+        response = make_response(jsonify(result), 200)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+    except Exception as e:
+        logger.error(f"Error in /join at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {str(e)}\n{traceback.format_exc()}")
+        response = make_response(jsonify({"error": str(e), "details": traceback.format_exc()}), 500)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+
+@app.route('/operator_aliases', methods=['GET', 'POST', 'OPTIONS'])
+def operator_aliases():
+    if request.method == 'OPTIONS':
+        response = make_response('', 204)
+        origin = request.headers.get('Origin')
+        logger.debug(f"OPTIONS request origin: {origin} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    try:
+        if request.method == 'POST':
+            payload = request.get_json(silent=True) or {}
+            alias = str(payload.get('alias', '')).strip()
+            canonical = str(payload.get('canonical', '')).strip()
+            if not alias or not canonical:
+                logger.error(f"Missing alias or canonical in /operator_aliases request at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+                response = make_response(jsonify({"error": "alias and canonical are required"}), 400)
+                origin = request.headers.get('Origin')
+                response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+                return response
+            alias_key = set_operator_alias(alias, canonical)
+            logger.info(f"Operator alias '{alias}' -> '{canonical}' saved at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+            response = make_response(jsonify({'success': True, 'alias_key': alias_key, 'canonical': canonical}), 200)
+        else:
+            aliases = load_operator_aliases()
+            response = make_response(jsonify({'aliases': [{'alias_key': key, 'canonical': value} for key, value in sorted(aliases.items())]}), 200)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+    except Exception as e:
+        logger.error(f"Error in /operator_aliases at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}: {str(e)}\n{traceback.format_exc()}")
+        response = make_response(jsonify({"error": str(e), "details": traceback.format_exc()}), 500)
+        origin = request.headers.get('Origin')
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        return response
+
+@app.route('/profiles/<profile_id>', methods=['GET', 'OPTIONS'])
+def download_profile(profile_id):
+    if request.method == 'OPTIONS':
+        response = make_response('', 204)
+        origin = request.headers.get('Origin')
+        logger.debug(f"OPTIONS request origin: {origin} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+        response.headers['Access-Control-Allow-Origin'] = origin if origin else '*'
+        response.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
+        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, X-Admin-Token'
+        return response
+
+    if not profile_admin_authorized():
+        response = make_response(jsonify({'success': False, 'error': 'A valid X-Admin-Token is required'}), 403)
+        response.headers['Access-Control-Allow-Origin'] = request.headers.get('Origin', '*')
+        return response
+    path = os.path.join(app.config['PROFILE_DIR'], f"{profile_id}.prof")
+    if not PROFILE_ID_PATTERN.match(profile_id) or not os.path.isfile(path):
+        response = make_response(jsonify({'success': False, 'error': f"No profile found for {profile_id}"}), 404)
+        response.headers['Access-Control-Allow-Origin'] = request.headers.get('Origin', '*')
+        return response
+    response = send_file(path, mimetype='application/octet-stream', as_attachment=True, download_name=f"{profile_id}.prof")
+    response.headers['Access-Control-Allow-Origin'] = request.headers.get('Origin', '*')
+    return response
+
+def run_production_server(host, port):
+    # gunicorn is POSIX-only, so it is imported here rather than at module load (dev runs on Windows).
+    from gunicorn.app.base import BaseApplication
+
+    class ProductionServer(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{host}:{port}")
+            self.cfg.set('workers', app.config['WORKERS'])
+            self.cfg.set('threads', app.config['THREADS'])
+            self.cfg.set('worker_class', 'gthread' if app.config['THREADS'] > 1 else 'sync')
+            self.cfg.set('timeout', int(os.getenv('WORKER_TIMEOUT', '600')))
+            # The master imports the app but never touches Firestore (db is lazy), so every worker opens its
+            # own gRPC channel after fork on its first request.
+            self.cfg.set('preload_app', False)
+
+        def load(self):
+            return app
+
+    logger.info(f"Starting production server on {host}:{port} with {app.config['WORKERS']} worker(s) x {app.config['THREADS']} thread(s), snapshots in {app.config['SNAPSHOT_DIR']} at {current_date.strftime('%Y-%m-%d %H:%M:%S IST')}")
+    ProductionServer().run()
+
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5003)
\ No newline at end of file
+    if os.getenv('SERVE_MODE', 'development') == 'production':
+        run_production_server(os.getenv('HOST', '0.0.0.0'), int(os.getenv('PORT', '5003')))
+    else:
+        app.run(debug=True, host='0.0.0.0', port=5003)
\ No newline at end of file
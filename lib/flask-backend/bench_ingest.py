@@ -0,0 +1,155 @@
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from load_test import departure_table, git_revision
+
+# Parse-throughput benchmark for the upload loaders in Merged_flask_app.py. Writes the same synthetic departure
+# export as .xlsx, .csv and .parquet, times loading and normalizing it with each Excel engine and each format,
+# and checks that every case yields exactly the records the openpyxl path produces.
+#
+#   python bench_ingest.py --rows 20000 --repeat 3 --output ingest.json
+#   python bench_ingest.py --formats xlsx --engines openpyxl,calamine
+
+FORMATS = ['xlsx', 'csv', 'parquet']
+ENGINES = ['openpyxl', 'calamine']
+
+
+class UploadFile:
+    # The loaders take the same file-like object Flask hands to process_excel_file.
+    def __init__(self, content):
+        self.content = content
+
+    def read(self):
+        return self.content
+
+
+def encode_table(table, file_format):
+    if file_format == 'xlsx':
+        buffer = io.BytesIO()
+        table.to_excel(buffer, header=False, index=False, sheet_name='Departures')
+        return buffer.getvalue()
+    if file_format == 'csv':
+        return table.to_csv(header=False, index=False).encode('utf-8')
+    # The ETL writes Parquet with real column names and no title rows.
+    frame = pd.DataFrame(table.iloc[3:].values.tolist(), columns=table.iloc[2].tolist())
+    for col in frame.columns:
+        if frame[col].dtype == object:
+            frame[col] = frame[col].astype(str)
+    buffer = io.BytesIO()
+    frame.to_parquet(buffer, index=False)
+    return buffer.getvalue()
+
+
+def load_app():
+    os.environ.setdefault('FIRESTORE_BACKEND', 'memory')
+    os.environ.setdefault('SNAPSHOT_DIR', tempfile.mkdtemp(prefix='bench_ingest_snapshots_'))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import logging
+    import Merged_flask_app
+    logging.getLogger().setLevel(logging.WARNING)
+    return Merged_flask_app
+
+
+def time_load(app_module, content, file_format, repeat):
+    timings = []
+    rows = 0
+    for _ in range(repeat):
+        stream = io.BytesIO(content)
+        started = time.perf_counter()
+        detected = app_module.detect_upload_format(stream)
+        for sheet in app_module.list_upload_sheets(stream, detected, f"bench.{file_format}"):
+            rows = len(app_module.load_upload_sheet(stream, detected, sheet, 'departure'))
+        timings.append(time.perf_counter() - started)
+    return rows, timings
+
+
+def processed_records(app_module, content, file_format):
+    result = app_module.process_excel_file(UploadFile(content), file_type='departure', filename=f"bench.{file_format}")
+    records = []
+    for data in result.values():
+        if 'error' in data:
+            raise RuntimeError(data['error'])
+        records.extend(data['_aggregates']['records'])
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark upload parsing per file format and Excel engine.')
+    parser.add_argument('--rows', type=int, default=20000, help='Rows in the synthetic departure export')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed loads per case (the median is reported)')
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--engines', default=','.join(ENGINES), help='Excel engines to time for .xlsx')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--no-verify', action='store_true', help='Skip the record-equality check against openpyxl')
+    parser.add_argument('--output', help='Write JSON results here (default: stdout)')
+    args = parser.parse_args()
+
+    app_module = load_app()
+    print(f"Generating a {args.rows}-row departure export ...", file=sys.stderr)
+    table = departure_table(args.rows, args.seed)
+    formats = [name for name in args.formats.split(',') if name]
+    engines = [name for name in args.engines.split(',') if name]
+    contents = {file_format: encode_table(table, file_format) for file_format in formats}
+
+    cases = []
+    for file_format in formats:
+        for engine in (engines if file_format == 'xlsx' else ['openpyxl']):
+            if engine == 'calamine' and not app_module.calamine_available():
+                print("Skipping calamine: python-calamine is not installed", file=sys.stderr)
+                continue
+            cases.append((file_format, engine))
+
+    baseline = None
+    if not args.no_verify:
+        app_module.app.config['EXCEL_ENGINE'] = 'openpyxl'
+        baseline = processed_records(app_module, contents['xlsx'] if 'xlsx' in contents else encode_table(table, 'xlsx'), 'xlsx')
+
+    results = []
+    for file_format, engine in cases:
+        app_module.app.config['EXCEL_ENGINE'] = engine
+        content = contents[file_format]
+        rows, timings = time_load(app_module, content, file_format, args.repeat)
+        median = statistics.median(timings)
+        entry = {
+            'format': file_format,
+            'engine': engine if file_format == 'xlsx' else None,
+            'rows': rows,
+            'bytes': len(content),
+            'seconds_median': round(median, 4),
+            'seconds_min': round(min(timings), 4),
+            'rows_per_second': round(rows / median, 1) if median else None,
+            'mb_per_second': round(len(content) / median / 1e6, 2) if median else None
+        }
+        if baseline is not None:
+            entry['identical_records'] = processed_records(app_module, content, file_format) == baseline
+        results.append(entry)
+
+    report = {
+        'meta': {'rows': args.rows, 'repeat': args.repeat, 'seed': args.seed, 'revision': git_revision(),
+                 'pandas': pd.__version__, 'python': sys.version.split()[0]},
+        'results': results
+    }
+
+    print(f"{'format':<8} {'engine':<9} {'MB':>7} {'median s':>9} {'rows/s':>10} {'MB/s':>7} identical", file=sys.stderr)
+    for entry in results:
+        print(f"{entry['format']:<8} {entry['engine'] or '-':<9} {entry['bytes'] / 1e6:>7.2f} {entry['seconds_median']:>9.3f} "
+              f"{entry['rows_per_second'] or 0:>10.0f} {entry['mb_per_second'] or 0:>7.2f} {entry.get('identical_records', '-')}", file=sys.stderr)
+
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            handle.write(payload)
+    else:
+        print(payload)
+
+
+if __name__ == '__main__':
+    main()
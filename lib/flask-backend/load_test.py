@@ -0,0 +1,407 @@
+import argparse
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+# Load harness for Merged_flask_app.py. Replays a weighted mix of month-end uploads and dashboard reads
+# against the app, either in-process (Flask test client, in-memory Firestore) or over HTTP against a local
+# server started with FIRESTORE_BACKEND=memory (one worker: each process has its own store). Reports
+# throughput, latency percentiles and peak RSS per endpoint as JSON so runs from different releases can be diffed.
+#
+#   python load_test.py --duration 60 --concurrency 8 --output results.json
+#   FIRESTORE_BACKEND=memory SERVE_MODE=production WORKERS=1 THREADS=8 python Merged_flask_app.py &
+#   python load_test.py --base-url http://127.0.0.1:5003 --server-pid $! --requests 500
+
+DEPARTURE_HEADER = [
+    'SL No.', 'Airport Code', 'Airport Name', 'Region', 'ProfitCenter', 'Operator Name', 'CA12 No.', 'Reg No.',
+    'Max Allup Wt', 'Seating Capacity', 'Helicopter', 'Aircraft Type', 'Arr Date', 'Arr GMT', 'Arr Flight No.',
+    'Dep Location', 'Arr Nature', 'Arr GCD', 'Arr Sch', 'Arr RCS Status', 'Arr RCS Category', 'Dep Date', 'Dep GMT',
+    'Dep Flight No.', 'Dest Location', 'Dep Nature', 'Dep GCD', 'Dep Sch', 'Dep RCS Status', 'Dep RCS Category',
+    'Credit Facility', 'Operator Type', 'Landing', 'Parking', 'Open Parking', 'Housing', 'RNFC', 'TNLC', 'Arr Watch',
+    'Dep Watch', 'Counter', 'XRay', 'UDF Charge', 'OLD IN PAX', 'OLD US PAX', 'NEW IN PAX', 'NEW US PAX',
+    'OLD IN RATE', 'OLD US RATE', 'NEW IN RATE', 'NEW US RATE', 'Unique Id', 'Arr Bill Status', 'Dep Bill Status',
+    'UDF Bill Status'
+]
+AIRPORTS = [('DEL', 'Delhi', 'NR'), ('BOM', 'Mumbai', 'WR'), ('BLR', 'Bengaluru', 'SR'), ('MAA', 'Chennai', 'SR'),
+            ('CCU', 'Kolkata', 'ER'), ('HYD', 'Hyderabad', 'SR'), ('IXB', 'Bagdogra', 'ER'), ('GAU', 'Guwahati', 'NER')]
+OPERATORS = ['Air India', 'AIR INDIA LTD', 'IndiGo', 'InterGlobe Aviation', 'SpiceJet', 'Alliance Air', 'Akasa Air', 'Star Air']
+AIRCRAFT = [('A320', 78000), ('B737', 79000), ('ATR72', 23000), ('Q400', 29000), ('E175', 38000)]
+SEARCH_TERMS = ['', 'air', 'indigo', 'vt-a', 'delhi', 'a320', '2025-07']
+STATS_GROUPS = ['operator', 'region', 'airport']
+DEFAULT_MIX = 'upload=1,analyze=1,search=6,stats=6,pdf=2'
+
+
+def departure_table(rows, seed):
+    # Sheet layout of a departure export: two title rows, the header row, then data (returned without column names).
+    rnd = random.Random(seed)
+    data = []
+    for i in range(rows):
+        code, name, region = rnd.choice(AIRPORTS)
+        aircraft, weight = rnd.choice(AIRCRAFT)
+        day = 45839 + rnd.randint(0, 30)
+        rcs = 'RCS' if rnd.random() < 0.1 else 'Non-RCS'
+        data.append([
+            i + 1, code, name, region, f"PC{code}", rnd.choice(OPERATORS), f"CA{seed}{i}", f"VT-{rnd.choice('ABCDEFGHJK')}{rnd.choice('ABCDEFGHJK')}{rnd.randint(1, 40)}",
+            weight, 180, 'N', aircraft, day, f"{rnd.randint(0, 23):02d}{rnd.randint(0, 59):02d}", f"AI{rnd.randint(100, 999)}",
+            rnd.choice(AIRPORTS)[0], 'D', rnd.randint(150, 2200), 'S', rcs, '',
+            day + rnd.choice([0, 0, 0, 1]), f"{rnd.randint(0, 23):02d}{rnd.randint(0, 59):02d}", f"AI{rnd.randint(100, 999)}",
+            rnd.choice(AIRPORTS)[0], 'D', rnd.randint(150, 2200), 'S', rcs, '', 'Y', 'D',
+            rnd.choice([0, 1200.5, 3400, 8800]), rnd.choice([0, 150, 450]), 0, 0, 0, 0, 0, 0, 0, 0, rnd.choice([0, 500, 900]),
+            rnd.randint(0, 180), 0, rnd.choice([0, 20]), 0, 1, 0, 1, 0, '',
+            rnd.choice(['billed', 'unbilled']), rnd.choice(['billed', 'unbilled']), rnd.choice(['billed', 'unbilled'])
+        ])
+    return pd.DataFrame([['Departure Details Report'] + [''] * (len(DEPARTURE_HEADER) - 1),
+                         [f"Generated {datetime.now():%Y-%m-%d}"] + [''] * (len(DEPARTURE_HEADER) - 1),
+                         DEPARTURE_HEADER] + data)
+
+
+def departure_workbook(rows, seed):
+    buffer = io.BytesIO()
+    departure_table(rows, seed).to_excel(buffer, header=False, index=False, sheet_name='Departures')
+    return buffer.getvalue()
+
+
+def base_workbook(seed):
+    rnd = random.Random(seed)
+    customers = OPERATORS + [f"Charter Operator {i}" for i in range(40)]
+    frame = pd.DataFrame({
+        'Payer ID': range(len(customers)), 'Customer Name': customers, 'VAN SPOC': 'N/A', 'CF Validity': '2026-03-31',
+        'Fleet Count': [rnd.randint(1, 120) for _ in customers], 'Opening Balance': [rnd.uniform(0, 1e6) for _ in customers],
+        'Assessment': [rnd.uniform(1e4, 5e7) for _ in customers], 'Realisation': [rnd.uniform(1e4, 4e7) for _ in customers],
+        'Closing Balance': [rnd.uniform(0, 1e7) for _ in customers], 'SD/BG': 0, 'Avg Monthly Assessment': 0
+    })
+    buffer = io.BytesIO()
+    frame.to_excel(buffer, index=False, sheet_name='Base')
+    return buffer.getvalue()
+
+
+def child_pids(pid):
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children", encoding='ascii') as handle:
+                children.extend(int(child) for child in handle.read().split())
+    except OSError:
+        pass
+    return children
+
+
+def read_rss(pid):
+    # Resident set of the process plus its descendants, so a gunicorn master PID covers its workers.
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status", encoding='ascii') as handle:
+                total += next((int(line.split()[1]) * 1024 for line in handle if line.startswith('VmRSS:')), 0)
+        except OSError:
+            continue
+        pending.extend(child_pids(current))
+    if not total and pid == os.getpid():
+        # No /proc (macOS, Windows): fall back to this process's peak RSS where the POSIX resource module exists.
+        try:
+            import resource
+        except ImportError:
+            return None
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    return total or None
+
+
+class InProcessClient:
+    mode = 'inprocess'
+
+    def __init__(self):
+        os.environ.setdefault('FIRESTORE_BACKEND', 'memory')
+        os.environ.setdefault('SNAPSHOT_DIR', tempfile.mkdtemp(prefix='load_test_snapshots_'))
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        import logging
+        import Merged_flask_app
+        logging.getLogger().setLevel(logging.WARNING)
+        self.app = Merged_flask_app.app
+        self.local = threading.local()
+
+    def request(self, method, path, params=None, files=None, form=None):
+        client = getattr(self.local, 'client', None)
+        if client is None:
+            client = self.local.client = self.app.test_client()
+        data = dict(form or {})
+        for field, entries in (files or {}).items():
+            data[field] = [(io.BytesIO(content), name) for name, content in entries]
+        response = client.open(path, method=method, query_string=params, data=data or None,
+                               content_type='multipart/form-data' if files else None)
+        return response.status_code, response.get_data(), response.get_json(silent=True)
+
+
+class HttpClient:
+    mode = 'http'
+
+    def __init__(self, base_url):
+        import requests
+        self.requests = requests
+        self.base_url = base_url.rstrip('/')
+        self.local = threading.local()
+
+    def request(self, method, path, params=None, files=None, form=None):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = self.local.session = self.requests.Session()
+        multipart = [(field, (name, content, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'))
+                     for field, entries in (files or {}).items() for name, content in entries]
+        response = session.request(method, self.base_url + path, params=params, files=multipart or None, data=form, timeout=600)
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        return response.status_code, response.content, body
+
+
+class Scenario:
+    def __init__(self, client, departure_books, base_books, files_per_upload):
+        self.client = client
+        self.departure_books = departure_books
+        self.base_books = base_books
+        self.files_per_upload = files_per_upload
+        self.departure_doc_ids = []
+        self.any_doc_ids = []
+        self.lock = threading.Lock()
+
+    def remember(self, body, departure):
+        if not isinstance(body, dict) or not body.get('doc_id'):
+            return
+        with self.lock:
+            if departure:
+                self.departure_doc_ids.append(body['doc_id'])
+                self.departure_doc_ids.extend(sheet['doc_id'] for sheet in body.get('sheets', {}).values() if isinstance(sheet, dict) and sheet.get('doc_id'))
+            self.any_doc_ids.append(body['doc_id'])
+
+    def pick(self, rnd, departure=True):
+        with self.lock:
+            return rnd.choice(self.departure_doc_ids if departure else self.any_doc_ids)
+
+    def upload(self, rnd):
+        books = rnd.sample(self.departure_books, min(self.files_per_upload, len(self.departure_books)))
+        files = {'departure_files[]': [(f"departures_{i}.xlsx", book) for i, book in enumerate(books)]}
+        status, body, payload = self.client.request('POST', '/upload', files=files)
+        self.remember(payload, departure=True)
+        return status, body
+
+    def analyze(self, rnd):
+        status, body, payload = self.client.request('POST', '/analyze', files={'base_file': [('base.xlsx', rnd.choice(self.base_books))]})
+        self.remember(payload, departure=False)
+        return status, body
+
+    def search(self, rnd):
+        params = {'doc_id': self.pick(rnd), 'query': rnd.choice(SEARCH_TERMS), 'page': rnd.randint(0, 2), 'limit': 50}
+        status, body, _ = self.client.request('GET', '/search', params=params)
+        return status, body
+
+    def stats(self, rnd):
+        params = {'doc_id': self.pick(rnd), 'group_by': rnd.choice(STATS_GROUPS)}
+        if rnd.random() < 0.3:
+            params['percentiles'] = '50,95,99'
+        status, body, _ = self.client.request('GET', '/stats', params=params)
+        return status, body
+
+    def pdf(self, rnd):
+        status, body, _ = self.client.request('GET', '/download_dashboard_pdf', params={'doc_id': self.pick(rnd, departure=False)})
+        return status, body
+
+
+class Recorder:
+    def __init__(self, pid, interval):
+        self.pid = pid
+        self.interval = interval
+        self.samples = defaultdict(list)
+        self.errors = Counter()
+        self.bytes = Counter()
+        self.active = Counter()
+        self.peak_rss = {}
+        self.overall_peak_rss = read_rss(pid)
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.sample_rss, daemon=True)
+
+    def sample_rss(self):
+        while not self.stopped.wait(self.interval):
+            self.note_rss(read_rss(self.pid))
+
+    def note_rss(self, rss):
+        if rss is None:
+            return
+        with self.lock:
+            self.overall_peak_rss = max(self.overall_peak_rss or 0, rss)
+            for endpoint, in_flight in self.active.items():
+                if in_flight:
+                    self.peak_rss[endpoint] = max(self.peak_rss.get(endpoint, 0), rss)
+
+    def run(self, endpoint, action, rnd):
+        with self.lock:
+            self.active[endpoint] += 1
+        started = time.perf_counter()
+        try:
+            status, body = action(rnd)
+        except Exception as e:
+            status, body = 599, str(e).encode('utf-8')
+        elapsed = time.perf_counter() - started
+        self.note_rss(read_rss(self.pid))
+        with self.lock:
+            self.active[endpoint] -= 1
+            self.samples[endpoint].append(elapsed)
+            self.bytes[endpoint] += len(body or b'')
+            if status >= 400:
+                self.errors[endpoint] += 1
+        return status
+
+    def summarize(self, latencies, wall_seconds, errors, size, peak):
+        values = np.asarray(latencies) * 1000.0
+        return {
+            'requests': len(latencies),
+            'errors': errors,
+            'throughput_rps': round(len(latencies) / wall_seconds, 3) if wall_seconds else 0.0,
+            'latency_ms': {
+                'mean': round(float(values.mean()), 2),
+                'p50': round(float(np.percentile(values, 50)), 2),
+                'p95': round(float(np.percentile(values, 95)), 2),
+                'p99': round(float(np.percentile(values, 99)), 2),
+                'max': round(float(values.max()), 2)
+            } if len(values) else {},
+            'response_bytes': size,
+            'peak_rss_mb': round(peak / 2 ** 20, 1) if peak is not None else None
+        }
+
+    def report(self, wall_seconds):
+        endpoints = {endpoint: self.summarize(latencies, wall_seconds, self.errors[endpoint], self.bytes[endpoint], self.peak_rss.get(endpoint))
+                     for endpoint, latencies in sorted(self.samples.items())}
+        everything = [value for latencies in self.samples.values() for value in latencies]
+        overall = self.summarize(everything, wall_seconds, sum(self.errors.values()), sum(self.bytes.values()), self.overall_peak_rss)
+        return endpoints, overall
+
+
+def parse_mix(spec, scenario):
+    mix = []
+    for item in spec.split(','):
+        name, _, weight = item.partition('=')
+        name = name.strip()
+        if not hasattr(scenario, name) or name in ('pick', 'remember'):
+            raise SystemExit(f"Unknown endpoint '{name}' in --mix (expected upload, analyze, search, stats, pdf)")
+        if float(weight or 1) > 0:
+            mix.append((name, float(weight or 1)))
+    return mix
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent load test for the airport linkage backend.')
+    parser.add_argument('--base-url', help='Target a running server instead of the in-process app')
+    parser.add_argument('--server-pid', type=int, help='PID whose RSS to sample when using --base-url')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds to run (ignored when --requests is set)')
+    parser.add_argument('--requests', type=int, help='Total number of requests to issue')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f"Weighted endpoint mix (default {DEFAULT_MIX})")
+    parser.add_argument('--rows', type=int, default=2000, help='Rows per synthetic departure workbook')
+    parser.add_argument('--workbooks', type=int, default=4, help='Distinct departure workbooks to rotate through')
+    parser.add_argument('--files-per-upload', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--rss-interval', type=float, default=0.05)
+    parser.add_argument('--output', help='Write JSON results here (default: stdout)')
+    args = parser.parse_args()
+
+    client = HttpClient(args.base_url) if args.base_url else InProcessClient()
+    target_pid = args.server_pid if args.base_url and args.server_pid else os.getpid()
+    print(f"Generating {args.workbooks} departure workbook(s) x {args.rows} rows ...", file=sys.stderr)
+    departure_books = [departure_workbook(args.rows, args.seed + i) for i in range(args.workbooks)]
+    base_books = [base_workbook(args.seed + i) for i in range(2)]
+    scenario = Scenario(client, departure_books, base_books, args.files_per_upload)
+    mix = parse_mix(args.mix, scenario)
+    names = [name for name, _ in mix]
+    weights = [weight for _, weight in mix]
+
+    # Seed one departure batch and one base analysis so read endpoints have documents from the start.
+    for action in (scenario.upload, scenario.analyze):
+        status, body = action(random.Random(args.seed))
+        if status >= 400:
+            raise SystemExit(f"Seeding request failed with HTTP {status}: {body[:500]!r}")
+
+    recorder = Recorder(target_pid, args.rss_interval)
+    recorder.thread.start()
+    issued = Counter()
+    issued_lock = threading.Lock()
+    deadline = time.perf_counter() + args.duration
+
+    def worker(index):
+        rnd = random.Random(args.seed * 1000 + index)
+        while True:
+            if args.requests is not None:
+                with issued_lock:
+                    if issued['total'] >= args.requests:
+                        return
+                    issued['total'] += 1
+            elif time.perf_counter() >= deadline:
+                return
+            endpoint = rnd.choices(names, weights)[0]
+            recorder.run(endpoint, getattr(scenario, endpoint), rnd)
+
+    print(f"Running {client.mode} load: concurrency={args.concurrency}, mix={args.mix}", file=sys.stderr)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started
+    recorder.stopped.set()
+    recorder.thread.join()
+
+    endpoints, overall = recorder.report(wall_seconds)
+    results = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_revision': git_revision(),
+            'python': sys.version.split()[0],
+            'mode': client.mode,
+            'target': args.base_url or 'Merged_flask_app (in-process)',
+            'concurrency': args.concurrency,
+            'mix': dict(mix),
+            'rows_per_workbook': args.rows,
+            'files_per_upload': args.files_per_upload,
+            'wall_seconds': round(wall_seconds, 3)
+        },
+        'endpoints': endpoints,
+        'overall': overall
+    }
+
+    print(f"{'endpoint':<10} {'reqs':>6} {'err':>5} {'rps':>8} {'p50ms':>9} {'p95ms':>9} {'p99ms':>9} {'rssMB':>8}", file=sys.stderr)
+    for name, entry in list(endpoints.items()) + [('overall', overall)]:
+        latency = entry['latency_ms'] or {'p50': 0, 'p95': 0, 'p99': 0}
+        print(f"{name:<10} {entry['requests']:>6} {entry['errors']:>5} {entry['throughput_rps']:>8} {latency['p50']:>9} {latency['p95']:>9} {latency['p99']:>9} {entry['peak_rss_mb'] if entry['peak_rss_mb'] is not None else '-':>8}", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as handle:
+            handle.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
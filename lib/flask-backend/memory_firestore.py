@@ -0,0 +1,228 @@
+import copy
+import threading
+from datetime import datetime
+
+import pytz
+from google.api_core import exceptions
+from google.cloud.firestore import SERVER_TIMESTAMP
+
+# In-process stand-in for the subset of the Firestore client API that Merged_flask_app.py uses
+# (documents, subcollections, field-path projections, simple where/order/limit queries, batches).
+# Selected with FIRESTORE_BACKEND=memory for load tests and local runs without credentials;
+# data lives only as long as the process.
+
+def _lookup(data, field_path):
+    value = data
+    for part in field_path.split('.'):
+        value = value.get(part.strip('`')) if isinstance(value, dict) else None
+    return value
+
+def _project(data, field_paths):
+    if data is None or field_paths is None:
+        return data
+    projected = {}
+    for path in field_paths:
+        source, target = data, projected
+        parts = [part.strip('`') for part in path.split('.')]
+        for part in parts[:-1]:
+            if not isinstance(source, dict) or part not in source:
+                source = None
+                break
+            source = source[part]
+            target = target.setdefault(part, {})
+        if isinstance(source, dict) and parts[-1] in source:
+            target[parts[-1]] = source[parts[-1]]
+    return projected
+
+
+class MemorySnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path):
+        return copy.deepcopy(_lookup(self._data or {}, field_path))
+
+
+class MemoryDocument:
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+        self.id = path[-1]
+
+    @property
+    def path(self):
+        return '/'.join(self._path)
+
+    def collection(self, name):
+        return MemoryCollection(self._client, self._path + (name,))
+
+    def set(self, data, merge=False):
+        stored = self._client.resolve(copy.deepcopy(data))
+        with self._client.lock:
+            if merge and self._path in self._client.docs:
+                self._client.docs[self._path].update(stored)
+            else:
+                self._client.docs[self._path] = stored
+
+    def create(self, data):
+        with self._client.lock:
+            if self._path in self._client.docs:
+                raise exceptions.Conflict(f"Document already exists: {self.path}")
+            self._client.docs[self._path] = self._client.resolve(copy.deepcopy(data))
+
+    def update(self, data):
+        with self._client.lock:
+            if self._path not in self._client.docs:
+                raise KeyError(f"No document to update: {self.path}")
+            self._client.docs[self._path].update(self._client.resolve(copy.deepcopy(data)))
+
+    def get(self, field_paths=None, **kwargs):
+        with self._client.lock:
+            data = copy.deepcopy(self._client.docs.get(self._path))
+        return MemorySnapshot(self, _project(data, field_paths))
+
+    def delete(self, **kwargs):
+        with self._client.lock:
+            self._client.docs.pop(self._path, None)
+
+
+class MemoryQuery:
+    OPERATORS = {
+        '==': lambda actual, value: actual == value,
+        '!=': lambda actual, value: actual != value,
+        '<': lambda actual, value: actual is not None and actual < value,
+        '<=': lambda actual, value: actual is not None and actual <= value,
+        '>': lambda actual, value: actual is not None and actual > value,
+        '>=': lambda actual, value: actual is not None and actual >= value,
+        'in': lambda actual, value: actual in value,
+        'array_contains': lambda actual, value: isinstance(actual, list) and value in actual,
+    }
+
+    def __init__(self, collection, filters=(), field_paths=None, order=None, limit_count=None):
+        self._collection = collection
+        self._filters = list(filters)
+        self._field_paths = field_paths
+        self._order = order
+        self._limit = limit_count
+
+    def _clone(self, **changes):
+        params = dict(filters=self._filters, field_paths=self._field_paths, order=self._order, limit_count=self._limit)
+        params.update(changes)
+        return MemoryQuery(self._collection, **params)
+
+    def select(self, field_paths):
+        return self._clone(field_paths=list(field_paths))
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._clone(filters=self._filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path, direction='ASCENDING'):
+        return self._clone(order=(field_path, direction))
+
+    def limit(self, count):
+        return self._clone(limit_count=count)
+
+    def _matches(self, doc_id, data):
+        for field_path, op_string, value in self._filters:
+            if field_path == '__name__':
+                actual = doc_id
+                value = value.id if isinstance(value, MemoryDocument) else value
+            else:
+                actual = _lookup(data, field_path)
+            try:
+                if not self.OPERATORS[op_string](actual, value):
+                    return False
+            except TypeError:
+                return False
+        return True
+
+    def stream(self, **kwargs):
+        client = self._collection._client
+        prefix = self._collection._path
+        with client.lock:
+            items = [(path, copy.deepcopy(data)) for path, data in client.docs.items()
+                     if len(path) == len(prefix) + 1 and path[:-1] == prefix]
+        items.sort(key=lambda item: item[0][-1])
+        if self._order:
+            field_path, direction = self._order
+            items.sort(key=lambda item: (_lookup(item[1], field_path) is None, _lookup(item[1], field_path)),
+                       reverse=str(direction).upper().startswith('DESC'))
+        count = 0
+        for path, data in items:
+            if not self._matches(path[-1], data):
+                continue
+            yield MemorySnapshot(MemoryDocument(client, path), _project(data, self._field_paths))
+            count += 1
+            if self._limit is not None and count >= self._limit:
+                break
+
+    def get(self, **kwargs):
+        return list(self.stream())
+
+
+class MemoryCollection(MemoryQuery):
+    def __init__(self, client, path):
+        self._client = client
+        self._path = path
+        self.id = path[-1]
+        super().__init__(self)
+
+    def document(self, document_id):
+        return MemoryDocument(self._client, self._path + (document_id,))
+
+    def list_documents(self, page_size=None):
+        # Like Firestore, this includes "missing" parents that only exist because they hold subcollections.
+        depth = len(self._path) + 1
+        with self._client.lock:
+            paths = sorted({path[:depth] for path in self._client.docs if len(path) >= depth and path[:len(self._path)] == self._path})
+        return [MemoryDocument(self._client, path) for path in paths]
+
+
+class MemoryBatch:
+    def __init__(self, client):
+        self._client = client
+        self._operations = []
+
+    def set(self, reference, data, merge=False):
+        self._operations.append(lambda: reference.set(data, merge=merge))
+
+    def delete(self, reference):
+        self._operations.append(reference.delete)
+
+    def commit(self):
+        with self._client.lock:
+            for operation in self._operations:
+                operation()
+        self._operations = []
+
+
+class MemoryClient:
+    def __init__(self):
+        self.docs = {}
+        self.lock = threading.RLock()
+
+    def resolve(self, value):
+        if value is SERVER_TIMESTAMP:
+            return datetime.now(pytz.UTC)
+        if isinstance(value, dict):
+            return {key: self.resolve(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        return value
+
+    def collection(self, name):
+        return MemoryCollection(self, (name,))
+
+    def batch(self):
+        return MemoryBatch(self)
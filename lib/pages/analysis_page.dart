@@ -76,7 +76,7 @@ class _AnalysisPageState extends State<AnalysisPage> {
     try {
       final result = await FilePicker.platform.pickFiles(
         type: FileType.custom,
-        allowedExtensions: ['xlsx', 'xls'],
+        allowedExtensions: ['xlsx', 'xls', 'csv', 'parquet'],
         withData: kIsWeb,
         allowMultiple: false,
       );
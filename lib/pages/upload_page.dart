@@ -40,7 +40,7 @@ class _UploadPageState extends State<UploadPage> {
     try {
       final res = await FilePicker.platform.pickFiles(
         type: FileType.custom,
-        allowedExtensions: ['xlsx', 'xls'],
+        allowedExtensions: ['xlsx', 'xls', 'csv', 'parquet'],
         allowMultiple: true,
       );
       if (res == null || res.files.isEmpty) {